@@ -0,0 +1,203 @@
+import hashlib
+import hmac
+import logging
+from flask import Blueprint, Response, request, jsonify
+from sqlalchemy.orm import Session, joinedload
+from config import Config
+from database import get_request_db
+from models import User, SavedBuild
+from services.build_store import build_request, enqueue_build, save_build as store_build
+from services.catalog import load_catalog
+
+logger = logging.getLogger(__name__)
+
+builds_bp = Blueprint("builds", __name__)
+
+
+def owner_token(email: str) -> str | None:
+    """
+    The access token for a user's saved builds: an HMAC of their email under
+    Config.BUILD_TOKEN_SECRET, returned by /save_build and required to read the builds back.
+    None when no secret is configured.
+    """
+    if not Config.BUILD_TOKEN_SECRET:
+        return None
+    message = email.strip().lower().encode("utf-8")
+    return hmac.new(Config.BUILD_TOKEN_SECRET.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def _authorized(email: str):
+    """None when the request carries `email`'s token (X-Build-Token header or ?token=), else an error response."""
+    if not Config.BUILD_TOKEN_SECRET:
+        return jsonify({"error": "Reading saved builds is not enabled on this server."}), 403
+    token = request.headers.get("X-Build-Token") or request.args.get("token") or ""
+    if not hmac.compare_digest(token, owner_token(email)):
+        return jsonify({"error": "A valid build token is required."}), 403
+    return None
+
+
+def _price_version(builds: list, catalog) -> str:
+    """
+    ETag of saved builds as served: the builds' parts, each part's product details and its
+    current price entry. Stays the same across scrapes that don't change these parts' prices.
+    """
+    digest = hashlib.sha1()
+    for build in builds:
+        digest.update(f"{build.id}:".encode())
+        for part in build.parts:
+            product = catalog.products.get(part.product_id)
+            entry = catalog.lowest_price(part.product_id)
+            # Everything _build_to_dict() reads from the catalog, so a renamed product or new image isn't answered with 304
+            served = (
+                part.id, part.product_id,
+                *((product.category, product.name, product.brand, product.model, product.image_url) if product else ()),
+                *((entry.id, entry.price, entry.retailer_name, entry.retailer_url) if entry else ()),
+            )
+            digest.update(repr(served).encode("utf-8") + b";")
+    return digest.hexdigest()[:32]
+
+
+def _build_to_dict(build: SavedBuild, catalog) -> dict:
+    """A saved build with each part's current lowest price, from the catalog (no per-part queries)."""
+    parts = []
+    total_recommended = total_current = 0.0
+    for part in build.parts:
+        product = catalog.products.get(part.product_id)
+        entry = catalog.lowest_price(part.product_id)
+        current_price = entry.price if entry else None
+        total_recommended += part.recommended_price
+        total_current += current_price if current_price is not None else part.recommended_price
+        parts.append({
+            "category": product.category if product else None,
+            "product_id": part.product_id,
+            "name": product.name if product else None,
+            "brand": product.brand if product else None,
+            "model": product.model if product else None,
+            "image_url": product.image_url if product else None,
+            "recommended_price": part.recommended_price,
+            "current_price": current_price,
+            "lowest_price_retailer": entry.retailer_name if entry else part.lowest_price_retailer,
+            "lowest_price_url": entry.retailer_url if entry else part.lowest_price_url,
+        })
+    return {
+        "build_id": build.id,
+        "created_at": build.created_at.isoformat() if build.created_at else None,
+        "user_preferences": build.user_preferences,
+        "parts": parts,
+        "total_recommended": round(total_recommended, 2),
+        "total_current": round(total_current, 2), # Parts without a current price count at their saved price
+        "savings": round(total_recommended - total_current, 2),
+    }
+
+
+def _conditional_json(etag: str, payload):
+    """
+    Answers with 304 when the client already has this version (If-None-Match), otherwise with
+    the JSON and its ETag. `payload` is a callable, so a 304 skips building the body.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(payload())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache" # Always revalidate; revalidating is cheap
+    return response
+
+
+def _query_builds(db: Session):
+    # Builds with their parts (and owner, for the token check) in one query; products and prices come from the catalog
+    return db.query(SavedBuild).options(joinedload(SavedBuild.parts), joinedload(SavedBuild.user))
+
+
+@builds_bp.route("/builds/<int:build_id>", methods=["GET"])
+def get_build(build_id: int):
+    """
+    A saved build with current prices, for its owner's token (see owner_token()).
+    Poll it with If-None-Match: unchanged prices return 304.
+    """
+    if not Config.BUILD_TOKEN_SECRET:
+        return _authorized("")
+    db = get_request_db(read_only=True)
+    build = _query_builds(db).filter(SavedBuild.id == build_id).first()
+    if build is None and db is not get_request_db():
+        # Just saved and not on the replica yet
+        db = get_request_db()
+        build = _query_builds(db).filter(SavedBuild.id == build_id).first()
+    if build is None or _authorized(build.user.email) is not None:
+        # Someone else's build looks like a missing one, so ids can't be probed
+        return jsonify({"error": "Build not found."}), 404
+    catalog = load_catalog(db)
+    return _conditional_json(_price_version([build], catalog), lambda: _build_to_dict(build, catalog))
+
+
+@builds_bp.route("/builds", methods=["GET"])
+def list_builds():
+    """
+    A user's saved builds with current prices, newest first, e.g. /builds?email=ada@example.com
+    with the token /save_build returned in an X-Build-Token header (or &token=, for signed links).
+    """
+    user_email = (request.args.get("email") or "").strip()
+    if not user_email:
+        return jsonify({"error": "Query parameter 'email' is required."}), 400
+    denied = _authorized(user_email)
+    if denied:
+        return denied
+    db = get_request_db(read_only=True)
+    builds = _query_builds(db).join(User).filter(User.email == user_email).order_by(SavedBuild.id.desc()).all()
+    catalog = load_catalog(db)
+    return _conditional_json(
+        _price_version(builds, catalog),
+        lambda: {"email": user_email, "builds": [_build_to_dict(build, catalog) for build in builds]},
+    )
+
+
+@builds_bp.route("/save_build", methods=["POST"])
+def save_build():
+    """
+    Saves a build in one transaction. An Idempotency-Key header (or "idempotency_key") makes
+    retries return the first save's build. With Config.BUILD_WRITE_BEHIND the build is queued
+    durably and acknowledged with 202; it's written to the database within seconds.
+    """
+    data = request.get_json(silent=True) or {}
+    user_email = data.get("email")
+    user_name = data.get("name")
+    build_data = data.get("build_data") # This comes from the /chat response's recommendation_output
+
+    if not user_email or not build_data:
+        return jsonify({"error": "Email and build data are required."}), 400
+    try:
+        build = build_request(user_email, user_name, build_data, request.headers.get("Idempotency-Key") or data.get("idempotency_key"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if Config.BUILD_WRITE_BEHIND:
+        try:
+            key = enqueue_build(build)
+        except ValueError as e: # Idempotency key queued for another user
+            return jsonify({"error": str(e)}), 409
+        except Exception as e:
+            logger.error("Error queueing build: %s", e, exc_info=True)
+            return jsonify({"error": "Failed to save build."}), 500
+        return jsonify({
+            "message": "Build saved successfully! You will receive price drop notifications.",
+            "idempotency_key": key,
+            "access_token": owner_token(user_email),
+            "status": "queued",
+        }), 202
+
+    db: Session = get_request_db()
+    try:
+        build_id, replayed = store_build(db, build)
+    except ValueError as e: # Idempotency key reused by another user
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        logger.error("Error saving build: %s", e, exc_info=True)
+        return jsonify({"error": "Failed to save build."}), 500
+    response = jsonify({
+        "message": "Build saved successfully! You will receive price drop notifications.",
+        "build_id": build_id,
+        "access_token": owner_token(user_email), # Reads the user's builds back (GET /builds)
+    })
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return response, 201
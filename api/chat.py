@@ -0,0 +1,161 @@
+import json
+import threading
+import uuid
+from flask import Blueprint, current_app, request, jsonify, Response, stream_with_context
+from sqlalchemy.orm import Session
+from config import Config
+from database import get_request_db
+from services.admission import AdmissionRejected, get_controller
+from services.demand import record_recommendation
+from services.metrics import span
+from services.nlu_service import NLUService
+from services.product_search import resolve_part_requests
+from services.recommendation_service import RecommendationService, build_to_dict
+from services.recommendation_tiers import get_tiered_build
+
+chat_bp = Blueprint("chat", __name__)
+
+# Global storage for conversation history (for simplicity in MVP, real app uses session/DB)
+# Key: session_id, Value: list of messages
+conversation_histories = {}
+# Last recommended build per session (build_to_dict shape), so follow-up tweaks re-solve incrementally
+last_builds = {}
+
+_nlu_lock = threading.Lock()
+
+
+def get_nlu_service() -> NLUService:
+    """The app's NLUService, created on the first chat request rather than at startup."""
+    nlu_service = current_app.extensions.get("nlu_service")
+    if nlu_service is None:
+        with _nlu_lock:
+            nlu_service = current_app.extensions.get("nlu_service")
+            if nlu_service is None:
+                nlu_service = current_app.extensions["nlu_service"] = NLUService()
+    return nlu_service
+
+
+NO_BUILD_MESSAGE = "\n\nI couldn't generate a complete build with those parameters. Could you provide more details or adjust your budget?"
+
+
+def chat_recommendation(db: Session, session_id: str, extracted_params: dict) -> dict | None:
+    """
+    The recommendation part of a chat turn, shared by the Flask route and the ASGI entry point
+    (asgi.py): the build for the extracted parameters formatted for the frontend, or None when
+    no build fits. Remembers the build for the session's follow-up turns.
+    """
+    if extracted_params.get("part_requests"):
+        # "I want a 4070" -> pin that GPU in the build
+        extracted_params["pinned_parts"] = resolve_part_requests(db, extracted_params["part_requests"])
+    previous_build = last_builds.get(session_id)
+    # Common budget/use case combinations are precomputed; fall back to a live solve.
+    # Follow-up turns tweak the previous build instead, so the user can follow the changes.
+    build_result = get_tiered_build(db, extracted_params) if previous_build is None else None
+    if build_result is None:
+        rec_service = RecommendationService(db)
+        build_result = rec_service.recommend_build(extracted_params, previous_build=previous_build)
+    if not build_result:
+        return None
+
+    record_recommendation(build_result) # Recommended parts get scraped more often
+    with span("chat", stage="format"):
+        # Format the recommendation for the user
+        build_summary = "Here's a recommended PC build based on your preferences:\n"
+        if build_result.get("dropped_pins"):
+            dropped = ", ".join(build_result["dropped_pins"])
+            build_summary = f"I couldn't fit the {dropped} you asked for into a compatible build within your budget, so I left it out.\n" + build_summary
+        for category, item in build_result["build"].items():
+            product = item["product"]
+            price_entry = item["price_entry"]
+            build_summary += (
+                f"- {category}: {product.name} "
+                f"(Lowest Price: ${price_entry.price:.2f} at {price_entry.retailer_name} - {price_entry.retailer_url})\n"
+            )
+        build_summary += f"\nTotal Estimated Cost: ${build_result['total_cost']:.2f}\n"
+        build_summary += "Would you like to save this build and receive price drop notifications?"
+        recommendation_output = {
+            "message": build_summary,
+            "build_data": build_to_dict(build_result)
+        }
+    last_builds[session_id] = recommendation_output["build_data"]
+    return recommendation_output
+
+
+def wants_recommendation(extracted_params: dict) -> bool:
+    # We have enough info to try a recommendation
+    return bool(extracted_params and extracted_params.get("budget") and extracted_params.get("use_case"))
+
+
+def busy_response(rejected: AdmissionRejected):
+    # Fast refusal instead of queueing behind a saturated upstream; clients retry after Retry-After
+    return jsonify({"error": "The assistant is busy right now. Please try again shortly."}), rejected.status, {"Retry-After": str(rejected.retry_after)}
+
+
+@chat_bp.route("/chat", methods=["POST"])
+def chat():
+    data = request.get_json()
+    user_message = data.get("message")
+    session_id = data.get("session_id")
+
+    if not session_id:
+        session_id = str(uuid.uuid4()) # Generate a new session ID
+        conversation_histories[session_id] = [] # Initialize history
+
+    current_history = conversation_histories.get(session_id, [])
+    nlu_service = get_nlu_service()
+
+    # Fair queuing is per conversation (client addresses would lump everyone behind a proxy together)
+    try:
+        with get_controller("openai").admit(session_id):
+            # Get conversational response from GPT
+            ai_response_text, updated_history = nlu_service.get_chat_response(user_message, current_history.copy()) # Pass a copy
+
+            # Try to extract parameters for recommendation
+            # This call includes the full context to give GPT enough info
+            extracted_params = nlu_service.extract_parameters(user_message, updated_history)
+
+        recommendation_output = None
+        if wants_recommendation(extracted_params):
+            with get_controller("recommendation").admit(session_id):
+                # Recommendations are read-only, so they can be served from the replica
+                recommendation_output = chat_recommendation(get_request_db(read_only=True), session_id, extracted_params)
+            if recommendation_output is None:
+                # If no build found, inform the user or ask for more details
+                ai_response_text += NO_BUILD_MESSAGE
+            # The AI's conversational response might already contain the recommendation,
+            # we're just adding structured data for the frontend.
+    except AdmissionRejected as rejected:
+        return busy_response(rejected) # History unchanged, so the retried message isn't recorded twice
+    conversation_histories[session_id] = updated_history # Update history
+
+    return jsonify({
+        "session_id": session_id,
+        "ai_message": ai_response_text,
+        "extracted_parameters": extracted_params,
+        "recommendation": recommendation_output
+    })
+
+@chat_bp.route("/recommendations/batch", methods=["POST"])
+def recommend_batch():
+    """
+    Precomputes builds for many preference sets (e.g. marketing/SEO pages).
+    Body: {"preferences": [{...}, ...]}. Streams one JSON line per item as it's ready.
+    """
+    data = request.get_json() or {}
+    prefs_list = data.get("preferences")
+    if not isinstance(prefs_list, list) or not prefs_list:
+        return jsonify({"error": "A non-empty 'preferences' list is required."}), 400
+    if len(prefs_list) > Config.BATCH_RECOMMENDATION_MAX_ITEMS:
+        return jsonify({"error": f"At most {Config.BATCH_RECOMMENDATION_MAX_ITEMS} preference sets per batch."}), 400
+
+    rec_service = RecommendationService(get_request_db(read_only=True))
+    rec_service.catalog # Load catalog and prices once, before streaming starts
+
+    def generate():
+        for i, build_result in rec_service.recommend_builds(prefs_list):
+            yield json.dumps({
+                "index": i,
+                "recommendation": build_to_dict(build_result) if build_result else None
+            }) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
@@ -0,0 +1,72 @@
+from flask import Blueprint, request, jsonify
+from database import get_request_db
+from services.catalog import load_catalog
+from services.price_history import daily_history
+from services.product_search import search_products
+
+products_bp = Blueprint("products", __name__)
+
+SEARCH_MAX_LIMIT = 50
+PRICE_HISTORY_MAX_DAYS = 730
+
+
+@products_bp.route("/search", methods=["GET"])
+def search():
+    """
+    Free-text part search over product name, brand and model, e.g. /search?q=4070&category=GPU.
+    Tolerates partial model numbers and typos; results are ranked best first.
+    """
+    query = (request.args.get("q") or "").strip()
+    if not query:
+        return jsonify({"error": "Query parameter 'q' is required."}), 400
+    category = request.args.get("category") or None
+    try:
+        limit = min(max(int(request.args.get("limit", 10)), 1), SEARCH_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error": "'limit' must be an integer."}), 400
+
+    db = get_request_db(read_only=True)
+    catalog = load_catalog(db)
+    results = []
+    for product, score in search_products(db, query, category=category, limit=limit):
+        price_entry = catalog.lowest_price(product.id)
+        results.append({
+            "product_id": product.id,
+            "name": product.name,
+            "brand": product.brand,
+            "model": product.model,
+            "category": product.category,
+            "score": round(score, 4),
+            "lowest_price": price_entry.price if price_entry else None,
+            "lowest_price_retailer": price_entry.retailer_name if price_entry else None,
+        })
+    return jsonify({"query": query, "results": results})
+
+
+@products_bp.route("/products/<int:product_id>/price_history", methods=["GET"])
+def price_history(product_id: int):
+    """
+    Daily low/high/close per retailer for a price chart, e.g. /products/12/price_history?days=90.
+    Served from the daily rollups (plus the days not compacted yet).
+    """
+    try:
+        days = min(max(int(request.args.get("days", 90)), 1), PRICE_HISTORY_MAX_DAYS)
+    except ValueError:
+        return jsonify({"error": "'days' must be an integer."}), 400
+
+    db = get_request_db(read_only=True)
+    catalog = load_catalog(db)
+    if product_id not in catalog.products:
+        return jsonify({"error": "Product not found."}), 404
+    price_entry = catalog.lowest_price(product_id)
+    history = {
+        retailer: [{"date": day.isoformat(), "low": low, "high": high, "close": close} for day, low, high, close in points]
+        for retailer, points in daily_history(db, product_id, days=days).items()
+    }
+    return jsonify({
+        "product_id": product_id,
+        "days": days,
+        "lowest_price": price_entry.price if price_entry else None,
+        "lowest_price_retailer": price_entry.retailer_name if price_entry else None,
+        "history": history,
+    })
@@ -1,143 +1,164 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
-from sqlalchemy.orm import Session
-from database import SessionLocal, create_db_and_tables, get_db
-from services.nlu_service import NLUService
-from services.recommendation_service import RecommendationService
-from models import User, SavedBuild, BuildPart, Product, PriceEntry
-import json
-import uuid
-
-app = Flask(__name__)
-CORS(app) # Enable CORS for frontend interaction
-
-# Initialize services
-nlu_service = NLUService()
-# RecommendationService will be initialized per request or via dependency injection
-# in a real app, but for simplicity here we'll pass db session directly.
-
-# Global storage for conversation history (for simplicity in MVP, real app uses session/DB)
-# Key: session_id, Value: list of messages
-conversation_histories = {}
-
-
-@app.route("/chat", methods=["POST"])
-def chat():
-    data = request.get_json()
-    user_message = data.get("message")
-    session_id = data.get("session_id")
-
-    if not session_id:
-        session_id = str(uuid.uuid4()) # Generate a new session ID
-        conversation_histories[session_id] = [] # Initialize history
-
-    current_history = conversation_histories.get(session_id, [])
-
-    # Get conversational response from GPT
-    ai_response_text, updated_history = nlu_service.get_chat_response(user_message, current_history.copy()) # Pass a copy
-    conversation_histories[session_id] = updated_history # Update history
-
-    # Try to extract parameters for recommendation
-    # This call includes the full context to give GPT enough info
-    extracted_params = nlu_service.extract_parameters(user_message, updated_history)
-
-    recommendation_output = None
-    if extracted_params and extracted_params.get("budget") and extracted_params.get("use_case"):
-        # We have enough info to try a recommendation
-        db: Session = SessionLocal()
-        rec_service = RecommendationService(db)
-        build_result = rec_service.recommend_build(extracted_params)
-        db.close()
-
-        if build_result:
-            # Format the recommendation for the user
-            build_summary = "Here's a recommended PC build based on your preferences:\n"
-            for category, item in build_result["build"].items():
-                product = item["product"]
-                price_entry = item["price_entry"]
-                build_summary += (
-                    f"- {category}: {product.name} "
-                    f"(Lowest Price: ${price_entry.price:.2f} at {price_entry.retailer_name} - {price_entry.retailer_url})\n"
-                )
-            build_summary += f"\nTotal Estimated Cost: ${build_result['total_cost']:.2f}\n"
-            build_summary += "Would you like to save this build and receive price drop notifications?"
-            recommendation_output = {
-                "message": build_summary,
-                "build_data": {
-                    "parts": [
-                        {
-                            "category": cat,
-                            "product_id": item["product"].id,
-                            "name": item["product"].name,
-                            "recommended_price": item["price_entry"].price,
-                            "lowest_price_retailer": item["price_entry"].retailer_name,
-                            "lowest_price_url": item["price_entry"].retailer_url,
-                        } for cat, item in build_result["build"].items()
-                    ],
-                    "total_cost": build_result["total_cost"],
-                    "user_preferences": extracted_params
-                }
-            }
-            # The AI's conversational response might already contain the recommendation,
-            # we're just adding structured data for the frontend.
-        else:
-            # If no build found, inform the user or ask for more details
-            ai_response_text += "\n\nI couldn't generate a complete build with those parameters. Could you provide more details or adjust your budget?"
-
-
-    return jsonify({
-        "session_id": session_id,
-        "ai_message": ai_response_text,
-        "extracted_parameters": extracted_params,
-        "recommendation": recommendation_output
-    })
-
-@app.route("/save_build", methods=["POST"])
-def save_build():
-    data = request.get_json()
-    user_email = data.get("email")
-    user_name = data.get("name")
-    build_data = data.get("build_data") # This comes from the /chat response's recommendation_output
-
-    if not user_email or not build_data:
-        return jsonify({"error": "Email and build data are required."}), 400
-
-    db: Session = SessionLocal()
-    try:
-        user = db.query(User).filter(User.email == user_email).first()
-        if not user:
-            user = User(name=user_name, email=user_email)
-            db.add(user)
-            db.commit()
-            db.refresh(user)
-
-        saved_build = SavedBuild(
-            user_id=user.id,
-            user_preferences=build_data["user_preferences"] # Store original prefs
+from database import create_db_and_tables, init_app, get_pool_stats
+from config import Config
+from logging_config import configure_logging
+from services import profiling
+from services.metrics import (
+    REGISTRY, REQUEST_SECONDS, DB_POOL, REQUEST_DB_QUERIES, start_request_stats, end_request_stats, server_timing_header,
+)
+import threading
+import time
+
+
+def create_app(config_overrides: dict = None) -> Flask:
+    """
+    Application factory. Cheap to call: the DB engine is created with the first session and
+    the OpenAI client with the first chat request (see api.chat.get_nlu_service).
+    """
+    configure_logging() # Queue-based handlers; must run before the first log call
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if config_overrides:
+        app.config.update(config_overrides)
+    CORS(app) # Enable CORS for frontend interaction
+    init_app(app) # Request-scoped DB sessions, closed on app context teardown
+
+    # Blueprints pull in the recommendation/NLU services, so they're imported with the app, not the module
+    from api.chat import chat_bp
+    from api.builds import builds_bp
+    from api.products import products_bp
+
+    app.register_blueprint(chat_bp)
+    app.register_blueprint(builds_bp)
+    app.register_blueprint(products_bp)
+    _register_instrumentation(app)
+    if Config.CAPTURE_PATH:
+        _register_capture(app) # After the instrumentation: its after_request runs first, while the stats are still there
+    _register_ops_routes(app)
+    return app
+
+
+def _register_instrumentation(app: Flask):
+    # --- Per-request instrumentation ---
+    @app.before_request
+    def start_request_timing():
+        g.request_stats = start_request_stats()
+        g.profile_run = profiling.maybe_start_profile()
+
+    @app.after_request
+    def record_request_timing(response):
+        stats = g.get("request_stats")
+        if stats is None:
+            return response
+        endpoint = request.endpoint or "unknown"
+        duration = time.perf_counter() - stats.started
+        REQUEST_SECONDS.observe(duration, endpoint=endpoint, status=response.status_code)
+        REQUEST_DB_QUERIES.observe(stats.db_queries, endpoint=endpoint)
+        if app.debug or Config.TIMING_HEADERS:
+            # Per-stage breakdown, visible in the browser devtools' timing tab
+            response.headers["Server-Timing"] = server_timing_header(stats)
+            response.headers["X-DB-Queries"] = str(stats.db_queries)
+            response.headers["X-DB-Rows-Loaded"] = str(stats.db_rows_loaded)
+        return response
+
+    @app.teardown_request
+    def finish_request_timing(exception=None):
+        # Also runs when a view raised and after_request was skipped: a profiler left running
+        # (an enabled cProfile blocks every later sample) or stale stats would outlive the request
+        stats = g.pop("request_stats", None)
+        run = g.pop("profile_run", None)
+        if stats is not None:
+            profiling.finish_profile(run, f"route.{request.endpoint or 'unknown'}", time.perf_counter() - stats.started)
+        end_request_stats()
+
+    @app.teardown_request
+    def write_demand(exception=None):
+        # Buffered recommendation counts for scrape prioritization, written at most every DEMAND_FLUSH_SECONDS
+        from services.demand import maybe_flush_demand
+
+        maybe_flush_demand()
+
+
+def _register_capture(app: Flask):
+    # Opt-in traffic capture for scripts/replay_traffic.py (Config.CAPTURE_PATH)
+    from services.traffic_capture import CAPTURED_ENDPOINTS, capture_request, finish_capture, start_capture
+
+    @app.before_request
+    def start_traffic_capture():
+        if request.endpoint in CAPTURED_ENDPOINTS:
+            start_capture()
+
+    @app.after_request
+    def write_traffic_capture(response):
+        stats = g.get("request_stats")
+        if request.endpoint not in CAPTURED_ENDPOINTS or stats is None:
+            return response
+        capture_request(
+            request.endpoint,
+            request.path,
+            request.headers,
+            request.get_json(silent=True),
+            response.status_code,
+            response.get_json(silent=True) if response.is_json else None,
+            finish_capture(),
+            time.perf_counter() - stats.started,
+            stats.db_queries,
         )
-        db.add(saved_build)
-        db.commit()
-        db.refresh(saved_build)
-
-        for part_data in build_data["parts"]:
-            build_part = BuildPart(
-                saved_build_id=saved_build.id,
-                product_id=part_data["product_id"],
-                recommended_price=part_data["recommended_price"],
-                lowest_price_retailer=part_data["lowest_price_retailer"],
-                lowest_price_url=part_data["lowest_price_url"]
-            )
-            db.add(build_part)
-        db.commit()
-
-        return jsonify({"message": "Build saved successfully! You will receive price drop notifications.", "build_id": saved_build.id}), 201
-    except Exception as e:
-        db.rollback()
-        print(f"Error saving build: {e}")
-        return jsonify({"error": "Failed to save build."}), 500
-    finally:
-        db.close()
+        return response
+
+
+def _register_ops_routes(app: Flask):
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        # Prometheus text exposition; per process, so scrape every worker (or aggregate upstream)
+        for engine_name, pool in get_pool_stats().items():
+            for field in ("checked_out", "overflow", "utilization", "checkouts", "checkout_timeouts", "avg_checkout_wait_ms", "max_checkout_wait_ms"):
+                DB_POOL.set(pool[field], engine=engine_name, field=field)
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.route("/debug/profiling", methods=["GET", "POST"])
+    def profiling_settings():
+        # Toggle the sampling profiler at runtime, e.g. {"sample_rate": 0.01, "mode": "pstats"}.
+        # Only affects this worker; use PROFILING_CONTROL_FILE to switch every process.
+        if not Config.ADMIN_TOKEN or request.headers.get("X-Admin-Token") != Config.ADMIN_TOKEN:
+            return jsonify({"error": "Forbidden."}), 403
+        if request.method == "POST":
+            try:
+                profiling.settings.update(**(request.get_json() or {}))
+            except (TypeError, ValueError) as e:
+                return jsonify({"error": f"Invalid profiler settings: {e}"}), 400
+        return jsonify(profiling.settings.as_dict())
+
+    @app.route("/pool_stats", methods=["GET"])
+    def pool_stats():
+        # Connection pool utilization and checkout wait times, for sizing pools per worker count
+        return jsonify(get_pool_stats())
+
+    @app.route("/single_flight_stats", methods=["GET"])
+    def single_flight_stats():
+        # Calls computed vs. coalesced onto an identical one in flight, per flight (this worker)
+        from services.single_flight import flight_stats
+
+        return jsonify(flight_stats())
+
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # `app:app` (gunicorn, flask run) keeps working: the module-level app is built on first access
+    global _app
+    if name == "app":
+        with _app_lock:
+            if _app is None:
+                _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
     create_db_and_tables() # Ensure DB tables are created on startup
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    create_app().run(debug=True, port=5000)
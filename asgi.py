@@ -0,0 +1,297 @@
+"""
+ASGI entry point, alongside the WSGI app in app.py:
+
+    uvicorn asgi:app --workers 2
+
+/chat is served natively async: both OpenAI calls go through the async client, so a waiting
+conversation holds no thread, and only the (short) database part of a turn runs on a bounded
+thread pool (Config.ASGI_THREADS). Every other route is passed through to the Flask app on the
+same pool. Request and response bodies are identical to the WSGI app, and with
+Config.CAPTURE_PATH set /chat is captured for scripts/replay_traffic.py like the Flask routes.
+"""
+
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from services.metrics import REQUEST_SECONDS, REQUEST_DB_QUERIES, start_request_stats, end_request_stats, server_timing_header
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+def _wsgi_environ(scope: dict, body: bytes) -> dict:
+    """PEP 3333 environ for an ASGI HTTP scope."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for raw_name, raw_value in scope.get("headers", []):
+        name, value = raw_name.decode("latin-1").upper().replace("-", "_"), raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class ASGIApp:
+    """The ASGI callable: native async /chat, everything else bridged to the Flask (WSGI) app."""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        # Bounds the threads SQLAlchemy and the bridged routes may use, however many requests are waiting
+        self.executor = ThreadPoolExecutor(max_workers=Config.ASGI_THREADS, thread_name_prefix="asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            if scope["path"] == "/chat" and scope["method"] == "POST":
+                await self._chat(scope, receive, send)
+            else:
+                await self._wsgi(scope, receive, send)
+        # Websockets aren't served
+
+    async def run_sync(self, func, *args):
+        """Runs blocking code (SQLAlchemy) on the bounded pool, keeping request stats/spans (contextvars)."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, contextvars.copy_context().run, func, *args)
+
+    @property
+    def nlu_service(self):
+        # Shared with the Flask routes (api.chat.get_nlu_service)
+        from api.chat import _nlu_lock
+        from services.nlu_service import NLUService
+
+        extensions = self.flask_app.extensions
+        if "nlu_service" not in extensions:
+            with _nlu_lock:
+                if "nlu_service" not in extensions:
+                    extensions["nlu_service"] = NLUService()
+        return extensions["nlu_service"]
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                nlu_service = self.flask_app.extensions.get("nlu_service")
+                if nlu_service is not None:
+                    await nlu_service.aclose()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _recommend(self, session_id: str, extracted_params: dict):
+        # Runs on the pool: same session choice as get_request_db(read_only=True)
+        from api.chat import chat_recommendation
+        from database import ReplicaSessionLocal, SessionLocal
+        from services.demand import maybe_flush_demand
+
+        db = (ReplicaSessionLocal or SessionLocal)()
+        try:
+            return chat_recommendation(db, session_id, extracted_params)
+        finally:
+            db.close()
+            maybe_flush_demand()
+
+    async def _chat(self, scope, receive, send):
+        from api.chat import NO_BUILD_MESSAGE, conversation_histories, wants_recommendation
+        from services.admission import AdmissionRejected, get_controller
+        from services.traffic_capture import start_capture
+
+        stats = start_request_stats()
+        if Config.CAPTURE_PATH:
+            start_capture()
+        body = await _read_body(receive)
+        try:
+            data = json.loads(body or b"null")
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            await self._send_json(scope, send, {"error": "A JSON body is required."}, 400, stats, data)
+            return
+        user_message = data.get("message")
+        session_id = data.get("session_id")
+
+        if not session_id:
+            session_id = str(uuid.uuid4()) # Generate a new session ID
+            conversation_histories[session_id] = [] # Initialize history
+
+        current_history = conversation_histories.get(session_id, [])
+        nlu_service = self.nlu_service
+        try: # Fair queuing per conversation, as in api.chat.chat
+            async with get_controller("openai").admit_async(session_id):
+                ai_response_text, updated_history = await nlu_service.get_chat_response_async(user_message, current_history.copy())
+                extracted_params = await nlu_service.extract_parameters_async(user_message, updated_history)
+
+            recommendation_output = None
+            if wants_recommendation(extracted_params):
+                # Admitted on the event loop, so queued requests don't occupy pool threads
+                async with get_controller("recommendation").admit_async(session_id):
+                    recommendation_output = await self.run_sync(self._recommend, session_id, extracted_params)
+                if recommendation_output is None:
+                    ai_response_text += NO_BUILD_MESSAGE
+        except AdmissionRejected as rejected:
+            await self._send_json(
+                scope, send, {"error": "The assistant is busy right now. Please try again shortly."}, rejected.status, stats, data,
+                headers=[(b"retry-after", str(rejected.retry_after).encode("latin-1"))],
+            )
+            return
+        conversation_histories[session_id] = updated_history
+
+        await self._send_json(scope, send, {
+            "session_id": session_id,
+            "ai_message": ai_response_text,
+            "extracted_parameters": extracted_params,
+            "recommendation": recommendation_output
+        }, 200, stats, data)
+
+    async def _send_json(self, scope, send, payload: dict, status: int, stats, request_body, headers: list = None):
+        # Serialized by the Flask app's JSON provider, so the bytes match jsonify()
+        response = self.flask_app.json.response(payload)
+        if Config.CAPTURE_PATH: # As app._register_capture does for the Flask routes
+            from werkzeug.datastructures import Headers
+            from services.traffic_capture import capture_request, finish_capture
+
+            request_headers = Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope.get("headers", [])])
+            capture_request(
+                "chat.chat", scope["path"], request_headers, request_body, status, payload,
+                finish_capture(), time.perf_counter() - stats.started, stats.db_queries,
+            )
+        headers = [(b"content-type", response.content_type.encode("latin-1")), *(headers or ())]
+        if any(name == b"origin" for name, _ in scope.get("headers", [])):
+            headers.append((b"access-control-allow-origin", b"*")) # As flask_cors' defaults in create_app
+        duration = time.perf_counter() - stats.started
+        REQUEST_SECONDS.observe(duration, endpoint="chat.chat", status=status)
+        REQUEST_DB_QUERIES.observe(stats.db_queries, endpoint="chat.chat")
+        if Config.TIMING_HEADERS:
+            headers.append((b"server-timing", server_timing_header(stats).encode("latin-1")))
+            headers.append((b"x-db-queries", str(stats.db_queries).encode("latin-1")))
+        end_request_stats()
+        body = response.get_data()
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _wsgi(self, scope, receive, send):
+        """Runs the Flask app on the pool, streaming its body back (e.g. /recommendations/batch)."""
+        environ = _wsgi_environ(scope, await _read_body(receive))
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=16) # Backpressure: a slow client pauses the producing thread
+        abandoned = threading.Event()
+
+        def put(message):
+            if not abandoned.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        def produce():
+            def start_response(status, headers, exc_info=None):
+                put(("start", int(status.split(" ", 1)[0]), headers))
+
+            try:
+                iterable = self.flask_app(environ, start_response)
+                try:
+                    for chunk in iterable:
+                        if abandoned.is_set():
+                            break
+                        if chunk:
+                            put(("body", chunk))
+                finally:
+                    if hasattr(iterable, "close"):
+                        iterable.close()
+            except Exception:
+                logger.error("Unhandled error in bridged WSGI request %s", environ["PATH_INFO"], exc_info=True)
+                put(("error", None))
+            finally:
+                put(_END)
+
+        producer = asyncio.ensure_future(self.run_sync(produce))
+        started = False
+        try:
+            while True:
+                message = await queue.get()
+                if message is _END:
+                    if started:
+                        await send({"type": "http.response.body", "body": b""})
+                    break
+                kind = message[0]
+                if kind == "start":
+                    _, status, headers = message
+                    await send({
+                        "type": "http.response.start",
+                        "status": status,
+                        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+                    })
+                    started = True
+                elif kind == "body":
+                    await send({"type": "http.response.body", "body": message[1], "more_body": True})
+                elif not started:
+                    await send({"type": "http.response.start", "status": 500, "headers": [(b"content-type", b"text/plain")]})
+                    await send({"type": "http.response.body", "body": b"Internal Server Error", "more_body": True})
+                    started = True
+        finally:
+            abandoned.set()
+            while not queue.empty(): # Unblock a producer waiting on a full queue
+                queue.get_nowait()
+            await producer
+
+
+def create_asgi_app(config_overrides: dict = None) -> ASGIApp:
+    from app import create_app
+
+    return ASGIApp(create_app(config_overrides))
+
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # `asgi:app` for uvicorn/hypercorn; built on first access, like app.app
+    global _app
+    if name == "app":
+        with _app_lock:
+            if _app is None:
+                _app = create_asgi_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
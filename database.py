@@ -1,12 +1,121 @@
+import threading
+import time
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool
 from config import Config
+from services.metrics import instrument_sqlalchemy
+
+
+class PoolStats:
+    """Thread-safe counters for connection checkouts from a pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long callers waited to check out a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError: # Not connect or auth errors: those aren't a full pool
+            timed_out = True
+            raise
+        finally:
+            self.stats.record_wait(time.perf_counter() - start, timed_out)
+
+
+def _engine_options(url: str) -> dict:
+    # SQLite (local development) manages its own pooling, the pool settings don't apply.
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": Config.DB_POOL_SIZE,
+        "max_overflow": Config.DB_MAX_OVERFLOW,
+        "pool_timeout": Config.DB_POOL_TIMEOUT,
+        "pool_recycle": Config.DB_POOL_RECYCLE,
+        "pool_pre_ping": Config.DB_POOL_PRE_PING,
+    }
+
+
+# Engines are created on first use rather than at import (creating one loads the DB driver),
+# so importing models or services for scripts/tests stays cheap.
+_engines = {}
+_engine_lock = threading.Lock()
+
+
+def _get_or_create_engine(name: str, url: str):
+    engine = _engines.get(name)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(name)
+            if engine is None:
+                engine = create_engine(url, **_engine_options(url))
+                instrument_sqlalchemy(engine) # Query/row counters and timings for /metrics
+                _engines[name] = engine
+    return engine
+
+
+def get_engine():
+    return _get_or_create_engine("primary", Config.DATABASE_URL)
+
+
+def get_replica_engine():
+    """Optional read replica for read-only paths (recommendations); None when not configured."""
+    if not Config.DATABASE_REPLICA_URL:
+        return None
+    return _get_or_create_engine("replica", Config.DATABASE_REPLICA_URL)
+
+
+def __getattr__(name):
+    # `database.engine` / `database.replica_engine` still work, they just create the engine on access
+    if name == "engine":
+        return get_engine()
+    if name == "replica_engine":
+        return get_replica_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class LazySessionmaker(sessionmaker):
+    """sessionmaker that binds to its engine when the first session is created."""
+
+    def __init__(self, engine_factory, **kwargs):
+        super().__init__(**kwargs)
+        self._engine_factory = engine_factory
+
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None:
+            self.configure(bind=self._engine_factory())
+        return super().__call__(**local_kw)
 
-# Create a database engine
-engine = create_engine(Config.DATABASE_URL)
 
 # Create a SessionLocal class
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = LazySessionmaker(get_engine, autocommit=False, autoflush=False)
+ReplicaSessionLocal = (
+    LazySessionmaker(get_replica_engine, autocommit=False, autoflush=False) if Config.DATABASE_REPLICA_URL else None
+)
 
 # Base class for declarative models
 Base = declarative_base()
@@ -19,11 +128,66 @@ def get_db():
     finally:
         db.close()
 
+# --- Request-scoped sessions for Flask ---
+def init_app(app):
+    """Closes the request's sessions when the Flask app context tears down."""
+    app.teardown_appcontext(close_request_sessions)
+
+def get_request_db(read_only: bool = False):
+    """
+    Returns the session bound to the current Flask request, creating it on first use.
+    Read-only callers get a replica session when DATABASE_REPLICA_URL is configured.
+    """
+    from flask import g
+
+    if read_only and ReplicaSessionLocal is not None:
+        if "db_read" not in g:
+            g.db_read = ReplicaSessionLocal()
+        return g.db_read
+    if "db" not in g:
+        g.db = SessionLocal()
+    return g.db
+
+def close_request_sessions(exception=None):
+    from flask import g
+
+    for key in ("db", "db_read"):
+        db = g.pop(key, None)
+        if db is None:
+            continue
+        if exception is not None:
+            db.rollback()
+        db.close()
+
+def get_pool_stats() -> dict:
+    """Pool utilization and checkout wait times per engine, for sizing pools against worker count."""
+    stats = {}
+    for name, eng in list(_engines.items()): # Engines not used yet have nothing to report
+        if not isinstance(eng.pool, InstrumentedQueuePool):
+            continue
+        pool = eng.pool
+        capacity = pool.size() + Config.DB_MAX_OVERFLOW
+        checkouts = pool.stats.checkouts
+        stats[name] = {
+            "pool_size": pool.size(),
+            "max_overflow": Config.DB_MAX_OVERFLOW,
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "utilization": pool.checkedout() / capacity if capacity else 0.0,
+            "checkouts": checkouts,
+            "checkout_timeouts": pool.stats.timeouts,
+            "avg_checkout_wait_ms": (pool.stats.total_wait_seconds / checkouts * 1000) if checkouts else 0.0,
+            "max_checkout_wait_ms": pool.stats.max_wait_seconds * 1000,
+        }
+    return stats
+
 # For initial setup:
 def create_db_and_tables():
-    Base.metadata.create_all(engine)
+    import models # noqa: F401  (registers the tables on Base.metadata)
+
+    Base.metadata.create_all(get_engine())
 
 if __name__ == "__main__":
     print("Creating database tables...")
     create_db_and_tables()
-    print("Tables created.")
\ No newline at end of file
+    print("Tables created.")
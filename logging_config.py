@@ -0,0 +1,132 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from config import Config
+
+# LogRecord attributes that aren't user-supplied `extra` fields
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; `extra={...}` fields are included as top-level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token-bucket rate limit per (logger, message template) for chatty per-item messages.
+    `limits` maps logger name prefixes to messages/second; loggers without a limit pass through.
+    Errors are never dropped; warnings are limited like the rest, so a per-item warning
+    repeated for every product can't flood the logs. The next message that gets through
+    carries a `suppressed` count of what was dropped before it.
+    """
+
+    def __init__(self, limits: dict):
+        super().__init__()
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._buckets = {} # (logger, template) -> [tokens, last refill, suppressed]
+
+    def _limit_for(self, name: str) -> float | None:
+        for prefix, rate in self.limits.items():
+            if name == prefix or name.startswith(prefix + "."):
+                return rate
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        rate = self._limit_for(record.name)
+        if rate is None:
+            return True
+        now = time.monotonic()
+        key = (record.name, record.msg if isinstance(record.msg, str) else type(record.msg).__name__)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [rate, now, 0]
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate) # Burst of up to one second's worth
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves `msg % args` formatting to the listener thread
+    (the stock one formats on the calling thread). Only tracebacks are rendered
+    eagerly, so the queued record doesn't keep frames alive.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _parse_rate_limits(spec: str) -> dict:
+    # "services.scraper_service=5,services.recommendation_service=20"
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = item.partition("=")
+        limits[name.strip()] = float(rate)
+    return limits
+
+
+_listener = None
+
+
+def configure_logging():
+    """
+    Sets up the process-wide logging pipeline once: records go onto an in-memory queue
+    and a background QueueListener does the formatting and I/O, off the request thread.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler()
+    if Config.LOG_JSON:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(_parse_rate_limits(Config.LOG_RATE_LIMITS)))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(Config.LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop) # Flush what's still queued on shutdown
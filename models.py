@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, JSON, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Float, JSON, Date, DateTime, ForeignKey, Boolean, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -29,10 +29,14 @@ class PriceEntry(Base):
     retailer_name = Column(String(100), nullable=False) # Add length
     retailer_url = Column(String(500), nullable=False) # Add length
     price = Column(Float, nullable=False)
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    timestamp = Column(DateTime(timezone=True), server_default=func.now()) # First seen at this price
+    # Last scrape that saw the same price; unchanged prices extend this instead of adding a row (NULL: only seen once)
+    last_seen_at = Column(DateTime(timezone=True))
 
     product = relationship("Product", back_populates="prices")
 
+    __table_args__ = (Index("ix_price_entries_product_retailer", "product_id", "retailer_name"),)
+
     def __repr__(self):
         return f"<PriceEntry(product_id={self.product_id}, retailer='{self.retailer_name}', price={self.price})>"
 
@@ -52,9 +56,10 @@ class SavedBuild(Base):
     user_preferences = Column(JSON, nullable=False) # JSON doesn't need length
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     notified_at = Column(DateTime(timezone=True))
+    idempotency_key = Column(String(64), unique=True) # Client's Idempotency-Key (or the write-behind queue's); retries return this build
 
     user = relationship("User", back_populates="saved_builds")
-    parts = relationship("BuildPart", back_populates="saved_build")
+    parts = relationship("BuildPart", back_populates="saved_build", order_by="BuildPart.id")
 
 class BuildPart(Base):
     __tablename__ = "build_parts"
@@ -67,4 +72,53 @@ class BuildPart(Base):
     lowest_price_url = Column(String(500)) # Add length
 
     saved_build = relationship("SavedBuild", back_populates="parts")
-    product = relationship("Product", back_populates="build_parts")
\ No newline at end of file
+    product = relationship("Product", back_populates="build_parts")
+
+class RecommendationTier(Base):
+    __tablename__ = "recommendation_tiers"
+    id = Column(Integer, primary_key=True, index=True)
+    budget = Column(Integer, nullable=False)
+    use_case = Column(String(50), nullable=False) # Add length
+    monitor = Column(Boolean, nullable=False, default=False)
+    parts = Column(JSON(none_as_null=True)) # [[category, product_id, price, stage budget], ...]; NULL when no build fits this cell
+    total_cost = Column(Float)
+    price_version = Column(Integer) # Newest PriceEntry id the cell was built against
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (UniqueConstraint("budget", "use_case", "monitor", name="uq_recommendation_tier_cell"),)
+
+class RetailerProductUrl(Base):
+    __tablename__ = "retailer_product_urls"
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    retailer_name = Column(String(100), nullable=False) # Add length
+    retailer_sku = Column(String(50)) # ASIN / Newegg item number
+    product_url = Column(String(500)) # Direct product page; NULL when search found no match
+    resolved_at = Column(DateTime(timezone=True))
+    verified_at = Column(DateTime(timezone=True)) # Last scrape that found a price on product_url
+    failure_count = Column(Integer, nullable=False, default=0) # Consecutive failed scrapes
+
+    product = relationship("Product")
+
+    __table_args__ = (UniqueConstraint("product_id", "retailer_name", name="uq_retailer_product_url"),)
+
+class ProductDemand(Base):
+    __tablename__ = "product_demand"
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    recommendations = Column(Float, nullable=False, default=0.0) # Times recommended, exponentially decayed (see services/demand.py)
+    updated_at = Column(DateTime(timezone=True)) # When `recommendations` was last decayed/incremented
+
+class PriceRollup(Base):
+    __tablename__ = "price_daily_rollups"
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    retailer_name = Column(String(100), nullable=False) # Add length
+    day = Column(Date, nullable=False)
+    low = Column(Float, nullable=False)
+    high = Column(Float, nullable=False)
+    close = Column(Float, nullable=False) # Last price seen that day
+
+    __table_args__ = (
+        UniqueConstraint("product_id", "retailer_name", "day", name="uq_price_daily_rollup"),
+        Index("ix_price_daily_rollups_day", "day"),
+    )
@@ -0,0 +1,89 @@
+# scripts/check_import_time.py
+
+"""
+Startup-time budget for the entry points. Imports each module in a fresh interpreter with
+`python -X importtime`, reports the cumulative import time (best of N runs) and fails when a
+module exceeds its budget or pulls in a dependency it shouldn't need at import.
+
+    python scripts/check_import_time.py [--runs 5] [--scale 1.5]
+
+Use --scale on slow CI machines instead of editing the budgets.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# module -> (budget in ms, modules that must not be imported)
+BUDGETS = {
+    "config": (100, ("sqlalchemy", "flask", "openai")),
+    "models": (500, ("flask", "openai", "httpx")),
+    "services.recommendation_service": (600, ("flask", "openai", "httpx")),
+    "services.scraper_service": (700, ("flask", "openai", "httpx")),
+    "tasks.scheduled_tasks": (900, ("flask", "openai", "httpx")),
+    # Importing app must not construct the app or any API client
+    "app": (900, ("openai", "httpx", "api.chat")),
+    "asgi": (300, ("flask", "openai", "httpx", "api.chat")),
+}
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def measure(module: str) -> tuple:
+    """Returns (cumulative microseconds for `module`, set of every module imported)."""
+    env = dict(os.environ, PYTHONPATH=PROJECT_ROOT)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=PROJECT_ROOT, env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    total, imported = None, set()
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        imported.add(match.group(4))
+        if match.group(4) == module and len(match.group(3)) == 1: # Top level, not a nested import
+            total = int(match.group(2))
+    return total or 0, imported
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Runs per module; the fastest one counts.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier applied to every budget.")
+    parser.add_argument("modules", nargs="*", help="Modules to check (default: all budgeted modules).")
+    args = parser.parse_args()
+
+    failures = []
+    for module in args.modules or BUDGETS:
+        budget_ms, forbidden = BUDGETS.get(module, (float("inf"), ()))
+        budget_ms *= args.scale
+        best_us, imported = None, set()
+        for _ in range(max(args.runs, 1)):
+            elapsed_us, imported = measure(module)
+            best_us = elapsed_us if best_us is None else min(best_us, elapsed_us)
+        elapsed_ms = best_us / 1000
+        unexpected = sorted(name for name in forbidden if name in imported)
+        status = "ok"
+        if elapsed_ms > budget_ms:
+            status = "OVER BUDGET"
+            failures.append(module)
+        if unexpected:
+            status = f"imports {', '.join(unexpected)}"
+            failures.append(module)
+        print(f"{module:<35} {elapsed_ms:8.1f} ms  (budget {budget_ms:.0f} ms)  {status}")
+
+    if failures:
+        print(f"\nImport-time check failed for: {', '.join(sorted(set(failures)))}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
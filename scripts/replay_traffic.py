@@ -0,0 +1,196 @@
+# scripts/replay_traffic.py
+
+"""
+Replays captured traffic (services/traffic_capture.py, Config.CAPTURE_PATH) against the app
+in-process, with OpenAI stubbed by the recorded NLU results, and compares latency and DB
+query counts per endpoint with a stored baseline. No network; run it against a scratch copy
+of the database, since /save_build requests are replayed too.
+
+    python scripts/replay_traffic.py capture.jsonl --write-baseline baseline.json
+    python scripts/replay_traffic.py capture.jsonl --baseline baseline.json [--tolerance 0.25]
+
+Requests run one at a time in capture order, with the recommendation RNG seeded per request,
+so two replays of one capture do the same work. Exits 1 when an endpoint's p50 or p90
+latency is more than `tolerance` (and --min-delta-ms) above the baseline, or it issues more DB
+queries on average.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from config import Config
+
+
+class _RecordedCompletions:
+    """Stands in for client.chat.completions: returns the current request's recorded NLU results in order."""
+
+    def __init__(self):
+        self.pending = deque()
+        self.missing = 0
+
+    def create(self, messages=None, **settings):
+        call = "extract" if settings.get("temperature") == 0 else "chat"
+        if not self.pending or self.pending[0]["call"] != call:
+            self.missing += 1
+            raise RuntimeError(f"The capture has no recorded {call} result here.")
+        recorded = self.pending.popleft()
+        if recorded.get("error"):
+            raise RuntimeError(f"Recorded {recorded['error']}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=recorded["content"]))])
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(samples: dict) -> dict:
+    """{endpoint: [(seconds, db queries), ...]} -> per-endpoint latency percentiles (ms) and query counts."""
+    summary = {}
+    for endpoint, rows in sorted(samples.items()):
+        latencies = [seconds * 1000 for seconds, _ in rows]
+        queries = [count for _, count in rows]
+        summary[endpoint] = {
+            "count": len(rows),
+            "p50_ms": round(percentile(latencies, 0.50), 2),
+            "p90_ms": round(percentile(latencies, 0.90), 2),
+            "p99_ms": round(percentile(latencies, 0.99), 2),
+            "mean_ms": round(sum(latencies) / len(latencies), 2),
+            "db_queries_mean": round(sum(queries) / len(queries), 2),
+            "db_queries_max": max(queries),
+        }
+    return summary
+
+
+def compare(summary: dict, baseline: dict, tolerance: float, min_delta_ms: float = 5.0) -> list:
+    """Regressions of `summary` against `baseline`, as messages."""
+    regressions = []
+    for endpoint, current in summary.items():
+        base = baseline.get(endpoint)
+        if base is None:
+            continue
+        for field in ("p50_ms", "p90_ms"):
+            # Relative and absolute: a 1 ms route jittering to 1.5 ms isn't a regression
+            if current[field] > base[field] * (1 + tolerance) and current[field] - base[field] > min_delta_ms:
+                regressions.append(f"{endpoint}: {field} {current[field]} ms vs baseline {base[field]} ms")
+        if current["db_queries_mean"] > base["db_queries_mean"]:
+            regressions.append(f"{endpoint}: {current['db_queries_mean']} DB queries per request vs baseline {base['db_queries_mean']}")
+    return regressions
+
+
+def load_capture(path: str, limit: int = None) -> list:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+                if limit and len(records) >= limit:
+                    break
+    return records
+
+
+def replay(records: list) -> tuple:
+    """Drives the app through `records`. Returns ({endpoint: [(seconds, db queries), ...]}, problems)."""
+    # Every NLU call must reach the stub, and the replay must not capture itself
+    Config.NLU_CACHE_ENABLED = False
+    Config.CAPTURE_PATH = None
+    Config.TIMING_HEADERS = True
+
+    from app import create_app
+    from services.nlu_service import NLUService
+
+    app = create_app()
+    completions = _RecordedCompletions()
+    nlu_service = NLUService()
+    nlu_service._client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    app.extensions["nlu_service"] = nlu_service
+    client = app.test_client()
+
+    run_id = uuid.uuid4().hex[:8] # Fresh idempotency keys, so a second replay saves builds again
+    sessions = {} # Captured session id -> the one this replay was given
+    samples, problems = defaultdict(list), defaultdict(int)
+    for index, record in enumerate(records):
+        body = dict(record["body"])
+        if body.get("session_id"):
+            body["session_id"] = sessions.get(body["session_id"], body["session_id"])
+        headers = dict(record.get("headers") or {})
+        if "Idempotency-Key" in headers:
+            # Per user too: workers without a shared CAPTURE_SALT give one user different pseudonyms
+            scope = f"{run_id}:{body.get('email')}:{headers['Idempotency-Key']}"
+            headers["Idempotency-Key"] = hashlib.sha256(scope.encode("utf-8")).hexdigest()[:64]
+        completions.pending = deque(record.get("nlu") or [])
+        random.seed(index)
+
+        started = time.perf_counter()
+        response = client.post(record["path"], json=body, headers=headers)
+        elapsed = time.perf_counter() - started
+
+        payload = response.get_json(silent=True) or {}
+        if record.get("session_id") and payload.get("session_id"):
+            sessions[record["session_id"]] = payload["session_id"]
+        if response.status_code != record["status"]:
+            problems["status_mismatch"] += 1
+        if completions.pending:
+            problems["unused_nlu_results"] += 1
+        samples[record["endpoint"]].append((elapsed, int(response.headers.get("X-DB-Queries", 0))))
+    problems["missing_nlu_results"] = completions.missing
+    return samples, dict(problems)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="JSONL written with CAPTURE_PATH set")
+    parser.add_argument("--baseline", help="Summary JSON to compare against")
+    parser.add_argument("--write-baseline", metavar="PATH", help="Store this replay's summary as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed latency increase over the baseline (0.25 = 25%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="Latency increases smaller than this never count")
+    parser.add_argument("--limit", type=int, help="Replay only the first N requests")
+    args = parser.parse_args()
+
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        sys.exit(f"No requests in {args.capture}.")
+    samples, problems = replay(records)
+    summary = summarize(samples)
+    captured = summarize({
+        endpoint: [(record["seconds"], record["db_queries"]) for record in records if record["endpoint"] == endpoint]
+        for endpoint in samples
+    })
+
+    print(f"Replayed {len(records)} requests from {args.capture}")
+    for endpoint, current in summary.items():
+        print(f"  {endpoint}: {json.dumps(current)}")
+        print(f"  {' ' * len(endpoint)}  captured in production: {json.dumps(captured[endpoint])}")
+    if any(problems.values()):
+        # Divergence means the replay didn't do what production did; its numbers are suspect
+        print(f"  Divergence: {json.dumps(problems)}")
+
+    if args.write_baseline:
+        with open(args.write_baseline, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.write_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(summary, baseline, args.tolerance, args.min_delta_ms)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
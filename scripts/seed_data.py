@@ -11,7 +11,7 @@ from sqlalchemy import func
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from database import SessionLocal, create_db_and_tables
-from models import Product, PriceEntry, User, SavedBuild, BuildPart # Import all models
+from models import Product, PriceEntry, PriceRollup, ProductDemand, RetailerProductUrl, User, SavedBuild, BuildPart # Import all models
 
 def seed_data():
     db: Session = SessionLocal()
@@ -23,7 +23,10 @@ def seed_data():
         db.query(BuildPart).delete()
         db.query(SavedBuild).delete()
         db.query(User).delete()
+        db.query(PriceRollup).delete()
         db.query(PriceEntry).delete()
+        db.query(RetailerProductUrl).delete()
+        db.query(ProductDemand).delete()
         db.query(Product).delete()
         db.commit()
         print("Cleared existing data from tables.")
@@ -0,0 +1,206 @@
+# services/admission.py
+
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from config import Config
+from services.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_ACTIVE = REGISTRY.gauge("pc_agent_admission_active", "Requests holding an upstream slot.", ("upstream",))
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge("pc_agent_admission_queue_depth", "Requests waiting for an upstream slot.", ("upstream",))
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "pc_agent_admission_wait_seconds", "Time spent waiting for an upstream slot.", ("upstream", "outcome")
+)
+ADMISSION_REJECTIONS = REGISTRY.counter(
+    "pc_agent_admission_rejections_total", "Requests turned away by admission control.", ("upstream", "reason")
+)
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised instead of queueing: `status` 429 when the caller's own session already has too
+    many requests waiting, 503 when the queue is full or the wait deadline passed.
+    """
+
+    def __init__(self, upstream: str, status: int, reason: str, retry_after: int):
+        super().__init__(f"{upstream} is busy ({reason}); retry in {retry_after}s.")
+        self.upstream = upstream
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("session", "granted", "_event", "_loop", "_future")
+
+    def __init__(self, session, loop=None):
+        self.session = session
+        self.granted = False
+        self._loop = loop
+        self._event = threading.Event() if loop is None else None
+        self._future = loop.create_future() if loop is not None else None
+
+    def wake(self):
+        # Called under the controller lock, possibly from another thread than the waiter's
+        if self._loop is None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(lambda: self._future.done() or self._future.set_result(None))
+
+
+class AdmissionController:
+    """
+    Caps concurrent calls to one upstream (OpenAI, the recommendation solver) per process.
+    Callers beyond the limit wait in a bounded queue, up to a deadline. Freed slots go to the
+    waiting sessions in round-robin order, so a client firing many requests waits behind its
+    own requests, not in front of everyone else's. Works from threads (admit) and from
+    asyncio tasks (admit_async) alike.
+    """
+
+    def __init__(self, upstream: str, limit: int, max_queue: int, max_queue_per_session: int, timeout: float):
+        self.upstream = upstream
+        self.limit = max(limit, 1)
+        self.max_queue = max_queue
+        self.max_queue_per_session = max_queue_per_session
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._queues = OrderedDict() # session -> deque of waiters; order = whose turn is next
+        self._avg_hold = 1.0 # Seconds a slot is held, smoothed; for Retry-After
+
+    def _retry_after(self) -> int:
+        # Roughly when the current queue will have drained
+        return min(max(math.ceil(self._avg_hold * (self._queued + 1) / self.limit), 1), 60)
+
+    def _reject(self, status: int, reason: str) -> AdmissionRejected:
+        ADMISSION_REJECTIONS.inc(upstream=self.upstream, reason=reason)
+        return AdmissionRejected(self.upstream, status, reason, self._retry_after())
+
+    def _enter(self, session, loop=None) -> _Waiter | None:
+        """Takes a slot (returns None) or queues a waiter; raises AdmissionRejected when it can't queue."""
+        with self._lock:
+            if self._active < self.limit and not self._queued:
+                self._active += 1
+                ADMISSION_ACTIVE.set(self._active, upstream=self.upstream)
+                return None
+            if self._queued >= self.max_queue:
+                raise self._reject(503, "queue_full")
+            queue = self._queues.get(session)
+            if queue is not None and len(queue) >= self.max_queue_per_session:
+                raise self._reject(429, "session_limit")
+            if queue is None:
+                queue = self._queues[session] = deque()
+            waiter = _Waiter(session, loop)
+            queue.append(waiter)
+            self._queued += 1
+            ADMISSION_QUEUE_DEPTH.set(self._queued, upstream=self.upstream)
+            return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """Takes a timed-out waiter off the queue. False if it was granted a slot meanwhile (it must release it)."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            queue = self._queues.get(waiter.session)
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[waiter.session]
+            self._queued -= 1
+            ADMISSION_QUEUE_DEPTH.set(self._queued, upstream=self.upstream)
+            return True
+
+    def _release(self, held_seconds: float):
+        with self._lock:
+            self._avg_hold += 0.1 * (held_seconds - self._avg_hold)
+            if self._queues:
+                # Hand the slot straight to the next session's oldest waiter
+                session, queue = next(iter(self._queues.items()))
+                waiter = queue.popleft()
+                if queue:
+                    self._queues.move_to_end(session) # Its next request waits for everyone else's turn
+                else:
+                    del self._queues[session]
+                self._queued -= 1
+                ADMISSION_QUEUE_DEPTH.set(self._queued, upstream=self.upstream)
+                waiter.granted = True
+                waiter.wake()
+                return
+            self._active -= 1
+            ADMISSION_ACTIVE.set(self._active, upstream=self.upstream)
+
+    def _timed_out(self, waiter: _Waiter, started: float) -> bool:
+        if self._abandon(waiter):
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, upstream=self.upstream, outcome="timeout")
+            return True
+        return False
+
+    @contextmanager
+    def admit(self, session=None):
+        """Holds one slot for the block; waits (blocking the thread) up to `timeout` for it."""
+        started = time.perf_counter()
+        waiter = self._enter(session)
+        if waiter is not None:
+            if not waiter._event.wait(self.timeout) and self._timed_out(waiter, started):
+                raise self._reject(503, "deadline")
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, upstream=self.upstream, outcome="admitted")
+        admitted = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(time.perf_counter() - admitted)
+
+    @asynccontextmanager
+    async def admit_async(self, session=None):
+        """admit() for asyncio tasks: waiting doesn't block the event loop."""
+        started = time.perf_counter()
+        waiter = self._enter(session, asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter._future), self.timeout)
+            except asyncio.TimeoutError:
+                if self._timed_out(waiter, started):
+                    raise self._reject(503, "deadline")
+            except asyncio.CancelledError:
+                # Client went away while queued: give up the place (or the slot, if it just arrived)
+                if not self._abandon(waiter):
+                    self._release(0.0)
+                raise
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, upstream=self.upstream, outcome="admitted")
+        admitted = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(time.perf_counter() - admitted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"active": self._active, "limit": self.limit, "queued": self._queued, "sessions_waiting": len(self._queues)}
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(upstream: str) -> AdmissionController:
+    """The process-wide controller for "openai" or "recommendation", sized from Config."""
+    controller = _controllers.get(upstream)
+    if controller is None:
+        with _controllers_lock:
+            controller = _controllers.get(upstream)
+            if controller is None:
+                limits = {"openai": Config.ADMISSION_OPENAI_CONCURRENCY, "recommendation": Config.ADMISSION_RECOMMENDATION_CONCURRENCY}
+                controller = _controllers[upstream] = AdmissionController(
+                    upstream,
+                    limits[upstream],
+                    max_queue=Config.ADMISSION_MAX_QUEUE,
+                    max_queue_per_session=Config.ADMISSION_MAX_QUEUE_PER_SESSION,
+                    timeout=Config.ADMISSION_QUEUE_TIMEOUT_SECONDS,
+                )
+    return controller
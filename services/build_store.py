@@ -0,0 +1,340 @@
+# services/build_store.py
+
+"""
+Saving builds. persist_builds() writes any number of builds in one transaction: users are
+upserted on their email, builds inserted, and all their parts bulk inserted, with a single
+commit. An idempotency key per build makes retries return the build saved the first time.
+
+With Config.BUILD_WRITE_BEHIND, /save_build only appends the build to a durable local queue
+(a SQLite file, committed before the request is acknowledged) and a background thread writes
+queued builds to the database in batches. Queued builds always carry an idempotency key, so a
+batch replayed after a crash doesn't save anything twice.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from config import Config
+from models import BuildPart, SavedBuild, User
+from services.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+BUILD_QUEUE_DEPTH = REGISTRY.gauge("pc_agent_build_queue_depth", "Builds acknowledged but not yet written to the database.", ())
+BUILD_QUEUE_FLUSHED = REGISTRY.counter("pc_agent_build_queue_flushed_total", "Queued builds written to the database.", ("outcome",))
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 64
+
+
+def build_request(email: str, name: str | None, build_data: dict, idempotency_key: str = None) -> dict:
+    """
+    Validates a /save_build payload into the form persist_builds() and the queue take.
+    Raises ValueError with a client-facing message.
+    """
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValueError(f"Idempotency keys are 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters.")
+    try:
+        parts = [
+            {
+                "product_id": int(part["product_id"]),
+                "recommended_price": float(part["recommended_price"]),
+                "lowest_price_retailer": part.get("lowest_price_retailer"),
+                "lowest_price_url": part.get("lowest_price_url"),
+            }
+            for part in build_data["parts"]
+        ]
+        preferences = build_data["user_preferences"]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("build_data needs 'parts' (product_id, recommended_price) and 'user_preferences'.")
+    return {"email": email, "name": name, "user_preferences": preferences, "parts": parts, "idempotency_key": idempotency_key}
+
+
+def _insert_ignoring_conflicts(db: Session, model, index_elements: list):
+    """INSERT that skips rows violating a unique constraint, in the current dialect."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return insert(model).prefix_with("IGNORE") # MySQL / MariaDB
+    return dialect_insert(model).on_conflict_do_nothing(index_elements=index_elements)
+
+
+def _upsert_users(db: Session, builds: list) -> dict:
+    """{email: user id}, creating missing users; concurrent first saves of one email can't collide."""
+    names = {}
+    for build in builds:
+        names.setdefault(build["email"], build["name"])
+    users = dict(db.execute(select(User.email, User.id).where(User.email.in_(names))).all())
+    missing = [{"email": email, "name": name} for email, name in names.items() if email not in users]
+    if missing:
+        db.execute(_insert_ignoring_conflicts(db, User, ["email"]), missing)
+        users.update(db.execute(select(User.email, User.id).where(User.email.in_([row["email"] for row in missing]))).all())
+    return users
+
+
+def persist_builds(db: Session, builds: list) -> dict:
+    """
+    Saves build_request() dicts in one transaction and commits (rolls back on error). Returns
+    {index in `builds`: (build id, replayed)}; replayed means the idempotency key was saved
+    before (by the same user) and nothing new was written for it.
+    """
+    try:
+        keys = [build["idempotency_key"] for build in builds if build["idempotency_key"]]
+        existing = {}
+        if keys:
+            existing = {
+                key: (build_id, email)
+                for key, build_id, email in db.execute(
+                    select(SavedBuild.idempotency_key, SavedBuild.id, User.email).join(User).where(SavedBuild.idempotency_key.in_(keys))
+                )
+            }
+        results, new_builds, duplicates, first_with_key = {}, [], [], {}
+        for index, build in enumerate(builds):
+            key = build["idempotency_key"]
+            if key in existing or key in first_with_key:
+                owner = existing[key][1] if key in existing else builds[first_with_key[key]]["email"]
+                if owner != build["email"]:
+                    raise ValueError("This idempotency key was already used by another user.")
+                if key in existing:
+                    results[index] = (existing[key][0], True)
+                else:
+                    duplicates.append((index, first_with_key[key]))
+                continue
+            new_builds.append(index)
+            if key:
+                first_with_key[key] = index
+
+        build_ids = []
+        if new_builds:
+            users = _upsert_users(db, [builds[index] for index in new_builds])
+            saved_builds = [
+                SavedBuild(
+                    user_id=users[builds[index]["email"]],
+                    user_preferences=builds[index]["user_preferences"],
+                    idempotency_key=builds[index]["idempotency_key"],
+                )
+                for index in new_builds
+            ]
+            db.add_all(saved_builds)
+            db.flush() # Assigns the build ids (batched INSERT ... RETURNING where the driver supports it)
+            build_ids = [saved_build.id for saved_build in saved_builds] # Read before commit expires them
+            part_rows = [
+                {**part, "saved_build_id": build_id}
+                for index, build_id in zip(new_builds, build_ids)
+                for part in builds[index]["parts"]
+            ]
+            if part_rows:
+                db.execute(insert(BuildPart), part_rows) # One executemany for every part of every build
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    for index, build_id in zip(new_builds, build_ids):
+        results[index] = (build_id, False)
+    for index, first in duplicates: # Same key twice in one batch: both get the first one's build
+        results[index] = (results[first][0], True)
+    return results
+
+
+def save_build(db: Session, build: dict) -> tuple:
+    """Saves one build_request() dict. Returns (build id, replayed)."""
+    try:
+        return persist_builds(db, [build])[0]
+    except IntegrityError:
+        # A concurrent retry with the same idempotency key won the insert; answer with its build
+        if not build["idempotency_key"]:
+            raise
+        return persist_builds(db, [build])[0]
+
+
+class BuildQueue:
+    """
+    A durable, multi-process FIFO of builds in a local SQLite file. Flushers claim a batch
+    with a lease, write it, then delete it; a crashed flusher's batch is claimed again once
+    its lease expires, and idempotency keys keep the retry from saving duplicates.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS queued_builds ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " idempotency_key TEXT NOT NULL UNIQUE,"
+                " email TEXT,"
+                " payload TEXT NOT NULL,"
+                " enqueued_at REAL NOT NULL,"
+                " claimed_until REAL NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(queued_builds)")}
+            if "email" not in columns: # Queue files from before keys were checked against their owner
+                connection.execute("ALTER TABLE queued_builds ADD COLUMN email TEXT")
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL") # Acknowledged builds survive a power loss
+            self._local.connection = connection
+        return connection
+
+    def enqueue(self, build: dict) -> str:
+        """
+        Durably queues a build_request() dict; returns its idempotency key (generated if missing).
+        Raises ValueError when the key is queued for another user, like persist_builds().
+        """
+        key = build["idempotency_key"] or uuid.uuid4().hex
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT email, payload FROM queued_builds WHERE idempotency_key = ?", (key,)).fetchone()
+            if row is None:
+                connection.execute(
+                    "INSERT INTO queued_builds (idempotency_key, email, payload, enqueued_at) VALUES (?, ?, ?, ?)",
+                    (key, build["email"], json.dumps({**build, "idempotency_key": key}), time.time()),
+                )
+            elif (row[0] or json.loads(row[1])["email"]) != build["email"]:
+                raise ValueError("This idempotency key was already used by another user.")
+            # Otherwise it's a retry of a build still in the queue: the same build
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return key
+
+    def claim(self, limit: int) -> list:
+        """Leases up to `limit` unclaimed (or abandoned) builds: [(row id, build dict), ...], oldest first."""
+        now = time.time()
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute(
+                "SELECT id, payload FROM queued_builds WHERE claimed_until < ? ORDER BY id LIMIT ?", (now, limit),
+            ).fetchall()
+            if rows:
+                connection.executemany(
+                    "UPDATE queued_builds SET claimed_until = ? WHERE id = ?",
+                    [(now + Config.BUILD_QUEUE_LEASE_SECONDS, row_id) for row_id, _ in rows],
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return [(row_id, json.loads(payload)) for row_id, payload in rows]
+
+    def delete(self, row_ids: list):
+        with self._connect() as connection:
+            connection.executemany("DELETE FROM queued_builds WHERE id = ?", [(row_id,) for row_id in row_ids])
+
+    def release(self, row_ids: list):
+        """Makes claimed builds available again, e.g. after a failed write."""
+        with self._connect() as connection:
+            connection.executemany("UPDATE queued_builds SET claimed_until = 0 WHERE id = ?", [(row_id,) for row_id in row_ids])
+
+    def depth(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM queued_builds").fetchone()[0]
+
+
+def _persist_batch(db: Session, batch: list) -> int:
+    """
+    Writes a claimed batch. Only a build's own data error (a since-deleted product, a key owned by
+    another user) drops it; anything else (the database being unreachable, a lost connection)
+    propagates, so the whole batch is released and retried.
+    """
+    builds = [build for _, build in batch]
+    try:
+        persist_builds(db, builds)
+        return len(builds)
+    except (IntegrityError, ValueError):
+        pass
+    # One bad build mustn't hold up the rest: write them one by one (already written ones replay by key)
+    written = 0
+    for build in builds:
+        try:
+            save_build(db, build)
+            written += 1
+        except (IntegrityError, ValueError):
+            logger.error("Dropping queued build %s: it can't be saved.", build["idempotency_key"], exc_info=True)
+            BUILD_QUEUE_FLUSHED.inc(outcome="dropped")
+    return written
+
+
+def flush_build_queue(db: Session, queue: "BuildQueue" = None, max_batches: int = None) -> int:
+    """Writes queued builds to the database in batches of Config.BUILD_QUEUE_BATCH_SIZE until the queue is empty. Returns the number written."""
+    queue = queue or get_build_queue()
+    written = batches = 0
+    while max_batches is None or batches < max_batches:
+        batch = queue.claim(Config.BUILD_QUEUE_BATCH_SIZE)
+        if not batch:
+            break
+        batches += 1
+        try:
+            count = _persist_batch(db, batch)
+        except Exception:
+            queue.release([row_id for row_id, _ in batch])
+            logger.warning("Could not write %d queued builds; will retry.", len(batch), exc_info=True)
+            BUILD_QUEUE_FLUSHED.inc(len(batch), outcome="retried")
+            break
+        queue.delete([row_id for row_id, _ in batch])
+        written += count
+        BUILD_QUEUE_FLUSHED.inc(count, outcome="written")
+    BUILD_QUEUE_DEPTH.set(queue.depth())
+    return written
+
+
+def _flush_forever(queue: BuildQueue):
+    from database import SessionLocal
+
+    while True:
+        time.sleep(Config.BUILD_QUEUE_FLUSH_SECONDS)
+        db = SessionLocal()
+        try:
+            flush_build_queue(db, queue)
+        except Exception:
+            logger.error("Build queue flush failed.", exc_info=True)
+        finally:
+            db.close()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_build_queue() -> BuildQueue:
+    """This host's queue at Config.BUILD_QUEUE_PATH."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = BuildQueue(Config.BUILD_QUEUE_PATH)
+    return _queue
+
+
+_flusher = None
+
+
+def enqueue_build(build: dict) -> str:
+    """Write-behind save: queues the build and makes sure this process runs a flusher. Returns the idempotency key."""
+    global _flusher
+    queue = get_build_queue()
+    key = queue.enqueue(build)
+    if _flusher is None or not _flusher.is_alive(): # Started lazily: threads don't survive a pre-fork
+        with _queue_lock:
+            if _flusher is None or not _flusher.is_alive():
+                _flusher = threading.Thread(target=_flush_forever, args=(queue,), name="build-queue-flusher", daemon=True)
+                _flusher.start()
+    return key
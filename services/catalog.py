@@ -0,0 +1,159 @@
+# services/catalog.py
+
+import json
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from config import Config
+from models import Product, PriceEntry
+from services.catalog_snapshot import encode_version, export_snapshot, open_snapshot
+from services.price_history import latest_entries, seen_at
+from services.compatibility import CompatibilityIndex
+from services.single_flight import get_flight
+
+logger = logging.getLogger(__name__)
+
+
+class Catalog:
+    """
+    An in-memory view of the product catalog and current prices for one catalog version,
+    shared by all requests until the catalog or its prices change.
+    """
+
+    def __init__(self, products: list, prices: dict = None, version=None, compatibility: CompatibilityIndex = None):
+        self.version = version
+        self.product_version = product_version(version)
+        self.products = {product.id: product for product in products}
+        self.prices = prices or {} # product_id -> current lowest PriceEntry
+        self.by_category = defaultdict(list)
+        for product in products:
+            self.by_category[product.category].append(product)
+        # Specs don't change with prices: a price-only reload passes the previous catalog's index
+        self.compatibility = compatibility or CompatibilityIndex(products, version=self.product_version)
+
+    def products_in(self, category: str, ids=None) -> list:
+        """
+        Returns a new list of the products in `category`, optionally limited to `ids`.
+        Callers are free to sort the returned list in place.
+        """
+        if ids is None:
+            return list(self.by_category.get(category, []))
+        return [product for product in self.by_category.get(category, []) if product.id in ids]
+
+    def lowest_price(self, product_id: int):
+        return self.prices.get(product_id)
+
+
+_catalog_lock = threading.Lock()
+_cached_catalog: Catalog | None = None
+
+
+def catalog_version(db: Session) -> tuple:
+    """
+    A cheap fingerprint of the catalog: (product count, max product id, max price entry id,
+    newest observation). Product rows are append-mostly, so count + max id catches inserts and
+    deletes; a changed price adds a price entry, so a new max id means new prices, and the
+    newest observation changes with every scrape (which can move the current price between
+    retailers). In-place spec edits must call invalidate_catalog().
+    """
+    count, max_id = db.query(func.count(Product.id), func.max(Product.id)).one()
+    max_price_id, last_seen = db.query(
+        func.max(PriceEntry.id), func.max(func.coalesce(PriceEntry.last_seen_at, PriceEntry.timestamp)),
+    ).one()
+    return (count, max_id, max_price_id, last_seen)
+
+
+def product_version(version) -> tuple | None:
+    """The products/specs part of a catalog version, which scrapes (price changes) leave alone."""
+    return tuple(version[:2]) if version else None
+
+
+def load_current_prices(db: Session, max_price_id: int = None) -> dict:
+    """
+    Loads the current lowest price of every product: the cheapest of each retailer's newest
+    price, among the retailers seen within Config.PRICE_CURRENT_WINDOW_HOURS of the product's
+    latest observation (so a retailer that stopped listing it drops out).
+    `max_price_id` gives the prices as they were when that entry was the newest one.
+    """
+    window = timedelta(hours=Config.PRICE_CURRENT_WINDOW_HOURS)
+    by_product = defaultdict(list)
+    for (product_id, _), entry in latest_entries(db, max_price_id=max_price_id).items():
+        by_product[product_id].append(entry)
+
+    prices = {}
+    for product_id, entries in by_product.items():
+        newest = max(seen_at(entry) for entry in entries)
+        current = [entry for entry in entries if newest - seen_at(entry) <= window]
+        prices[product_id] = min(current, key=lambda entry: entry.price)
+    return prices
+
+
+def load_catalog(db: Session) -> Catalog:
+    """
+    Returns the cached Catalog, reloading it when the catalog version has changed. When only
+    prices changed (a scrape), the products and the compatibility index are kept and just the
+    current prices are reloaded. With Config.CATALOG_SNAPSHOT_PATH set, a snapshot of the same
+    version is mapped instead of loading the rows through the ORM.
+
+    A rebuild is single-flight: concurrent requests wait for one load. With
+    Config.SINGLE_FLIGHT_DIR set too, so do the other workers on the host; the first one
+    writes the snapshot from the database and the rest map it.
+    """
+    version = catalog_version(db)
+    catalog = _cached_catalog
+    if catalog is not None and catalog.version == version:
+        return catalog
+    key = json.dumps(encode_version(version)) # The same in every process
+    return get_flight("catalog").do(key, lambda: _load_catalog(db, version), cross_process=bool(Config.CATALOG_SNAPSHOT_PATH))
+
+
+def _load_catalog(db: Session, version: tuple) -> Catalog:
+    global _cached_catalog
+    with _catalog_lock:
+        if _cached_catalog is not None and _cached_catalog.version == version:
+            return _cached_catalog
+        previous = _cached_catalog
+        same_products = previous is not None and previous.product_version == product_version(version)
+        snapshot = open_snapshot(Config.CATALOG_SNAPSHOT_PATH) if Config.CATALOG_SNAPSHOT_PATH else None
+        if snapshot is not None and snapshot.version == encode_version(version) and snapshot.version != _stale_snapshot_version:
+            products, prices, source = snapshot.products(), snapshot.prices(), "snapshot"
+        else:
+            # Detach the rows so they outlive this session (and aren't expired by its commits).
+            if same_products:
+                products, source = list(previous.products.values()), "database (prices only)"
+            else:
+                products, source = db.query(Product).all(), "database"
+                for product in products:
+                    db.expunge(product)
+            prices = load_current_prices(db)
+            for entry in prices.values():
+                db.expunge(entry)
+            if Config.CATALOG_SNAPSHOT_PATH:
+                _export_snapshot(version, products, prices) # The prices are in the snapshot too
+        compatibility = previous.compatibility if same_products else None
+        _cached_catalog = Catalog(products, prices, version=version, compatibility=compatibility)
+        logger.info("Catalog loaded from %s: %d products, %d prices, version %s.", source, len(products), len(prices), version)
+        return _cached_catalog
+
+
+def _export_snapshot(version: tuple, products: list, prices: dict):
+    # So other workers (waiting on the catalog flight, or starting later) map this load instead of repeating it
+    try:
+        export_snapshot(Config.CATALOG_SNAPSHOT_PATH, version, products, prices)
+    except OSError as e:
+        logger.warning("Could not write catalog snapshot %s: %s", Config.CATALOG_SNAPSHOT_PATH, e)
+
+
+_stale_snapshot_version = None
+
+
+def invalidate_catalog():
+    global _cached_catalog, _stale_snapshot_version
+    with _catalog_lock:
+        if _cached_catalog is not None:
+            # In-place edits don't change the version, so a snapshot of it is outdated too
+            _stale_snapshot_version = encode_version(_cached_catalog.version)
+        _cached_catalog = None
@@ -0,0 +1,318 @@
+# services/catalog_snapshot.py
+
+"""
+A read-only, memory-mapped columnar snapshot of the catalog (products, their specs and current
+prices), written by the scraper after each refresh. Every process maps the same file, so the
+page cache holds one copy for all workers, and loading it is a header parse instead of ORM
+hydration. Products and prices are thin views over the mapped columns.
+
+File layout (little endian):
+    b"PCCATSN1" | uint32 header length | header JSON | columns, each 8-byte aligned
+Numeric columns are raw arrays; string columns are a uint64 offsets array (rows + 1) followed
+by the UTF-8 data. Category and retailer names are stored once in the header.
+"""
+
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from datetime import date, datetime
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PCCATSN1"
+FORMAT_VERSION = 1
+
+# Product attribute -> column type ("str" or an array typecode)
+PRODUCT_COLUMNS = (
+    ("id", "q"),
+    ("category", "H"), # Index into header["categories"]
+    ("name", "str"),
+    ("brand", "str"),
+    ("model", "str"),
+    ("specs", "str"), # Compact JSON, decoded on first access
+    ("image_url", "str"),
+    ("gaming_score", "q"),
+    ("productivity_score", "q"),
+    ("aesthetic_tags", "str"),
+    # Current lowest price (catalog.load_current_prices); price_id -1 when the product has none
+    ("price_id", "q"),
+    ("price", "d"),
+    ("price_retailer", "H"), # Index into header["retailers"]
+    ("price_url", "str"),
+)
+_COLUMN_TYPES = dict(PRODUCT_COLUMNS)
+
+
+def encode_version(version) -> list:
+    """The catalog version as stored in the header (datetimes as ISO strings)."""
+    return [value.isoformat() if isinstance(value, (datetime, date)) else value for value in version or ()]
+
+
+def _str_column(values: list) -> bytes:
+    data = [(value or "").encode("utf-8") for value in values]
+    offsets, position = array("Q", [0]), 0
+    for item in data:
+        position += len(item)
+        offsets.append(position)
+    return offsets.tobytes() + b"".join(data)
+
+
+def write_snapshot(db, path: str) -> str:
+    """
+    Exports the current catalog to `path` atomically (temp file + rename), so readers see
+    either the old or the new snapshot, never a partial one. Returns the path.
+    """
+    from models import Product
+    from services.catalog import catalog_version, load_current_prices
+
+    version = catalog_version(db)
+    return export_snapshot(path, version, db.query(Product).all(), load_current_prices(db))
+
+
+def export_snapshot(path: str, version, products: list, prices: dict) -> str:
+    """write_snapshot() for a catalog already in memory (products and their current prices)."""
+    products = sorted(products, key=lambda product: product.id)
+    categories = sorted({product.category for product in products})
+    retailers = sorted({entry.retailer_name for entry in prices.values()})
+    category_codes = {name: code for code, name in enumerate(categories)}
+    retailer_codes = {name: code for code, name in enumerate(retailers)}
+
+    rows = {name: [] for name, _ in PRODUCT_COLUMNS}
+    for product in products:
+        entry = prices.get(product.id)
+        values = {
+            "id": product.id,
+            "category": category_codes[product.category],
+            "name": product.name,
+            "brand": product.brand,
+            "model": product.model,
+            "specs": json.dumps(product.specs or {}, separators=(",", ":"), sort_keys=True),
+            "image_url": product.image_url,
+            "gaming_score": product.gaming_score or 0,
+            "productivity_score": product.productivity_score or 0,
+            "aesthetic_tags": product.aesthetic_tags,
+            "price_id": entry.id if entry else -1,
+            "price": entry.price if entry else math.nan,
+            "price_retailer": retailer_codes[entry.retailer_name] if entry else 0,
+            "price_url": entry.retailer_url if entry else None,
+        }
+        for name, value in values.items():
+            rows[name].append(value)
+
+    blobs = []
+    for name, kind in PRODUCT_COLUMNS:
+        blobs.append((name, _str_column(rows[name]) if kind == "str" else array(kind, rows[name]).tobytes()))
+
+    # Column offsets are relative to the end of the header; pad each column to 8 bytes
+    columns, position = {}, 0
+    for name, blob in blobs:
+        columns[name] = [position, len(blob)]
+        position += len(blob) + (-len(blob) % 8)
+    header = json.dumps({
+        "format": FORMAT_VERSION,
+        "version": encode_version(version),
+        "count": len(products),
+        "categories": categories,
+        "retailers": retailers,
+        "columns": columns,
+    }).encode("utf-8")
+    header += b" " * (-(len(MAGIC) + 4 + len(header)) % 8)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".catalog-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(MAGIC + struct.pack("<I", len(header)) + header)
+            for _, blob in blobs:
+                out.write(blob + b"\0" * (-len(blob) % 8))
+            out.flush()
+            os.fsync(out.fileno())
+        os.chmod(tmp_path, 0o644) # mkstemp creates it private; workers may run as another user
+        os.replace(tmp_path, path) # Atomic on POSIX; mapped readers keep the old inode
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    logger.info("Catalog snapshot written to %s: %d products, %d prices, version %s.", path, len(products), len(prices), version)
+    return path
+
+
+class CatalogSnapshot:
+    """A mapped snapshot file. Stays valid (and mapped) while any product or price view references it."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+        self.file_id = (stat.st_ino, stat.st_mtime_ns) # Changes when the scraper replaces the file
+        if sys.byteorder != "little":
+            raise ValueError("Catalog snapshots are little endian.")
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot.")
+        (header_length,) = struct.unpack_from("<I", self._map, len(MAGIC))
+        header_end = len(MAGIC) + 4 + header_length
+        header = json.loads(self._map[len(MAGIC) + 4:header_end])
+        if header["format"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported catalog snapshot format {header['format']} in {path}.")
+        self.version = header["version"]
+        self.count = header["count"]
+        self.categories = header["categories"]
+        self.retailers = header["retailers"]
+
+        view = memoryview(self._map)
+        self._columns = {}
+        for name, (offset, length) in header["columns"].items():
+            column = view[header_end + offset:header_end + offset + length]
+            kind = _COLUMN_TYPES[name]
+            if kind == "str":
+                offsets = column[:(self.count + 1) * 8].cast("Q")
+                self._columns[name] = (offsets, column[(self.count + 1) * 8:])
+            else:
+                self._columns[name] = column.cast(kind)
+
+    def number(self, name: str, row: int):
+        return self._columns[name][row]
+
+    def string(self, name: str, row: int) -> str:
+        offsets, data = self._columns[name]
+        return str(data[offsets[row]:offsets[row + 1]], "utf-8")
+
+    def products(self) -> list:
+        return [SnapshotProduct(self, row) for row in range(self.count)]
+
+    def prices(self) -> dict:
+        """product_id -> SnapshotPrice for every product with a current price."""
+        ids, price_ids = self._columns["id"], self._columns["price_id"]
+        return {ids[row]: SnapshotPrice(self, row) for row in range(self.count) if price_ids[row] >= 0}
+
+
+class SnapshotProduct:
+    """Read-only stand-in for a Product row, backed by the snapshot's columns."""
+
+    __slots__ = ("_snapshot", "_row", "id", "category", "_specs")
+
+    def __init__(self, snapshot: CatalogSnapshot, row: int):
+        self._snapshot = snapshot
+        self._row = row
+        # Hot in every index and lookup, so kept as attributes
+        self.id = snapshot.number("id", row)
+        self.category = snapshot.categories[snapshot.number("category", row)]
+        self._specs = None
+
+    @property
+    def specs(self) -> dict:
+        if self._specs is None:
+            self._specs = json.loads(self._snapshot.string("specs", self._row))
+        return self._specs
+
+    @property
+    def name(self) -> str:
+        return self._snapshot.string("name", self._row)
+
+    @property
+    def brand(self) -> str:
+        return self._snapshot.string("brand", self._row)
+
+    @property
+    def model(self) -> str:
+        return self._snapshot.string("model", self._row)
+
+    @property
+    def image_url(self) -> str | None:
+        return self._snapshot.string("image_url", self._row) or None
+
+    @property
+    def aesthetic_tags(self) -> str | None:
+        return self._snapshot.string("aesthetic_tags", self._row) or None
+
+    @property
+    def gaming_score(self) -> int:
+        return self._snapshot.number("gaming_score", self._row)
+
+    @property
+    def productivity_score(self) -> int:
+        return self._snapshot.number("productivity_score", self._row)
+
+    def __repr__(self):
+        return f"<Product(name='{self.name}', category='{self.category}')>"
+
+
+class SnapshotPrice:
+    """Read-only stand-in for a product's current lowest PriceEntry."""
+
+    __slots__ = ("_snapshot", "_row", "product_id", "price")
+
+    def __init__(self, snapshot: CatalogSnapshot, row: int):
+        self._snapshot = snapshot
+        self._row = row
+        self.product_id = snapshot.number("id", row)
+        self.price = snapshot.number("price", row)
+
+    @property
+    def id(self) -> int:
+        return self._snapshot.number("price_id", self._row)
+
+    @property
+    def retailer_name(self) -> str:
+        return self._snapshot.retailers[self._snapshot.number("price_retailer", self._row)]
+
+    @property
+    def retailer_url(self) -> str:
+        return self._snapshot.string("price_url", self._row)
+
+    def __repr__(self):
+        return f"<PriceEntry(product_id={self.product_id}, retailer='{self.retailer_name}', price={self.price})>"
+
+
+_open_lock = threading.Lock()
+_current: CatalogSnapshot | None = None
+
+
+def open_snapshot(path: str) -> CatalogSnapshot | None:
+    """
+    The mapped snapshot at `path`, remapped when the file has been replaced since the last call.
+    Returns None when there is no (readable) snapshot.
+    """
+    global _current
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    file_id = (stat.st_ino, stat.st_mtime_ns)
+    current = _current
+    if current is not None and current.path == path and current.file_id == file_id:
+        return current
+    with _open_lock:
+        if _current is not None and _current.path == path and _current.file_id == file_id:
+            return _current
+        try:
+            _current = CatalogSnapshot(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Could not map catalog snapshot %s: %s", path, e)
+            return None
+        # The previous mapping is released once no catalog refers to it any more
+        return _current
+
+
+if __name__ == "__main__":
+    # Export the snapshot by hand, e.g. when deploying the first time
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    from config import Config
+    from database import SessionLocal
+
+    target = sys.argv[1] if len(sys.argv) > 1 else Config.CATALOG_SNAPSHOT_PATH
+    if not target:
+        sys.exit("Usage: python services/catalog_snapshot.py PATH (or set CATALOG_SNAPSHOT_PATH)")
+    session = SessionLocal()
+    try:
+        print(write_snapshot(session, target))
+    finally:
+        session.close()
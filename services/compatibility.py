@@ -0,0 +1,229 @@
+# services/compatibility.py
+
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from dataclasses import dataclass
+
+
+def form_factor_size(form_factor) -> int | None:
+    """
+    Maps a motherboard/case form factor string onto an ordered size so that
+    "case supports board" becomes a simple numeric comparison.
+    Cases are described by the largest board they take ("ATX Mid Tower" -> ATX).
+    """
+    if not form_factor:
+        return None
+    value = str(form_factor).upper().replace(" ", "-")
+    if "E-ATX" in value or "EATX" in value:
+        return 4
+    if "ITX" in value:
+        return 1
+    if "MICRO" in value or "MATX" in value:
+        return 2
+    if "ATX" in value:
+        return 3
+    return None
+
+
+# Spec values that are derived from the raw `Product.specs` JSON before indexing.
+DERIVED_SPECS = {
+    "form_factor_size": lambda specs: form_factor_size(specs.get("form_factor")),
+}
+
+
+@dataclass(frozen=True)
+class CompatibilityRule:
+    """
+    A declarative part-to-part rule: a candidate in `category` is compatible when its
+    `spec_key` compares with `op` against the `source_key` of the already selected
+    `source_category` part. Candidates missing a numeric spec are treated as unconstrained.
+    """
+    category: str
+    spec_key: str
+    op: str  # "eq", "gte" or "lte"
+    source_category: str
+    source_key: str
+
+    def candidate_ids(self, index: "CompatibilityIndex", value) -> frozenset:
+        if self.op == "eq":
+            return index.with_spec(self.category, self.spec_key, value)
+        if self.op == "gte":
+            return index.at_least(self.category, self.spec_key, value, include_unknown=True)
+        if self.op == "lte":
+            return index.at_most(self.category, self.spec_key, value, include_unknown=True)
+        raise ValueError(f"Unknown compatibility operator: {self.op}")
+
+    def source_ids(self, index: "CompatibilityIndex", value) -> frozenset:
+        """The rule read backwards: `source_category` parts compatible with a `category` part whose spec is `value`."""
+        if self.op == "eq":
+            return index.with_spec(self.source_category, self.source_key, value)
+        if self.op == "gte":
+            return index.at_most(self.source_category, self.source_key, value, include_unknown=True)
+        if self.op == "lte":
+            return index.at_least(self.source_category, self.source_key, value, include_unknown=True)
+        raise ValueError(f"Unknown compatibility operator: {self.op}")
+
+
+# New rule types are added here, not in the recommendation logic.
+COMPATIBILITY_RULES = (
+    CompatibilityRule("Motherboard", "socket", "eq", "CPU", "socket"),
+    CompatibilityRule("RAM", "ram_type", "eq", "Motherboard", "ram_type"),
+    CompatibilityRule("Case", "form_factor_size", "gte", "Motherboard", "form_factor_size"),
+    CompatibilityRule("Case", "max_gpu_length_mm", "gte", "GPU", "length_mm"),
+)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class CompatibilityIndex:
+    """
+    Precomputed id sets over a product catalog: by category, by spec value (socket, RAM type,
+    form factor, ...), by aesthetic tag, plus value-sorted arrays for numeric specs such as
+    PSU wattage. Compatible candidate sets are obtained by set intersection.
+    Built once per catalog version (see services/catalog.py).
+    """
+
+    def __init__(self, products, rules=COMPATIBILITY_RULES, version=None):
+        self.version = version
+        self.rules = tuple(rules)
+        self._by_category = defaultdict(set)
+        self._by_spec = defaultdict(lambda: defaultdict(set))  # (category, key) -> value -> ids
+        self._by_tag = defaultdict(set)  # (category, tag) -> ids
+        self._numeric = {}  # (category, key) -> (sorted values, ids in the same order)
+        self._specs = {}  # product id -> indexed spec values, used to resolve rule sources
+
+        numeric_rows = defaultdict(list)
+        for product in products:
+            specs = dict(product.specs or {})
+            for key, derive in DERIVED_SPECS.items():
+                derived = derive(specs)
+                if derived is not None:
+                    specs[key] = derived
+            self._specs[product.id] = specs
+            self._by_category[product.category].add(product.id)
+
+            for key, value in specs.items():
+                if isinstance(value, (str, int, float, bool)):
+                    self._by_spec[(product.category, key)][value].add(product.id)
+                if _is_number(value):
+                    numeric_rows[(product.category, key)].append((value, product.id))
+
+            for tag in (product.aesthetic_tags or "").split(","):
+                tag = tag.strip().lower()
+                if tag:
+                    self._by_tag[(product.category, tag)].add(product.id)
+
+        for key, rows in numeric_rows.items():
+            rows.sort()
+            self._numeric[key] = ([value for value, _ in rows], [product_id for _, product_id in rows])
+
+        # Freeze everything so callers can't mutate shared sets.
+        self._by_category = {category: frozenset(ids) for category, ids in self._by_category.items()}
+        self._by_spec = {
+            key: {value: frozenset(ids) for value, ids in values.items()}
+            for key, values in self._by_spec.items()
+        }
+        self._by_tag = {key: frozenset(ids) for key, ids in self._by_tag.items()}
+
+    def ids(self, category: str) -> frozenset:
+        return self._by_category.get(category, frozenset())
+
+    def spec(self, product_id: int, key: str):
+        return self._specs.get(product_id, {}).get(key)
+
+    def with_spec(self, category: str, key: str, value) -> frozenset:
+        return self._by_spec.get((category, key), {}).get(value, frozenset())
+
+    def tagged(self, category: str, tag: str) -> frozenset:
+        return self._by_tag.get((category, tag.strip().lower()), frozenset())
+
+    def _without_spec(self, category: str, key: str) -> frozenset:
+        values, ids = self._numeric.get((category, key), ([], []))
+        return self.ids(category) - frozenset(ids)
+
+    def at_least(self, category: str, key: str, minimum, include_unknown: bool = False) -> frozenset:
+        values, ids = self._numeric.get((category, key), ([], []))
+        matched = frozenset(ids[bisect_left(values, minimum):])
+        return matched | self._without_spec(category, key) if include_unknown else matched
+
+    def at_most(self, category: str, key: str, maximum, include_unknown: bool = False) -> frozenset:
+        values, ids = self._numeric.get((category, key), ([], []))
+        matched = frozenset(ids[:bisect_right(values, maximum)])
+        return matched | self._without_spec(category, key) if include_unknown else matched
+
+    def _allowed(self, rule: CompatibilityRule, values: set, backwards: bool) -> frozenset | None:
+        """
+        Ids on the other side of `rule` compatible with at least one part whose spec is in `values`
+        (read backwards: `source_category` parts). None when one of the parts doesn't declare the
+        spec, so there's nothing to enforce.
+        """
+        if None in values:
+            return None
+        if not values:
+            return frozenset()
+        if rule.op != "eq":
+            # The union of threshold sets is the set of the loosest threshold
+            at_least = (rule.op == "gte") != backwards
+            values = {min(values) if at_least else max(values)}
+        lookup = rule.source_ids if backwards else rule.candidate_ids
+        allowed = frozenset()
+        for value in values:
+            allowed |= lookup(self, value)
+        return allowed
+
+    def _values(self, part, key: str) -> set:
+        ids = part if isinstance(part, (set, frozenset)) else (getattr(part, "id", part),)
+        return {self.spec(product_id, key) for product_id in ids}
+
+    def compatible_ids(self, category: str, selected_parts: dict) -> frozenset:
+        """
+        Returns the ids in `category` compatible with every already selected part,
+        by intersecting the id sets of all rules that apply.
+        `selected_parts` maps category -> Product (or product id), or -> a frozenset of the ids
+        still possible for a stage not picked yet (see narrowed_ids()). Rules apply in both
+        directions, so a part pinned downstream (e.g. a requested motherboard) also
+        constrains the stages before it (the CPU socket).
+        """
+        candidates = self.ids(category)
+        own = selected_parts.get(category)
+        if isinstance(own, (set, frozenset)):
+            candidates = candidates & own
+        for rule in self.rules:
+            if rule.category == category and rule.source_category in selected_parts:
+                allowed = self._allowed(rule, self._values(selected_parts[rule.source_category], rule.source_key), False)
+            elif rule.source_category == category and rule.category in selected_parts:
+                allowed = self._allowed(rule, self._values(selected_parts[rule.category], rule.spec_key), True)
+            else:
+                continue
+            if allowed is not None:
+                candidates = candidates & allowed
+        return candidates
+
+    def narrowed_ids(self, pinned_parts: dict) -> dict:
+        """
+        category -> frozenset of the ids that can still be part of a build containing every
+        `pinned_parts` part (category -> Product or product id), for the categories the pins
+        constrain. Follows the rules transitively: pinned DDR4 RAM narrows the motherboards to
+        DDR4 boards, and those narrow the CPUs to their sockets.
+        """
+        domains = {category: frozenset((getattr(part, "id", part),)) for category, part in pinned_parts.items()}
+        changed = bool(domains)
+        while changed: # Domains only shrink, so this settles after a few passes
+            changed = False
+            for rule in self.rules:
+                for source, target, key, backwards in (
+                    (rule.source_category, rule.category, rule.source_key, False),
+                    (rule.category, rule.source_category, rule.spec_key, True),
+                ):
+                    if source not in domains:
+                        continue
+                    allowed = self._allowed(rule, self._values(domains[source], key), backwards)
+                    if allowed is None:
+                        continue
+                    narrowed = domains.get(target, self.ids(target)) & allowed
+                    if narrowed != domains.get(target):
+                        domains[target] = narrowed
+                        changed = True
+        return domains
@@ -0,0 +1,80 @@
+# services/demand.py
+
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from sqlalchemy.orm import Session
+from config import Config
+from models import ProductDemand
+
+logger = logging.getLogger(__name__)
+
+_pending = Counter() # product_id -> recommendations not yet written
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def decayed(count: float, since: datetime | None, now: datetime) -> float:
+    """`count` as of `since`, decayed to `now` with a half-life of Config.DEMAND_HALF_LIFE_DAYS."""
+    if not count or since is None:
+        return count or 0.0
+    age_days = max((now - since.replace(tzinfo=None)).total_seconds(), 0.0) / 86400
+    return count * 0.5 ** (age_days / Config.DEMAND_HALF_LIFE_DAYS)
+
+
+def record_recommendation(build_result: dict):
+    """Counts the parts of a build shown to a user. Buffered in memory; see flush_demand()."""
+    if not build_result:
+        return
+    with _pending_lock:
+        _pending.update(item["product"].id for item in build_result["build"].values())
+
+
+def flush_demand(db: Session, force: bool = False) -> int:
+    """
+    Adds the buffered recommendation counts to product_demand, at most once per
+    Config.DEMAND_FLUSH_SECONDS unless `force`. Returns the number of products written.
+    Workers flush independently, so concurrent flushes may lose an increment; the counts
+    only steer scrape priority, so that's an acceptable trade for not writing on every request.
+    """
+    global _last_flush
+    with _pending_lock:
+        if not _pending or (not force and time.monotonic() - _last_flush < Config.DEMAND_FLUSH_SECONDS):
+            return 0
+        counts = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+
+    now = datetime.now()
+    rows = {row.product_id: row for row in db.query(ProductDemand).filter(ProductDemand.product_id.in_(counts))}
+    for product_id, count in counts.items():
+        row = rows.get(product_id)
+        if row is None:
+            db.add(ProductDemand(product_id=product_id, recommendations=float(count), updated_at=now))
+        else:
+            row.recommendations = decayed(row.recommendations, row.updated_at, now) + count
+            row.updated_at = now
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.warning("Could not write recommendation demand for %d products.", len(counts), exc_info=True)
+        return 0
+    return len(counts)
+
+
+def maybe_flush_demand():
+    """Flushes on a short-lived primary session when due; called after requests (the request's own session may be a replica)."""
+    with _pending_lock:
+        due = _pending and time.monotonic() - _last_flush >= Config.DEMAND_FLUSH_SECONDS
+    if not due:
+        return
+    from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        flush_demand(db)
+    finally:
+        db.close()
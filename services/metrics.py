@@ -0,0 +1,251 @@
+# services/metrics.py
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from fast in-memory stages up to slow LLM calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: dict = None) -> str:
+    pairs = list(zip(label_names, label_values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values: tuple, value) -> list:
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {value}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def snapshot(self, **labels) -> dict:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return {"sum": state["sum"], "count": state["count"]} if state else {"sum": 0.0, "count": 0}
+
+    def _render_value(self, label_values: tuple, state) -> list:
+        lines, cumulative = [], 0
+        for upper, count in zip(self.buckets, state["counts"]):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, label_values, {'le': upper})} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(self.label_names, label_values, {'le': '+Inf'})} {state['count']}")
+        lines.append(f"{self.name}_sum{_format_labels(self.label_names, label_values)} {state['sum']}")
+        lines.append(f"{self.name}_count{_format_labels(self.label_names, label_values)} {state['count']}")
+        return lines
+
+
+class Registry:
+    """Process-local metric registry rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name: str, help_text: str, label_names: tuple, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, label_names, **kwargs)
+            return metric
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()) -> Counter:
+        return self._get_or_create(Counter, name, help_text, label_names)
+
+    def gauge(self, name: str, help_text: str, label_names: tuple = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help_text, label_names)
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help_text, label_names, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+SPAN_SECONDS = REGISTRY.histogram("pc_agent_span_seconds", "Duration of instrumented stages.", ("span", "stage"))
+REQUEST_SECONDS = REGISTRY.histogram("pc_agent_request_seconds", "HTTP request latency.", ("endpoint", "status"))
+REQUEST_DB_QUERIES = REGISTRY.histogram(
+    "pc_agent_request_db_queries", "DB queries per HTTP request.", ("endpoint",),
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000),
+)
+DB_QUERIES = REGISTRY.counter("pc_agent_db_queries_total", "DB queries executed.")
+DB_QUERY_SECONDS = REGISTRY.histogram("pc_agent_db_query_seconds", "DB query execution time.")
+DB_ROWS_LOADED = REGISTRY.counter("pc_agent_db_rows_loaded_total", "ORM objects hydrated from query results.")
+DB_ROWS_WRITTEN = REGISTRY.counter("pc_agent_db_rows_written_total", "Rows affected by INSERT/UPDATE/DELETE.")
+DB_POOL = REGISTRY.gauge("pc_agent_db_pool", "DB connection pool state.", ("engine", "field"))
+
+
+class RequestStats:
+    """Per-request (or per-task) timings and DB counters."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = [] # (name, seconds)
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.db_rows_loaded = 0
+        self.db_rows_written = 0
+
+
+_current_stats: contextvars.ContextVar = contextvars.ContextVar("pc_agent_request_stats", default=None)
+
+
+def start_request_stats() -> RequestStats:
+    stats = RequestStats()
+    _current_stats.set(stats)
+    return stats
+
+
+def current_request_stats() -> RequestStats | None:
+    return _current_stats.get()
+
+
+def end_request_stats():
+    _current_stats.set(None)
+
+
+@contextmanager
+def span(name: str, stage: str = ""):
+    """Times a block into pc_agent_span_seconds (and the current request's timings)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        SPAN_SECONDS.observe(elapsed, span=name, stage=stage)
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.spans.append((f"{name}.{stage}" if stage else name, elapsed))
+
+
+def server_timing_header(stats: RequestStats) -> str:
+    """Formats a request's spans and DB time as a Server-Timing header value."""
+    totals = {}
+    for name, seconds in stats.spans:
+        totals[name] = totals.get(name, 0.0) + seconds
+    totals["db"] = stats.db_seconds
+    return ", ".join(f"{name.replace(' ', '_')};dur={seconds * 1000:.2f}" for name, seconds in totals.items())
+
+
+def instrument_sqlalchemy(engine):
+    """Counts queries, query time and rows via SQLAlchemy event hooks."""
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    # The start time lives on the execution context, not the pooled connection: a failed query
+    # never reaches after_cursor_execute, and nothing of it must carry over to later queries
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.pc_agent_query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "pc_agent_query_started", None)
+        elapsed = time.perf_counter() - started if started is not None else 0.0
+        DB_QUERIES.inc()
+        DB_QUERY_SECONDS.observe(elapsed)
+        is_write = context is not None and (context.isinsert or context.isupdate or context.isdelete)
+        written = cursor.rowcount if is_write else 0
+        if written > 0:
+            DB_ROWS_WRITTEN.inc(written)
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.db_queries += 1
+            stats.db_seconds += elapsed
+            if written > 0:
+                stats.db_rows_written += written
+
+    if not getattr(instrument_sqlalchemy, "_session_hooked", False):
+        @event.listens_for(Session, "loaded_as_persistent")
+        def _loaded_as_persistent(session, instance):
+            DB_ROWS_LOADED.inc()
+            stats = _current_stats.get()
+            if stats is not None:
+                stats.db_rows_loaded += 1
+
+        instrument_sqlalchemy._session_hooked = True
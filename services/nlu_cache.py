@@ -0,0 +1,156 @@
+# services/nlu_cache.py
+
+"""
+Exact-match cache for NLUService calls. Keys hash the call's prompt messages (with their
+text normalized: whitespace collapsed, case folded) together with the model settings, so
+"Hi" and " hi " share an entry but any change to the history, the system prompt or the
+model doesn't. Entries live in a bounded in-memory LRU and, with Config.NLU_CACHE_PATH set,
+in a SQLite file shared by the host's workers and kept across restarts.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from config import Config
+from services.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+NLU_CACHE_REQUESTS = REGISTRY.counter("pc_agent_nlu_cache_requests_total", "NLU cache lookups.", ("call", "result"))
+NLU_CACHE_HIT_RATIO = REGISTRY.gauge("pc_agent_nlu_cache_hit_ratio", "Share of NLU cache lookups answered from the cache.", ("call",))
+NLU_CACHE_SAVED_SECONDS = REGISTRY.counter(
+    "pc_agent_nlu_cache_saved_seconds_total", "OpenAI latency avoided by cache hits (the original call's duration).", ("call",)
+)
+
+_PRUNE_EVERY = 1000 # Disk writes between deletions of expired rows
+
+
+def normalize_text(text) -> str:
+    return " ".join(str(text or "").split()).casefold()
+
+
+def cache_key(call: str, messages: list, settings: dict) -> str:
+    """Hash of the normalized prompt messages and the model settings."""
+    payload = json.dumps({
+        "call": call,
+        "settings": settings,
+        "messages": [[message["role"], normalize_text(message["content"])] for message in messages],
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class NLUCache:
+    """Values are stored as JSON, so every hit returns a fresh copy the caller may modify."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, path: str = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (expires at, value JSON, seconds the call took)
+        self._counts = {} # call -> [hits, misses, seconds saved]
+        self._local = threading.local()
+        self._writes = 0
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._connect().execute(
+                "CREATE TABLE IF NOT EXISTS nlu_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, seconds REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _record(self, call: str, hit: bool, seconds: float = 0.0):
+        NLU_CACHE_REQUESTS.inc(call=call, result="hit" if hit else "miss")
+        with self._lock:
+            counts = self._counts.setdefault(call, [0, 0, 0.0])
+            counts[0 if hit else 1] += 1
+            counts[2] += seconds
+            ratio = counts[0] / (counts[0] + counts[1])
+        NLU_CACHE_HIT_RATIO.set(ratio, call=call)
+        if hit:
+            NLU_CACHE_SAVED_SECONDS.inc(seconds, call=call)
+
+    def _read_disk(self, key: str, now: float):
+        try:
+            return self._connect().execute(
+                "SELECT expires_at, value, seconds FROM nlu_cache WHERE key = ? AND expires_at > ?", (key, now),
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("NLU cache read from %s failed: %s", self.path, e)
+            return None
+
+    def get(self, key: str, call: str):
+        """The cached value, or None on a miss (counted for the hit rate either way)."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                else:
+                    del self._entries[key]
+                    entry = None
+        if entry is None and self.path:
+            entry = self._read_disk(key, now)
+            if entry is not None:
+                self._remember(key, tuple(entry))
+        if entry is None:
+            self._record(call, False)
+            return None
+        self._record(call, True, entry[2])
+        return json.loads(entry[1])
+
+    def _remember(self, key: str, entry: tuple):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key: str, value, seconds: float):
+        """Caches `value` (JSON-serializable); `seconds` is what the call cost, reported as saved on each hit."""
+        expires_at = time.time() + self.ttl_seconds
+        entry = (expires_at, json.dumps(value), seconds)
+        self._remember(key, entry)
+        if not self.path:
+            return
+        try:
+            connection = self._connect()
+            connection.execute("INSERT OR REPLACE INTO nlu_cache (key, value, seconds, expires_at) VALUES (?, ?, ?, ?)", (key, entry[1], seconds, expires_at))
+            with self._lock:
+                self._writes += 1
+                prune = self._writes % _PRUNE_EVERY == 0
+            if prune:
+                connection.execute("DELETE FROM nlu_cache WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            logger.warning("NLU cache write to %s failed: %s", self.path, e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = {
+                call: {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                    "seconds_saved": round(saved, 3),
+                }
+                for call, (hits, misses, saved) in self._counts.items()
+            }
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "calls": calls}
+
+
+def cache_from_config() -> NLUCache | None:
+    if not Config.NLU_CACHE_ENABLED:
+        return None
+    return NLUCache(Config.NLU_CACHE_MAX_ENTRIES, Config.NLU_CACHE_TTL_SECONDS, path=Config.NLU_CACHE_PATH)
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 # The above line explicitly declares the file's encoding as UTF-8.
 
-from openai import OpenAI, OpenAIError
+# openai/httpx are imported on first use (see NLUService.client): they dominate
+# import time, and the scheduler/CLI entry points never talk to the API.
 from config import Config
+from services.metrics import span
+from services.nlu_cache import cache_from_config, cache_key
+from services.traffic_capture import record_nlu
 import json
 import logging
-import httpx # <--- NEW IMPORT: Required for creating a custom HTTP client
 import os    # Keep os import, might be useful for environment checks
+import threading
+import time
 
-# Configure basic logging to show messages in the terminal where Flask runs
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Handlers/format are set up once by logging_config.configure_logging()
+logger = logging.getLogger(__name__)
 
 # --- Helper function to clean strings ---
 def sanitize_text(text: str) -> str:
@@ -22,28 +27,22 @@ def sanitize_text(text: str) -> str:
         text = str(text) # Ensure it's a string before processing
     return text.replace('\u2028', '').replace('\u2029', '')
 
+# Model settings per call; part of the NLU cache keys
+CHAT_SETTINGS = {"model": "gpt-3.5-turbo", "max_tokens": 500, "temperature": 0.7}
+EXTRACTION_SETTINGS = {"model": "gpt-3.5-turbo", "max_tokens": 200, "temperature": 0.0}
+
 class NLUService:
     def __init__(self):
-        # --- NEW: Create a custom httpx client for explicit encoding control ---
-        # This client will be used by the OpenAI library.
-        # While httpx typically handles UTF-8, explicitly configuring it can
-        # help with stubborn encoding issues, especially if invisible chars persist.
-        self.http_client = httpx.Client(
-            # You can add transport/proxy/timeout settings here if needed later
-            # transport=httpx.HTTPTransport(retries=3),
-            # timeout=30.0,
-        )
-
-        # --- MODIFIED: Pass the custom http_client to the OpenAI client ---
-        self.client = OpenAI(
-            api_key=Config.OPENAI_API_KEY,
-            http_client=self.http_client # Pass our custom httpx client
-        )
-        # ------------------------------------------------------------------
+        # The OpenAI client is created on first use (see `client`)
+        self._client = None
+        self._async_client = None
+        self._client_lock = threading.Lock()
+        # Exact-match cache of replies and extractions (services.nlu_cache); None when disabled
+        self.cache = cache_from_config()
 
-        logging.info(f"NLUService initialized. OpenAI API Key (first 5 chars): {Config.OPENAI_API_KEY[:5] if Config.OPENAI_API_KEY else 'N/A'}")
+        logger.info("NLUService initialized. OpenAI API Key configured: %s", bool(Config.OPENAI_API_KEY))
         if not Config.OPENAI_API_KEY:
-            logging.error("CRITICAL ERROR: OPENAI_API_KEY is not set in config.py. Please check .env file.")
+            logger.error("CRITICAL ERROR: OPENAI_API_KEY is not set in config.py. Please check .env file.")
 
         # Manually re-typed and sanitized original system message content
         # --- CRITICAL: Manually RE-TYPE this string or paste from a plain source ---
@@ -64,10 +63,58 @@ class NLUService:
             "role": "system",
             "content": sanitize_text(original_system_content) # Sanitize here once at init
         }
-        logging.debug(f"System message sanitized and loaded: {self.system_message['content']}")
+        logger.debug("System message sanitized and loaded (%d chars)", len(self.system_message["content"]))
 
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import httpx
+                    from openai import OpenAI
 
-    def get_chat_response(self, user_message: str, conversation_history: list = None):
+                    # --- NEW: Create a custom httpx client for explicit encoding control ---
+                    # This client will be used by the OpenAI library.
+                    # While httpx typically handles UTF-8, explicitly configuring it can
+                    # help with stubborn encoding issues, especially if invisible chars persist.
+                    self.http_client = httpx.Client(
+                        # You can add transport/proxy/timeout settings here if needed later
+                        # transport=httpx.HTTPTransport(retries=3),
+                        # timeout=30.0,
+                    )
+
+                    # --- MODIFIED: Pass the custom http_client to the OpenAI client ---
+                    self._client = OpenAI(
+                        api_key=Config.OPENAI_API_KEY,
+                        http_client=self.http_client # Pass our custom httpx client
+                    )
+        return self._client
+
+    @property
+    def async_client(self):
+        """AsyncOpenAI client for the ASGI entry point (asgi.py); requests wait on the network without holding a thread."""
+        if self._async_client is None:
+            with self._client_lock:
+                if self._async_client is None:
+                    import httpx
+                    from openai import AsyncOpenAI
+
+                    self._async_client = AsyncOpenAI(
+                        api_key=Config.OPENAI_API_KEY,
+                        http_client=httpx.AsyncClient(
+                            # One process holds many conversations; keep enough connections open for them
+                            limits=httpx.Limits(max_connections=Config.ASGI_OPENAI_MAX_CONNECTIONS),
+                        ),
+                    )
+        return self._async_client
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+    def _chat_messages(self, user_message: str, conversation_history: list = None) -> list:
+        """The conversation history with the new (sanitized) user message; shared by the sync and async paths."""
         if conversation_history is None:
             conversation_history = [self.system_message]
         else:
@@ -79,32 +126,76 @@ class NLUService:
         user_message_sanitized = sanitize_text(user_message)
         conversation_history.append({"role": "user", "content": user_message_sanitized})
 
-        logging.info(f"Attempting to get chat response for user message: '{user_message_sanitized}'")
-        logging.debug(f"Conversation history sent to OpenAI: {conversation_history}")
+        # Lengths only: full prompts are large and contain user data
+        logger.info("Attempting to get chat response (message %d chars, history %d messages)", len(user_message_sanitized), len(conversation_history))
+        return conversation_history
+
+    def _cache_key(self, call: str, messages: list, settings: dict) -> str | None:
+        """Cache key for a call, or None when it mustn't be cached (cache off, or a sampled call)."""
+        if self.cache is None or (settings["temperature"] != 0 and not Config.NLU_CACHE_NONDETERMINISTIC):
+            return None
+        return cache_key(call, messages, settings)
+
+    def _chat_reply(self, ai_response_content: str, conversation_history: list):
+        record_nlu("chat", ai_response_content) # For traffic replays (services.traffic_capture)
+        conversation_history.append({"role": "assistant", "content": ai_response_content})
+        logger.info("OpenAI chat response received (%d chars)", len(ai_response_content or ""))
+        return ai_response_content, conversation_history
 
+    def _chat_error(self, e: Exception, conversation_history: list):
+        from openai import OpenAIError
+
+        record_nlu("chat", error=type(e).__name__)
+        if isinstance(e, OpenAIError): # Catch specific OpenAI API errors
+            logger.error("OpenAI API Error in get_chat_response: %s", e)
+            return "I'm sorry, I encountered an issue with the AI service. Please check your API key and network connection.", conversation_history
+        logger.error("General Error in get_chat_response: %s", e, exc_info=True) # Log full traceback
+        return "I'm sorry, I'm having trouble understanding right now. Can you please try again?", conversation_history
+
+    def get_chat_response(self, user_message: str, conversation_history: list = None):
+        conversation_history = self._chat_messages(user_message, conversation_history)
+        key = self._cache_key("chat", conversation_history, CHAT_SETTINGS)
+        cached = self.cache.get(key, "chat") if key else None
+        if cached is not None:
+            return self._chat_reply(cached, conversation_history)
         try:
             # The conversation_history list should now only contain already-sanitized strings
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=conversation_history, # Use the list with pre-sanitized content
-                max_tokens=500,
-                temperature=0.7,
-            )
-
+            started = time.perf_counter()
+            with span("nlu", stage="chat"):
+                response = self.client.chat.completions.create(
+                    messages=conversation_history, # Use the list with pre-sanitized content
+                    **CHAT_SETTINGS,
+                )
             # Access the content correctly: response.choices is a list
             ai_response_content = response.choices[0].message.content
-            conversation_history.append({"role": "assistant", "content": ai_response_content})
-            logging.info(f"OpenAI chat response received (first 100 chars): '{ai_response_content[:100]}'...")
-            return ai_response_content, conversation_history
+            if key:
+                self.cache.put(key, ai_response_content, time.perf_counter() - started)
+            return self._chat_reply(ai_response_content, conversation_history)
+        except Exception as e:
+            return self._chat_error(e, conversation_history)
 
-        except OpenAIError as e: # Catch specific OpenAI API errors
-            logging.error(f"OpenAI API Error in get_chat_response: {e}")
-            return "I'm sorry, I encountered an issue with the AI service. Please check your API key and network connection.", conversation_history
+    async def get_chat_response_async(self, user_message: str, conversation_history: list = None):
+        """get_chat_response() on the async client; same prompts, same return value."""
+        conversation_history = self._chat_messages(user_message, conversation_history)
+        key = self._cache_key("chat", conversation_history, CHAT_SETTINGS)
+        cached = self.cache.get(key, "chat") if key else None
+        if cached is not None:
+            return self._chat_reply(cached, conversation_history)
+        try:
+            started = time.perf_counter()
+            with span("nlu", stage="chat"):
+                response = await self.async_client.chat.completions.create(
+                    messages=conversation_history,
+                    **CHAT_SETTINGS,
+                )
+            ai_response_content = response.choices[0].message.content
+            if key:
+                self.cache.put(key, ai_response_content, time.perf_counter() - started)
+            return self._chat_reply(ai_response_content, conversation_history)
         except Exception as e:
-            logging.error(f"General Error in get_chat_response: {e}", exc_info=True) # Log full traceback
-            return "I'm sorry, I'm having trouble understanding right now. Can you please try again?", conversation_history
+            return self._chat_error(e, conversation_history)
 
-    def extract_parameters(self, user_input: str, conversation_history: list = None) -> dict:
+    def _extraction_messages(self, user_input: str, conversation_history: list = None) -> list:
         # Sanitize the incoming user_input for parameter extraction
         user_input_sanitized = sanitize_text(user_input)
 
@@ -117,6 +208,9 @@ class NLUService:
             f"budget (float), use_case (string, e.g., 'gaming', 'productivity'), "
             f"aesthetic (string, e.g., 'RGB', 'minimalist'), monitor (boolean), keyboard (boolean), mouse (boolean), "
             f"and any other specific part requests (e.g., 'cpu_brand', 'gpu_brand'). "
+            f"If the user names specific parts, add part_requests (object mapping the category - one of "
+            f"'CPU', 'Motherboard', 'GPU', 'RAM', 'Storage', 'PSU', 'Case', 'Monitor' - to the part as the user wrote it, "
+            f"e.g., {{\"GPU\": \"RTX 4070\", \"CPU\": \"Ryzen 7800X3D\"}}). "
             f"If a parameter is not mentioned or clearly implied, omit it. "
             f"Only output the JSON object. If no parameters are found, output an empty JSON object {{}}."
             f"\n\nConversation History: {json.dumps(conversation_history[-3:] if conversation_history else [])}"
@@ -128,34 +222,79 @@ class NLUService:
             {"role": "user", "content": user_prompt_for_extraction}
         ]
 
-        logging.info(f"Attempting to extract parameters for user input: '{user_input_sanitized}'")
-        logging.debug(f"Prompt sent for extraction: {prompt_messages[-1]['content']}")
+        logger.info("Attempting to extract parameters (input %d chars)", len(user_input_sanitized))
+        logger.debug("Extraction prompt: %d chars", len(user_prompt_for_extraction))
+        return prompt_messages
 
+    def extract_parameters(self, user_input: str, conversation_history: list = None) -> dict:
+        prompt_messages = self._extraction_messages(user_input, conversation_history)
+        # The prompt holds the input and the trimmed (last 3 messages) history, so it is the key
+        key = self._cache_key("extract", prompt_messages, EXTRACTION_SETTINGS)
+        cached = self.cache.get(key, "extract") if key else None
+        if cached is not None:
+            record_nlu("extract", json.dumps(cached))
+            return cached
         try:
             # The prompt_messages list should now only contain already-sanitized strings
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=prompt_messages, # Use the list with pre-sanitized content
-                max_tokens=200,
-                temperature=0.0
-            )
+            started = time.perf_counter()
+            with span("nlu", stage="extract"):
+                response = self.client.chat.completions.create(
+                    messages=prompt_messages, # Use the list with pre-sanitized content
+                    **EXTRACTION_SETTINGS,
+                )
+        except Exception as e:
+            record_nlu("extract", error=type(e).__name__)
+            return self._extraction_error(e)
+        return self._parse_parameters(response, key, time.perf_counter() - started)
 
+    async def extract_parameters_async(self, user_input: str, conversation_history: list = None) -> dict:
+        """extract_parameters() on the async client."""
+        prompt_messages = self._extraction_messages(user_input, conversation_history)
+        key = self._cache_key("extract", prompt_messages, EXTRACTION_SETTINGS)
+        cached = self.cache.get(key, "extract") if key else None
+        if cached is not None:
+            record_nlu("extract", json.dumps(cached))
+            return cached
+        try:
+            started = time.perf_counter()
+            with span("nlu", stage="extract"):
+                response = await self.async_client.chat.completions.create(
+                    messages=prompt_messages,
+                    **EXTRACTION_SETTINGS,
+                )
+        except Exception as e:
+            record_nlu("extract", error=type(e).__name__)
+            return self._extraction_error(e)
+        return self._parse_parameters(response, key, time.perf_counter() - started)
+
+    def _extraction_error(self, e: Exception) -> dict:
+        from openai import OpenAIError
+
+        if isinstance(e, OpenAIError):
+            logger.error("OpenAI API Error in extract_parameters: %s", e)
+        else:
+            logger.error("General Error in extract_parameters: %s", e, exc_info=True)
+        return {}
+
+    def _parse_parameters(self, response, cache_key: str = None, seconds: float = 0.0) -> dict:
+        # Only successfully parsed parameters are cached; failures are retried on the next call
+        json_str = None
+        try:
             json_str = response.choices[0].message.content.strip()
-            logging.info(f"Raw GPT extraction response (first 100 chars): '{json_str[:100]}'...")
+            record_nlu("extract", json_str)
+            logger.info("Raw GPT extraction response (first 100 chars): %.100s", json_str)
 
             # Clean up potential markdown code block
             if json_str.startswith("```json"):
                 json_str = json_str.replace("```json\n", "").replace("\n```", "")
 
             parameters = json.loads(json_str)
-            logging.info(f"Successfully extracted parameters: {parameters}")
+            logger.info("Successfully extracted parameters: %s", parameters)
+            if cache_key:
+                self.cache.put(cache_key, parameters, seconds)
             return parameters
         except json.JSONDecodeError as e:
-            logging.error(f"JSON Decode Error in extract_parameters: {e}\nRaw GPT response was: '{json_str}'", exc_info=True)
-            return {}
-        except OpenAIError as e:
-            logging.error(f"OpenAI API Error in extract_parameters: {e}")
+            logger.error("JSON Decode Error in extract_parameters: %s\nRaw GPT response was: '%.500s'", e, json_str, exc_info=True)
             return {}
         except Exception as e:
-            logging.error(f"General Error in extract_parameters: {e}", exc_info=True)
-            return {}
\ No newline at end of file
+            return self._extraction_error(e)
\ No newline at end of file
@@ -3,8 +3,14 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from sqlalchemy.orm import Session
 from models import SavedBuild, BuildPart, Product, PriceEntry, User
+from services.catalog import load_current_prices
+from services.price_history import lowest_prices
 from config import Config
+from services.metrics import span
 from datetime import datetime, timedelta
+import logging
+
+logger = logging.getLogger(__name__)
 
 class NotificationService:
     def __init__(self, db: Session):
@@ -12,7 +18,7 @@ class NotificationService:
 
     def send_email(self, to_email: str, subject: str, body: str):
         if not Config.EMAIL_USER or not Config.EMAIL_PASSWORD:
-            print("Email credentials not configured. Skipping email send.")
+            logger.warning("Email credentials not configured. Skipping email send.")
             return
 
         msg = MIMEMultipart()
@@ -22,21 +28,27 @@ class NotificationService:
         msg.attach(MIMEText(body, 'plain'))
 
         try:
-            server = smtplib.SMTP(Config.EMAIL_HOST, Config.EMAIL_PORT)
-            server.starttls()  # Upgrade connection to secure TLS
-            server.login(Config.EMAIL_USER, Config.EMAIL_PASSWORD)
-            text = msg.as_string()
-            server.sendmail(Config.FROM_EMAIL, to_email, text)
-            server.quit()
-            print(f"Email sent to {to_email} for subject '{subject}'")
+            with span("notification", stage="send"):
+                server = smtplib.SMTP(Config.EMAIL_HOST, Config.EMAIL_PORT)
+                server.starttls()  # Upgrade connection to secure TLS
+                server.login(Config.EMAIL_USER, Config.EMAIL_PASSWORD)
+                text = msg.as_string()
+                server.sendmail(Config.FROM_EMAIL, to_email, text)
+                server.quit()
+            logger.info("Email sent to %s for subject '%s'", to_email, subject)
             return True
         except Exception as e:
-            print(f"Failed to send email to {to_email}: {e}")
+            logger.error("Failed to send email to %s: %s", to_email, e)
             return False
 
     def check_for_price_drops(self):
         saved_builds = self.db.query(SavedBuild).all()
         notification_sent_count = 0
+        # Current prices and period lows for every product at once, not per part
+        current_prices = load_current_prices(self.db)
+        period_lows = lowest_prices(
+            self.db, {part.product_id for build in saved_builds for part in build.parts}, days=Config.PRICE_LOW_WINDOW_DAYS,
+        )
 
         for build in saved_builds:
             user = build.user
@@ -51,10 +63,7 @@ class NotificationService:
                 product = build_part.product
                 if not product: continue
 
-                latest_price_entry = self.db.query(PriceEntry) \
-                    .filter(PriceEntry.product_id == product.id) \
-                    .order_by(PriceEntry.timestamp.desc(), PriceEntry.price.asc()) \
-                    .first()
+                latest_price_entry = current_prices.get(product.id)
 
                 if latest_price_entry:
                     current_build_cost += latest_price_entry.price
@@ -72,7 +81,8 @@ class NotificationService:
                             "old_price": build_part.recommended_price,
                             "new_price": latest_price_entry.price,
                             "retailer": latest_price_entry.retailer_name,
-                            "url": latest_price_entry.retailer_url
+                            "url": latest_price_entry.retailer_url,
+                            "period_low": latest_price_entry.price <= period_lows.get(product.id, latest_price_entry.price),
                         })
             self.db.commit()
 
@@ -89,7 +99,8 @@ class NotificationService:
                         f"  - Old Price: ${drop['old_price']:.2f}\n"
                         f"  - New Price: ${drop['new_price']:.2f} (a saving of ${drop['old_price'] - drop['new_price']:.2f}!)\n"
                         f"  - Retailer: {drop['retailer']}\n"
-                        f"  - Link: {drop['url']}\n\n"
+                        + (f"  - Lowest price in {Config.PRICE_LOW_WINDOW_DAYS} days!\n" if drop["period_low"] else "")
+                        + f"  - Link: {drop['url']}\n\n"
                     )
                 body += (
                     f"Log in to your account or visit our platform to review your updated build.\n\n"
@@ -101,7 +112,7 @@ class NotificationService:
                     self.db.add(build)
                     self.db.commit()
                     notification_sent_count += 1
-        print(f"Finished checking price drops. Sent {notification_sent_count} notifications.")
+        logger.info("Finished checking price drops. Sent %d notifications.", notification_sent_count)
 
 if __name__ == "__main__":
     from database import SessionLocal, create_db_and_tables
@@ -0,0 +1,209 @@
+# services/price_history.py
+
+import logging
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import delete, func, insert, update
+from sqlalchemy.orm import Session
+from config import Config
+from models import PriceEntry, PriceRollup
+
+logger = logging.getLogger(__name__)
+
+# A row's last observation: rows seen only once have no last_seen_at
+_SEEN_AT = func.coalesce(PriceEntry.last_seen_at, PriceEntry.timestamp)
+
+_DELETE_BATCH_SIZE = 1000 # Ids per DELETE ... WHERE id IN (...) statement
+
+
+def _naive(moment: datetime | None) -> datetime | None:
+    return moment.replace(tzinfo=None) if moment is not None else None
+
+
+def seen_at(entry: PriceEntry) -> datetime | None:
+    return _naive(entry.last_seen_at or entry.timestamp)
+
+
+def _newest_ids(db: Session, max_price_id: int = None):
+    # Rows are only inserted when a price changes, so the highest id per pair is its current price
+    newest = db.query(func.max(PriceEntry.id)).group_by(PriceEntry.product_id, PriceEntry.retailer_name)
+    if max_price_id is not None:
+        newest = newest.filter(PriceEntry.id <= max_price_id)
+    return newest.scalar_subquery()
+
+
+def latest_entries(db: Session, max_price_id: int = None) -> dict:
+    """Each retailer's current price row: {(product_id, retailer): PriceEntry}, optionally as of `max_price_id`."""
+    entries = db.query(PriceEntry).filter(PriceEntry.id.in_(_newest_ids(db, max_price_id))).all()
+    return {(entry.product_id, entry.retailer_name): entry for entry in entries}
+
+
+def record_prices(db: Session, rows: list, observed_at: datetime = None) -> tuple:
+    """
+    Writes scraped prices (PriceEntry column dicts). A price equal to the pair's current row
+    (same price and URL) only moves that row's last_seen_at; anything else starts a new row.
+    Doesn't commit. Returns (rows inserted, rows extended).
+    """
+    observed_at = observed_at or datetime.now()
+    current = {
+        (product_id, retailer): (entry_id, price, url)
+        for entry_id, product_id, retailer, price, url in db.query(
+            PriceEntry.id, PriceEntry.product_id, PriceEntry.retailer_name, PriceEntry.price, PriceEntry.retailer_url,
+        ).filter(PriceEntry.id.in_(_newest_ids(db)))
+    }
+    new_rows, extended = [], []
+    for row in rows:
+        entry = current.get((row["product_id"], row["retailer_name"]))
+        if entry is not None and round(entry[1], 2) == round(row["price"], 2) and entry[2] == row["retailer_url"]:
+            extended.append({"id": entry[0], "last_seen_at": observed_at})
+        else:
+            new_rows.append({**row, "timestamp": observed_at, "last_seen_at": observed_at})
+    if new_rows:
+        db.execute(insert(PriceEntry), new_rows) # One batched INSERT for the changed prices
+    if extended:
+        db.execute(update(PriceEntry), extended) # Bulk UPDATE by primary key
+    return len(new_rows), len(extended)
+
+
+def _rollup_days(db: Session, start: date, end: date, product_ids=None) -> dict:
+    """
+    Daily low/high/close from the raw rows for days in [start, end):
+    {(product_id, retailer, day): [low, high, close]}. A row counts on every day between its
+    first and last observation, so a price that held for a week shows up on each of its days.
+    """
+    start_at, end_at = datetime.combine(start, time.min), datetime.combine(end, time.min)
+    query = db.query(PriceEntry.product_id, PriceEntry.retailer_name, PriceEntry.price, PriceEntry.timestamp, _SEEN_AT) \
+        .filter(PriceEntry.timestamp < end_at, _SEEN_AT >= start_at)
+    if product_ids is not None:
+        query = query.filter(PriceEntry.product_id.in_(product_ids))
+
+    days = {} # key -> [low, high, close, first seen of the close row]
+    for product_id, retailer, price, first_seen, last_seen in query.yield_per(5000):
+        first_seen, last_seen = _naive(first_seen), _naive(last_seen)
+        day = max(first_seen.date(), start)
+        while day <= last_seen.date() and day < end:
+            key = (product_id, retailer, day)
+            current = days.get(key)
+            if current is None:
+                days[key] = [price, price, price, first_seen]
+            else:
+                current[0] = min(current[0], price)
+                current[1] = max(current[1], price)
+                if first_seen >= current[3]: # The later row is the one still valid at day end
+                    current[2], current[3] = price, first_seen
+            day += timedelta(days=1)
+    return {key: values[:3] for key, values in days.items()}
+
+
+def _rolled_up_through(db: Session) -> date | None:
+    return db.query(func.max(PriceRollup.day)).scalar()
+
+
+def compact_price_history(db: Session, now: datetime = None) -> dict:
+    """
+    Daily maintenance: rolls every complete day since the last run up into price_daily_rollups,
+    then applies retention. Raw rows whose last observation is older than
+    Config.PRICE_HISTORY_RAW_DAYS (and already rolled up) are deleted, except each pair's current
+    row; rollups older than Config.PRICE_ROLLUP_RETENTION_DAYS are deleted.
+    Days are rolled up Config.PRICE_ROLLUP_CHUNK_DAYS at a time, each chunk committed before the
+    next is read, so the first run over a large history holds one chunk in memory, and an
+    interrupted run resumes after the last committed day.
+    """
+    now = now or datetime.now()
+    today = now.date()
+    watermark = _rolled_up_through(db)
+    if watermark is not None:
+        start = watermark + timedelta(days=1)
+    else:
+        earliest = db.query(func.min(PriceEntry.timestamp)).scalar()
+        start = _naive(earliest).date() if earliest else today
+
+    # Days past rollup retention would be deleted again right away
+    start = max(start, today - timedelta(days=Config.PRICE_ROLLUP_RETENTION_DAYS))
+    chunk = timedelta(days=max(1, Config.PRICE_ROLLUP_CHUNK_DAYS))
+    rolled = 0
+    while start < today: # Complete days only; today is still being scraped
+        end = min(start + chunk, today)
+        rollups = _rollup_days(db, start, end)
+        db.execute(delete(PriceRollup).where(PriceRollup.day >= start, PriceRollup.day < end))
+        if rollups:
+            db.execute(insert(PriceRollup), [
+                {"product_id": product_id, "retailer_name": retailer, "day": day, "low": low, "high": high, "close": close}
+                for (product_id, retailer, day), (low, high, close) in rollups.items()
+            ])
+        db.commit() # The watermark (newest rollup day) moves with each chunk
+        rolled += len(rollups)
+        watermark = end - timedelta(days=1)
+        start = end
+
+    raw_deleted = 0
+    if watermark is not None:
+        # Only rows whose whole interval is rolled up; never a pair's current price
+        raw_cutoff = min(
+            datetime.combine(today - timedelta(days=Config.PRICE_HISTORY_RAW_DAYS), time.min),
+            datetime.combine(watermark + timedelta(days=1), time.min),
+        )
+        # Ids are selected first: MySQL rejects a DELETE whose subquery reads the same table (error 1093)
+        expired = [
+            entry_id for (entry_id,) in
+            db.query(PriceEntry.id).filter(_SEEN_AT < raw_cutoff, PriceEntry.id.not_in(_newest_ids(db)))
+        ]
+        for offset in range(0, len(expired), _DELETE_BATCH_SIZE):
+            raw_deleted += db.execute(
+                delete(PriceEntry).where(PriceEntry.id.in_(expired[offset:offset + _DELETE_BATCH_SIZE]))
+                .execution_options(synchronize_session=False)
+            ).rowcount
+    rollups_deleted = db.execute(
+        delete(PriceRollup).where(PriceRollup.day < today - timedelta(days=Config.PRICE_ROLLUP_RETENTION_DAYS))
+    ).rowcount
+    db.commit()
+    logger.info(
+        "Price history compacted: %d daily rollups written, %d raw rows and %d rollups past retention deleted.",
+        rolled, raw_deleted, rollups_deleted,
+    )
+    return {"rollups_written": rolled, "raw_deleted": raw_deleted, "rollups_deleted": rollups_deleted}
+
+
+def lowest_prices(db: Session, product_ids, days: int = 30, now: datetime = None) -> dict:
+    """
+    {product_id: lowest price at any retailer over the last `days` days}, e.g. for "30-day low"
+    alerts. Complete days come from the rollups; only days not rolled up yet read raw rows.
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+    now = now or datetime.now()
+    since = now.date() - timedelta(days=days)
+    watermark = _rolled_up_through(db)
+    lows = dict(
+        db.query(PriceRollup.product_id, func.min(PriceRollup.low))
+        .filter(PriceRollup.product_id.in_(product_ids), PriceRollup.day >= since)
+        .group_by(PriceRollup.product_id).all()
+    )
+    raw_since = datetime.combine(max(since, watermark + timedelta(days=1)) if watermark else since, time.min)
+    for product_id, low in db.query(PriceEntry.product_id, func.min(PriceEntry.price)) \
+            .filter(PriceEntry.product_id.in_(product_ids), _SEEN_AT >= raw_since) \
+            .group_by(PriceEntry.product_id):
+        lows[product_id] = min(low, lows.get(product_id, low))
+    return lows
+
+
+def daily_history(db: Session, product_id: int, days: int = 90, now: datetime = None) -> dict:
+    """
+    Price chart data: {retailer: [(day, low, high, close), ...]} for the last `days` days, oldest
+    first. Stored rollups, plus the days since the last compaction computed on the fly.
+    """
+    now = now or datetime.now()
+    today = now.date()
+    since = today - timedelta(days=days)
+    series = defaultdict(dict)
+    for rollup in db.query(PriceRollup).filter(PriceRollup.product_id == product_id, PriceRollup.day >= since):
+        series[rollup.retailer_name][rollup.day] = (rollup.low, rollup.high, rollup.close)
+    watermark = _rolled_up_through(db)
+    pending_start = max(since, watermark + timedelta(days=1)) if watermark else since
+    for (_, retailer, day), values in _rollup_days(db, pending_start, today + timedelta(days=1), product_ids=[product_id]).items():
+        series[retailer][day] = tuple(values)
+    return {
+        retailer: [(day, *values) for day, values in sorted(points.items())]
+        for retailer, points in series.items()
+    }
@@ -0,0 +1,305 @@
+# services/product_search.py
+
+import bisect
+import heapq
+import logging
+import math
+import re
+import threading
+from collections import defaultdict
+from sqlalchemy.orm import Session
+from services.catalog import Catalog, load_catalog
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_ALPHA_NUMERIC_RUN = re.compile(r"[a-z]+|[0-9]+")
+
+# Field weights: model numbers ("7800X3D", "RTX 4070") are what users name parts by
+FIELD_WEIGHTS = (("name", 1.0), ("brand", 1.0), ("model", 2.0))
+PREFIX_FACTOR = 0.6 # "780" -> "7800x3d"
+FUZZY_MIN_SIMILARITY = 0.45 # Trigram Jaccard similarity for typo matches ("radeonn" -> "radeon")
+MAX_EXPANSIONS = 20 # Vocabulary tokens a single prefix/fuzzy query token may expand to
+# Tokens in more products than this ("gaming", "asus") only re-rank products found through
+# rarer tokens instead of pulling in every product they occur in
+COMMON_TOKEN_POSTINGS = 500
+
+
+def tokenize(text) -> list:
+    return _TOKEN.findall(str(text or "").lower())
+
+
+def _trigrams(token: str) -> set:
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _document(product) -> dict:
+    """token -> weight for one product."""
+    weights = {}
+    for field, weight in FIELD_WEIGHTS:
+        for token in tokenize(getattr(product, field, "")):
+            weights[token] = max(weights.get(token, 0.0), weight)
+    return weights
+
+
+class ProductSearchIndex:
+    """
+    In-memory inverted index over product name, brand and model.
+    Exact token matches are weighted by field and IDF; query tokens without an exact match
+    expand to vocabulary tokens they prefix, then to tokens with similar trigrams (typos,
+    "rtx4070" vs "RTX 4070"); a run-together token with a typo in one run ("4070tl") matches
+    its runs on their own. Fuzzy matching works on the vocabulary, not the products,
+    so query cost grows with distinct tokens rather than catalog size. Queries of common
+    tokens only read their products best first, from a per-token ranking built on first use.
+    Kept in sync with the catalog incrementally (see sync()).
+    """
+
+    def __init__(self):
+        self.version = None
+        self._lock = threading.RLock()
+        self._docs = {} # product id -> (signature, category, {token: weight})
+        self._postings = defaultdict(dict) # token -> {product id: weight}
+        self._token_grams = defaultdict(set) # trigram -> vocabulary tokens containing it
+        self._sorted_vocab = None # Rebuilt lazily for prefix lookups after the vocabulary changes
+        self._norms = {} # product id -> length normalization of its score
+        self._ranked = {} # common token -> [(weight * norm, product id), ...] best first, built on first use
+        self._weight_ranges = {} # common token -> (min, max) weight over its products, computed on first use
+
+    def __len__(self):
+        return len(self._docs)
+
+    def sync(self, products, version=None) -> tuple:
+        """
+        Brings the index in line with `products`, touching only products that were added,
+        removed or renamed. Returns (added or updated count, removed count).
+        """
+        with self._lock:
+            seen, changed = set(), 0
+            for product in products:
+                seen.add(product.id)
+                signature = (product.name, product.brand, product.model, product.category)
+                current = self._docs.get(product.id)
+                if current is not None and current[0] == signature:
+                    continue
+                if current is not None:
+                    self._remove(product.id)
+                self._add(product, signature)
+                changed += 1
+            removed = [product_id for product_id in self._docs if product_id not in seen]
+            for product_id in removed:
+                self._remove(product_id)
+            self.version = version
+        if changed or removed:
+            logger.info("Product search index synced: %d added/updated, %d removed, %d indexed.", changed, len(removed), len(self._docs))
+        return changed, len(removed)
+
+    def _add(self, product, signature: tuple):
+        weights = _document(product)
+        self._docs[product.id] = (signature, product.category, weights)
+        # Prefer tighter matches: "4070" ranks "RTX 4070" above "RTX 4070 Ti SUPER"
+        self._norms[product.id] = 1 / (1 + 0.1 * len(weights))
+        for token, weight in weights.items():
+            self._ranked.pop(token, None)
+            self._weight_ranges.pop(token, None)
+            if token not in self._postings:
+                self._sorted_vocab = None
+                for gram in _trigrams(token):
+                    self._token_grams[gram].add(token)
+            self._postings[token][product.id] = weight
+
+    def _remove(self, product_id: int):
+        _, _, weights = self._docs.pop(product_id)
+        del self._norms[product_id]
+        for token in weights:
+            self._ranked.pop(token, None)
+            self._weight_ranges.pop(token, None)
+            postings = self._postings[token]
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[token]
+                self._sorted_vocab = None
+                for gram in _trigrams(token):
+                    grams = self._token_grams[gram]
+                    grams.discard(token)
+                    if not grams:
+                        del self._token_grams[gram]
+
+    def _expand(self, token: str) -> list:
+        """(vocabulary token, factor) pairs a query token matches."""
+        if token in self._postings:
+            return [(token, 1.0)]
+        parts = _ALPHA_NUMERIC_RUN.findall(token)
+        if len(parts) > 1 and all(part in self._postings for part in parts):
+            return [(part, 1.0) for part in parts] # Run-together "rtx4070" -> "rtx", "4070"
+        if self._sorted_vocab is None:
+            self._sorted_vocab = sorted(self._postings)
+        vocab = self._sorted_vocab
+        expansions = []
+        start = bisect.bisect_left(vocab, token)
+        for candidate in vocab[start:start + MAX_EXPANSIONS]:
+            if not candidate.startswith(token):
+                break
+            expansions.append((candidate, PREFIX_FACTOR))
+        if expansions:
+            return expansions
+        expansions = self._fuzzy(token)
+        if expansions or len(parts) < 2:
+            return expansions
+        # A typo in one run of a run-together token ("4070tl"): match the runs on their own
+        return [expansion for part in parts for expansion in self._expand(part)]
+
+    def _fuzzy(self, token: str) -> list:
+        # Similarity >= FUZZY_MIN_SIMILARITY needs at least `needed` shared trigrams, so any match
+        # shares one of the len(grams) - needed + 1 rarest ones: only those generate candidates,
+        # the common grams (" rt", "rtx") are checked per candidate.
+        grams = sorted(_trigrams(token), key=lambda gram: len(self._token_grams.get(gram, ())))
+        needed = max(1, math.ceil(FUZZY_MIN_SIMILARITY * len(grams)))
+        generating = len(grams) - needed + 1
+        candidates = set()
+        for gram in grams[:generating]:
+            candidates.update(self._token_grams.get(gram, ()))
+        shared = {candidate: 0 for candidate in candidates}
+        for gram in grams:
+            tokens_with_gram = self._token_grams.get(gram, ())
+            for candidate in candidates:
+                if candidate in tokens_with_gram:
+                    shared[candidate] += 1
+        scored = []
+        for candidate, count in shared.items():
+            # A token of length n has (at most) n padded trigrams
+            similarity = count / (len(grams) + len(candidate) - count)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                scored.append((similarity, candidate))
+        scored.sort(reverse=True)
+        return [(candidate, similarity) for similarity, candidate in scored[:MAX_EXPANSIONS]]
+
+    def _ranking(self, token: str) -> list:
+        """[(weight * norm, product id), ...] for a token's products, best first."""
+        ranked = self._ranked.get(token)
+        if ranked is None:
+            ranked = self._ranked[token] = sorted(
+                ((weight * self._norms[product_id], product_id) for product_id, weight in self._postings[token].items()),
+                key=lambda item: (-item[0], item[1]),
+            )
+        return ranked
+
+    def _weight_range(self, token: str) -> tuple:
+        weight_range = self._weight_ranges.get(token)
+        if weight_range is None:
+            weights = self._postings[token].values()
+            weight_range = self._weight_ranges[token] = (min(weights), max(weights))
+        return weight_range
+
+    def _search_common(self, matches: list, category: str, limit: int) -> list:
+        """
+        search() when every token is common: the most selective one generates the candidates,
+        read from its ranking best first. Reading stops once no later product can reach the
+        current top `limit`, so a one-token query like "4070" reads about `limit` products.
+        """
+        generator, _, boost = min(matches, key=lambda match: len(match[1]))
+        others = [(token, postings, other_boost) for token, postings, other_boost in matches if token != generator]
+        # A later product's score is at most key * boost + key * others_bound: its norm is at most
+        # key / (the generator's lowest weight), and it has at most each other token's highest weight.
+        # Computed like the scores below, so a product matching everything at those weights ties exactly.
+        others_bound = 0.0
+        for token, _, other_boost in others:
+            others_bound += self._weight_range(token)[1] * other_boost
+        others_bound /= self._weight_range(generator)[0]
+        lookups = [(postings.get, other_boost) for _, postings, other_boost in others]
+        top = [] # Min-heap of (score, -product id): the worst result kept is first
+        for key, product_id in self._ranking(generator):
+            # Later products have a lower key, or the same key and a higher id, so none can enter either
+            if len(top) == limit and (key * boost + key * others_bound, -product_id) < top[0]:
+                break
+            if category and self._docs[product_id][1] != category:
+                continue
+            other_score = 0.0
+            for weight_of, other_boost in lookups:
+                other_score += weight_of(product_id, 0.0) * other_boost
+            score = key * boost + self._norms[product_id] * other_score
+            if len(top) < limit:
+                heapq.heappush(top, (score, -product_id))
+            elif (score, -product_id) > top[0]:
+                heapq.heapreplace(top, (score, -product_id))
+        return [(-negated_id, score) for score, negated_id in sorted(top, reverse=True)]
+
+    def search(self, query: str, category: str = None, limit: int = 10) -> list:
+        """Returns up to `limit` (product id, score) pairs, best first."""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens or limit <= 0:
+            return []
+        with self._lock:
+            total = len(self._docs) or 1
+            matches = [] # (vocabulary token, postings, factor * idf)
+            for token in tokens:
+                for candidate, factor in self._expand(token):
+                    postings = self._postings[candidate]
+                    matches.append((candidate, postings, factor * math.log(1 + total / len(postings))))
+            if not matches:
+                return []
+            # Rare tokens generate the candidates, common ones only add to their scores
+            generating = [match for match in matches if len(match[1]) <= COMMON_TOKEN_POSTINGS]
+            if not generating:
+                return self._search_common(matches, category, limit)
+            generating_tokens = {token for token, _, _ in generating}
+            scores = defaultdict(float)
+            for _, postings, boost in generating:
+                for product_id, weight in postings.items():
+                    scores[product_id] += weight * boost
+            for token, postings, boost in matches:
+                if token in generating_tokens:
+                    continue
+                for product_id in scores:
+                    weight = postings.get(product_id)
+                    if weight:
+                        scores[product_id] += weight * boost
+            results = []
+            for product_id, score in scores.items():
+                if category and self._docs[product_id][1] != category:
+                    continue
+                results.append((product_id, score * self._norms[product_id]))
+        return heapq.nsmallest(limit, results, key=lambda item: (-item[1], item[0]))
+
+
+_index = ProductSearchIndex()
+_sync_lock = threading.Lock()
+
+
+def get_search_index(db: Session, catalog: Catalog = None) -> ProductSearchIndex:
+    """The process-wide index, synced when the catalog's products change (not its prices)."""
+    catalog = catalog or load_catalog(db)
+    if _index.version != catalog.product_version:
+        with _sync_lock:
+            if _index.version != catalog.product_version:
+                _index.sync(catalog.products.values(), catalog.product_version)
+    return _index
+
+
+def search_products(db: Session, query: str, category: str = None, limit: int = 10) -> list:
+    """Returns [(Product, score), ...] for a free-text part query, best first."""
+    catalog = load_catalog(db)
+    hits = get_search_index(db, catalog).search(query, category=category, limit=limit)
+    return [(catalog.products[product_id], score) for product_id, score in hits if product_id in catalog.products]
+
+
+def resolve_part_requests(db: Session, part_requests: dict) -> dict:
+    """
+    Resolves named parts from the conversation ({"GPU": "4070", "CPU": "Ryzen 7800X3D"})
+    to pinned product ids for recommend_build ({"GPU": 12, "CPU": 3}).
+    Requests that match nothing in their category are dropped.
+    """
+    catalog = load_catalog(db)
+    index = get_search_index(db, catalog)
+    categories = {category.lower(): category for category in catalog.by_category}
+    pinned = {}
+    for requested_category, query in (part_requests or {}).items():
+        category = categories.get(str(requested_category).lower())
+        if category is None or not isinstance(query, str) or not query.strip():
+            continue
+        hits = index.search(query, category=category, limit=1)
+        if hits:
+            pinned[category] = hits[0][0]
+        else:
+            logger.info("No %s matches the requested part '%.100s'.", category, query)
+    return pinned
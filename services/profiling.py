@@ -0,0 +1,191 @@
+# services/profiling.py
+
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from config import Config
+from services.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PROFILES_WRITTEN = REGISTRY.counter("pc_agent_profiles_written_total", "Profiles written to disk.", ("tag", "mode"))
+PROFILER_SELF_SECONDS = REGISTRY.counter(
+    "pc_agent_profiler_self_seconds_total", "Time spent by the profiler itself (stack sampling + writing files).", ("mode",)
+)
+# Compare the mean of profiled="true" vs "false" to see the overhead on profiled runs
+PROFILED_RUN_SECONDS = REGISTRY.histogram("pc_agent_profiled_run_seconds", "Run duration by profiling state.", ("tag", "profiled"))
+
+
+class ProfilerSettings:
+    """
+    Runtime-adjustable profiler settings. Set from Config at startup, then either updated in-process
+    (the /debug/profiling endpoint) or from PROFILING_CONTROL_FILE, a JSON file re-read when it changes,
+    which toggles every worker and scheduled task at once without a restart.
+    """
+
+    def __init__(self):
+        self.sample_rate = Config.PROFILING_SAMPLE_RATE
+        self.mode = Config.PROFILING_MODE # "stack" (collapsed stacks) or "pstats" (cProfile)
+        self.stack_interval = Config.PROFILING_STACK_INTERVAL_MS / 1000.0
+        self.output_dir = Config.PROFILING_OUTPUT_DIR
+        self.max_files = Config.PROFILING_MAX_FILES
+        self._control_mtime = None
+        self._checked_at = 0.0
+
+    def update(self, **changes):
+        for key in ("sample_rate", "mode", "stack_interval", "output_dir", "max_files"):
+            if changes.get(key) is not None:
+                setattr(self, key, type(getattr(self, key))(changes[key]))
+        self.sample_rate = min(max(self.sample_rate, 0.0), 1.0)
+        if self.mode not in ("stack", "pstats"):
+            self.mode = "stack"
+
+    def refresh(self):
+        """Re-reads the control file, at most once a second."""
+        path = Config.PROFILING_CONTROL_FILE
+        now = time.monotonic()
+        if not path or now - self._checked_at < 1.0:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(path)
+            if mtime == self._control_mtime:
+                return
+            with open(path) as f:
+                self.update(**json.load(f))
+            self._control_mtime = mtime
+            logger.info("Profiler settings reloaded from %s: sample_rate=%s, mode=%s", path, self.sample_rate, self.mode)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning("Ignoring invalid profiler control file %s: %s", path, e)
+
+    def as_dict(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "mode": self.mode,
+            "stack_interval": self.stack_interval,
+            "output_dir": self.output_dir,
+            "max_files": self.max_files,
+        }
+
+
+settings = ProfilerSettings()
+
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's Python stack every `interval` seconds into collapsed-stack counts."""
+
+    def __init__(self, target_thread_id: int, interval: float):
+        super().__init__(daemon=True, name="pc-agent-stack-sampler")
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.self_seconds = 0.0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            start = time.perf_counter()
+            frame = sys._current_frames().get(self.target_thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if frames:
+                self.stacks[";".join(reversed(frames))] += 1
+            self.self_seconds += time.perf_counter() - start
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class ProfileRun:
+    """One sampled run. Call stop() with the final tag to write the profile."""
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.started = time.perf_counter()
+        self._profiler = None
+        self._sampler = None
+        if mode == "pstats":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._sampler = _StackSampler(threading.get_ident(), settings.stack_interval)
+            self._sampler.start()
+
+    def stop(self, tag: str) -> str | None:
+        duration = time.perf_counter() - self.started
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self._sampler is not None:
+            self._sampler.stop()
+
+        write_start = time.perf_counter()
+        path = None
+        try:
+            path = self._write(tag, duration)
+        except OSError as e:
+            logger.warning("Failed to write profile for %s: %s", tag, e)
+        self_seconds = time.perf_counter() - write_start + (self._sampler.self_seconds if self._sampler else 0.0)
+        PROFILER_SELF_SECONDS.inc(self_seconds, mode=self.mode)
+        return path
+
+    def _write(self, tag: str, duration: float) -> str | None:
+        os.makedirs(settings.output_dir, exist_ok=True)
+        if len(os.listdir(settings.output_dir)) >= settings.max_files:
+            return None # Bounded disk usage; clear the directory to resume
+        safe_tag = re.sub(r"[^A-Za-z0-9_.-]+", "_", tag)
+        extension = "pstats" if self.mode == "pstats" else "collapsed"
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{safe_tag}_{duration * 1000:.0f}ms.{extension}"
+        path = os.path.join(settings.output_dir, filename)
+        tmp_path = path + ".tmp"
+        if self.mode == "pstats":
+            self._profiler.dump_stats(tmp_path)
+        else:
+            # flamegraph.pl / speedscope compatible: "frame;frame;frame count"
+            with open(tmp_path, "w") as f:
+                for stack, count in self._sampler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        os.replace(tmp_path, path)
+        PROFILES_WRITTEN.inc(tag=tag, mode=self.mode)
+        return path
+
+
+def maybe_start_profile() -> ProfileRun | None:
+    """Starts profiling the current thread for a sampled fraction of calls."""
+    settings.refresh()
+    if settings.sample_rate <= 0 or random.random() >= settings.sample_rate:
+        return None
+    try:
+        return ProfileRun(settings.mode)
+    except ValueError as e: # e.g. another cProfile is already active in this process
+        logger.debug("Skipping profile sample: %s", e)
+        return None
+
+
+def finish_profile(run: ProfileRun | None, tag: str, duration: float) -> str | None:
+    PROFILED_RUN_SECONDS.observe(duration, tag=tag, profiled="true" if run else "false")
+    return run.stop(tag) if run is not None else None
+
+
+@contextmanager
+def profile(tag: str):
+    """Profiles a block (e.g. a scheduled task) when sampled."""
+    start = time.perf_counter()
+    run = maybe_start_profile()
+    try:
+        yield
+    finally:
+        finish_profile(run, tag, time.perf_counter() - start)
@@ -1,326 +1,401 @@
 # services/recommendation_service.py
 
+import json
 import logging
 from sqlalchemy.orm import Session
 from sqlalchemy import func # Import func for potential future use (e.g., aggregations)
 from models import Product, PriceEntry # Ensure all necessary models are imported
+from services.catalog import Catalog, load_catalog
+from services.metrics import span
+from services.single_flight import get_flight
 import random # <--- ADDED: Required for random.uniform
 
-# Configure logging for the recommendation service
-# Using INFO level by default, you can change to DEBUG for more verbose output
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Handlers/format are set up once by logging_config.configure_logging();
+# per-selection lines are rate limited there (LOG_RATE_LIMITS)
+logger = logging.getLogger(__name__)
+
+
+def _normalized(value) -> str | None:
+    # Canonical form of request inputs for single-flight keys: unset preferences don't matter
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        value = {key: item for key, item in value.items() if item is not None}
+    return json.dumps(value, sort_keys=True, default=str)
+
 
 class RecommendationService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, rng: random.Random = None):
         self.db = db
-        logging.info("RecommendationService initialized.")
+        self.rng = rng or random # Pass a seeded random.Random for reproducible budget splits
+        self._catalog = None # Loaded lazily, shared across requests per catalog version
+        logger.info("RecommendationService initialized.")
 
     def get_lowest_price_for_product(self, product_id: int):
         """
-        Gets the latest lowest price for a specific product from available PriceEntry records.
+        Gets the latest lowest price for a specific product.
+        Prices are preloaded with the catalog, so this is a dictionary lookup, not a query.
         """
-        latest_price_entry = self.db.query(PriceEntry) \
-            .filter(PriceEntry.product_id == product_id) \
-            .order_by(PriceEntry.timestamp.desc(), PriceEntry.price.asc()) \
-            .first()
+        latest_price_entry = self.catalog.lowest_price(product_id)
         if latest_price_entry:
-            logging.debug(f"Found lowest price for product_id {product_id}: ${latest_price_entry.price} at {latest_price_entry.retailer_name}")
+            logger.debug("Found lowest price for product_id %s: $%s at %s", product_id, latest_price_entry.price, latest_price_entry.retailer_name)
         else:
-            logging.warning(f"No price entries found for product_id {product_id}.")
+            logger.warning("No price entries found for product_id %s.", product_id)
         return latest_price_entry # Returns PriceEntry object or None
 
-    def get_compatible_parts(self, category: str, requirements: dict):
+    @property
+    def catalog(self) -> Catalog:
+        if self._catalog is None:
+            with span("recommend", stage="catalog"):
+                self._catalog = load_catalog(self.db)
+        return self._catalog
+
+    def get_compatible_parts(self, category: str, selected_parts: dict, candidate_ids=None):
         """
-        Filters products by category and basic compatibility requirements.
-        Removes .astext for MySQL compatibility when querying JSON fields.
+        Returns the products in `category` compatible with the already selected parts
+        (category -> Product), using the precomputed compatibility index.
+        `candidate_ids` optionally narrows the result further (e.g. a wattage range).
         """
-        query = self.db.query(Product).filter(Product.category == category)
-        logging.debug(f"Filtering {category} with requirements: {requirements}")
-
-        # --- FIX: Removed .astext for MySQL JSON field comparisons ---
-        if category == "CPU" and requirements.get("socket"):
-            query = query.filter(Product.specs["socket"] == requirements["socket"])
-        if category == "Motherboard" and requirements.get("socket"):
-            query = query.filter(Product.specs["socket"] == requirements["socket"])
-        if category == "RAM" and requirements.get("ram_type"):
-            query = query.filter(Product.specs["ram_type"] == requirements["ram_type"])
-
-        # Add more compatibility rules as needed, e.g., Motherboard form factor, Case compatibility with MB/GPU size
-        # Example for motherboard form factor matching case:
-        if category == "Case" and requirements.get("mb_form_factor"):
-            # This would require your case specs to have a list of supported form factors
-            # e.g., Product(..., specs={"supported_mb_form_factors": ["ATX", "Micro-ATX"]})
-            # For simplicity, for MVP we might only filter by general size if a case supports ATX
-            logging.debug(f"Attempting to filter cases by MB form factor {requirements['mb_form_factor']} - (not fully implemented in MVP for cases)")
-
-
-        compatible_products = query.all()
-        logging.debug(f"Found {len(compatible_products)} compatible {category} products.")
+        index = self.catalog.compatibility
+        compatible_ids = index.compatible_ids(category, selected_parts)
+        if candidate_ids is not None:
+            compatible_ids = compatible_ids & candidate_ids
+        compatible_products = self.catalog.products_in(category, compatible_ids)
+        logger.debug("Found %d compatible %s products.", len(compatible_products), category)
         return compatible_products
 
-    def recommend_build(self, user_prefs: dict) -> dict | None:
+    # Category -> (preference keys the stage depends on besides the budget, upstream categories it depends on).
+    # Used by incremental re-recommendation to decide which stages must be re-solved.
+    STAGE_INPUTS = {
+        "CPU": (("use_case",), ()),
+        "Motherboard": ((), ("CPU",)),
+        "GPU": (("use_case",), ()),
+        "RAM": (("use_case",), ("Motherboard",)),
+        "Storage": ((), ()),
+        "PSU": ((), ("CPU", "GPU")),
+        "Case": (("aesthetic",), ("Motherboard", "GPU")),
+        "Monitor": (("monitor", "monitor_resolution", "monitor_refresh_rate"), ()),
+    }
+
+    def recommend_build(self, user_prefs: dict, previous_build: dict = None) -> dict | None:
         """
         Recommends a complete PC build based on user preferences and budget.
         Prioritizes gaming/productivity scores and ensures compatibility.
+
+        Identical requests (same preferences, previous build and catalog version) running at the
+        same time are solved once and share the result (services.single_flight); a service with a
+        seeded `rng` always solves on its own, so its results stay reproducible.
+
+        When `previous_build` (a build_to_dict() result) is given, works incrementally:
+        stages whose constraints didn't change keep their previous part, and stages that only
+        saw a budget change switch parts only for an upgrade or when the old part no longer fits.
+
+        `user_prefs["pinned_parts"]` ({category: product_id}, see product_search.resolve_part_requests)
+        forces specific parts: their price is set aside up front and the other stages are
+        picked to be compatible with them. When no build fits the pinned parts, the build is solved
+        without them and the result's "dropped_pins" lists them.
         """
+        if self.rng is not random:
+            return self._solve_build(user_prefs, previous_build)
+        key = (self.catalog.version, _normalized(user_prefs), _normalized(previous_build))
+        result = get_flight("recommendation").do(key, lambda: self._solve_build(user_prefs, previous_build))
+        if result is None:
+            return None
+        return {**result, "user_preferences": user_prefs} # The caller's own preferences, not the leader's
+
+    def _solve_build(self, user_prefs: dict, previous_build: dict = None) -> dict | None:
         budget = user_prefs.get("budget")
         use_case = user_prefs.get("use_case", "general") # gaming, productivity, general
         aesthetic = user_prefs.get("aesthetic")
         include_monitor = user_prefs.get("monitor", False)
-        monitor_resolution = user_prefs.get("monitor_resolution") # e.g., "1440p"
-        monitor_refresh_rate = user_prefs.get("monitor_refresh_rate") # e.g., 144
 
-        logging.info(f"Starting recommendation for budget=${budget}, use_case='{use_case}', aesthetic='{aesthetic}', monitor={include_monitor}")
+        logger.info("Starting recommendation for budget=$%s, use_case='%s', aesthetic='%s', monitor=%s, incremental=%s",
+                    budget, use_case, aesthetic, include_monitor, previous_build is not None)
 
         if not budget or budget <= 0:
-            logging.warning("Budget not provided or invalid. Cannot recommend build.")
+            logger.warning("Budget not provided or invalid. Cannot recommend build.")
             return None
 
+        previous_prefs = (previous_build or {}).get("user_preferences") or {}
+        previous_parts = {part["category"]: part["product_id"] for part in (previous_build or {}).get("parts", [])}
+
+        self.catalog # Load (or reuse) the catalog up front so it isn't billed to the first stage
+        pinned_parts = self._pinned_parts(user_prefs)
+        # What the pins leave possible for every stage, including ones they only reach through another
+        narrowed = self.catalog.compatibility.narrowed_ids(pinned_parts)
+        reserved = sum(self.get_lowest_price_for_product(product.id).price for product in pinned_parts.values())
         recommended_parts = {}
+        selected_parts = {} # category -> Product, drives the compatibility index rules
+        kept_categories = set() # Categories that kept their previous part
         total_cost = 0
 
         # --- Component Selection Logic ---
         # This is a heuristic-based selection. For better results,
         # you'd need more sophisticated optimization.
+        # Each stage gets a share of the remaining budget: (category, share, rank candidates, required)
+        stages = [
+            ("CPU", lambda: self.rng.uniform(0.15, 0.30), self._rank_cpus, True), # ~15-30% of budget
+            ("Motherboard", lambda: self.rng.uniform(0.10, 0.20), self._rank_motherboards, True),
+            ("GPU", lambda: 0.45 if use_case == "gaming" else 0.25, self._rank_gpus, True), # Highest priority for gaming
+            ("RAM", lambda: self.rng.uniform(0.05, 0.10), self._rank_rams, True),
+            ("Storage", lambda: self.rng.uniform(0.05, 0.10), self._rank_ssds, True),
+            ("PSU", lambda: self.rng.uniform(0.05, 0.08), self._rank_psus, True),
+            # For MVP we allow a build without a case if the budget is tight, but a real build needs one
+            ("Case", lambda: self.rng.uniform(0.03, 0.07), self._rank_cases, False),
+        ]
+        if include_monitor or "Monitor" in pinned_parts: # Peripherals - if requested and budget allows
+            stages.append(("Monitor", lambda: self.rng.uniform(0.05, 0.15), self._rank_monitors, False))
+
+        for category, share, rank_candidates, required in stages:
+            with span("recommend", stage=category):
+                pinned = pinned_parts.get(category)
+                if pinned is not None:
+                    reserved -= self.get_lowest_price_for_product(pinned.id).price
+                remaining = budget - total_cost - reserved
+                # Pinned parts downstream constrain this stage too (e.g. a requested GPU's length limits the case)
+                constraints = {**narrowed, **pinned_parts, **selected_parts}
+                if pinned is not None:
+                    # A requested part skips the ranking filters and budget share, it only has to fit
+                    candidates = self.get_compatible_parts(category, constraints, frozenset((pinned.id,)))
+                    budget_max, mode = remaining, None
+                else:
+                    budget_max = remaining * share()
+                    candidates = rank_candidates(user_prefs, constraints)
+                    mode = self._reuse_mode(category, user_prefs, previous_prefs, previous_parts, kept_categories)
+                logger.debug("Considering %d %s candidates for up to $%.2f", len(candidates), category, budget_max)
+                choice = self._pick(candidates, budget_max, remaining, previous_parts.get(category), mode)
+            if choice is None:
+                if required:
+                    logger.warning("Failed to select a %s within budget allocation and compatibility.", category)
+                    return self._full_solve_fallback(user_prefs, previous_build)
+                logger.warning("Failed to select a %s within budget.", category)
+                continue
+
+            product, price_entry = choice
+            if product.id == previous_parts.get(category) and (mode is not None or pinned is not None):
+                kept_categories.add(category)
+            # budget_max: what the stage could spend, so tier refreshes can tell which price drops matter
+            recommended_parts[category] = {"product": product, "price_entry": price_entry, "budget_max": budget_max}
+            selected_parts[category] = product
+            total_cost += price_entry.price
+            logger.info("Selected %s: %s for $%.2f. Running total: $%.2f", category, product.name, price_entry.price, total_cost)
 
-        selected_cpu = None
-        selected_mb = None
-        selected_gpu = None
-        selected_ram = None
-        selected_storage = None
-        selected_psu = None
-        selected_case = None
-        selected_monitor = None # For peripheral
+        # Final Check: if total_cost is too high, return None or suggest cutting corners
+        if total_cost > budget:
+            logger.warning("Final build cost ($%.2f) exceeds budget ($%.2f). Returning None.", total_cost, budget)
+            return self._full_solve_fallback(user_prefs, previous_build) # Or implement logic to reduce price by swapping parts
 
-        compat_reqs = {} # Will be updated with socket, RAM type etc.
+        # Ensure a minimal build is complete (CPU, MB, GPU, RAM, Storage, PSU)
+        required_categories = {"CPU", "Motherboard", "GPU", "RAM", "Storage", "PSU"}
+        if not required_categories.issubset(recommended_parts.keys()):
+            logger.warning("Required core components not all selected. Missing: %s. Returning None.", required_categories - recommended_parts.keys())
+            return None
 
-        # 1. CPU Selection (Allocate ~15-30% of budget)
-        cpu_budget_max = budget * random.uniform(0.15, 0.30)
-        cpus = self.db.query(Product).filter(Product.category == "CPU").all()
-        logging.debug(f"Considering {len(cpus)} CPUs for up to ${cpu_budget_max:.2f}")
 
+        logger.info("Successfully recommended build with total cost: $%.2f", total_cost)
+        return {
+            "build": recommended_parts,
+            "total_cost": total_cost,
+            "user_preferences": user_prefs # Store original preferences for later reference
+        }
+
+    # --- Stage candidates: each returns the compatible products of a category, best first ---
+    def _rank_cpus(self, user_prefs: dict, selected_parts: dict) -> list:
+        use_case = user_prefs.get("use_case", "general")
+        cpus = self.get_compatible_parts("CPU", selected_parts)
         if use_case == "gaming":
             cpus.sort(key=lambda x: (x.gaming_score, x.productivity_score), reverse=True)
         elif use_case == "productivity":
             cpus.sort(key=lambda x: (x.productivity_score, x.gaming_score), reverse=True)
         else: # General
             cpus.sort(key=lambda x: (x.gaming_score + x.productivity_score), reverse=True)
+        return cpus
 
-        for cpu in cpus:
-            price_entry = self.get_lowest_price_for_product(cpu.id)
-            if price_entry and price_entry.price <= cpu_budget_max:
-                selected_cpu = cpu
-                recommended_parts["CPU"] = {"product": cpu, "price_entry": price_entry}
-                total_cost += price_entry.price
-                # --- MODIFIED: Store CPU socket and RAM type in compat_reqs ---
-                compat_reqs["cpu_socket"] = selected_cpu.specs.get("socket")
-                compat_reqs["cpu_ram_type"] = selected_cpu.specs.get("ram_type")
-                logging.info(f"Selected CPU: {selected_cpu.name} for ${recommended_parts['CPU']['price_entry'].price:.2f}. Running total: ${total_cost:.2f}. CPU Socket: {compat_reqs['cpu_socket']}, CPU RAM Type: {compat_reqs['cpu_ram_type']}")
-                break
-        if not selected_cpu:
-            logging.warning("Failed to select a CPU within budget allocation.")
-            return None
-
-
-        # 2. Motherboard Selection (Allocate ~10-20% of remaining budget)
-        mb_budget_max = (budget - total_cost) * random.uniform(0.10, 0.20)
-        # Use CPU socket for filtering motherboards
-        motherboards = self.get_compatible_parts("Motherboard", {"socket": compat_reqs.get("cpu_socket")})
+    def _rank_motherboards(self, user_prefs: dict, selected_parts: dict) -> list:
+        # CPU socket filtering comes from the compatibility index rules
+        motherboards = self.get_compatible_parts("Motherboard", selected_parts)
         motherboards.sort(key=lambda x: (x.gaming_score + x.productivity_score), reverse=True)
-        logging.debug(f"Considering {len(motherboards)} Motherboards for up to ${mb_budget_max:.2f} (socket: {compat_reqs.get('cpu_socket')})")
-
-        for mb in motherboards:
-            price_entry = self.get_lowest_price_for_product(mb.id)
-            if price_entry and price_entry.price <= mb_budget_max:
-                selected_mb = mb
-                recommended_parts["Motherboard"] = {"product": mb, "price_entry": price_entry}
-                total_cost += price_entry.price
-                # --- IMPORTANT FIX: Update compat_reqs with MOTHERBOARD'S RAM type ---
-                compat_reqs["mb_form_factor"] = selected_mb.specs.get("form_factor")
-                compat_reqs["ram_type"] = selected_mb.specs.get("ram_type") # This is what RAM needs to match!
-                logging.info(f"Selected MB: {mb.name} for ${price_entry.price:.2f}. Running total: ${total_cost:.2f}. MB RAM Type: {compat_reqs['ram_type']}")
-                break
-        if not selected_mb:
-            logging.warning("Failed to select a Motherboard compatible with CPU and within budget.")
-            return None
+        return motherboards
 
-
-        # 3. GPU Selection (Allocate ~25-45% of remaining budget, highest priority for gaming)
-        gpu_budget_max = (budget - total_cost) * (0.45 if use_case == "gaming" else 0.25)
-        gpus = self.db.query(Product).filter(Product.category == "GPU").all()
-        logging.debug(f"Considering {len(gpus)} GPUs for up to ${gpu_budget_max:.2f}")
-
-        if use_case == "gaming":
+    def _rank_gpus(self, user_prefs: dict, selected_parts: dict) -> list:
+        gpus = self.get_compatible_parts("GPU", selected_parts)
+        if user_prefs.get("use_case", "general") == "gaming":
             gpus.sort(key=lambda x: x.gaming_score, reverse=True)
         else:
             gpus.sort(key=lambda x: (x.productivity_score + x.gaming_score), reverse=True)
+        return gpus
 
-        for gpu in gpus:
-            price_entry = self.get_lowest_price_for_product(gpu.id)
-            if price_entry and price_entry.price <= gpu_budget_max:
-                selected_gpu = gpu
-                recommended_parts["GPU"] = {"product": gpu, "price_entry": price_entry}
-                total_cost += price_entry.price
-                # Estimate needed PSU wattage
-                cpu_tdp = selected_cpu.specs.get("tdp", 65)
-                gpu_tdp = selected_gpu.specs.get("tdp", 150)
-                compat_reqs["min_psu_wattage"] = (cpu_tdp + gpu_tdp) * 1.5 # 50% buffer
-                logging.info(f"Selected GPU: {gpu.name} for ${price_entry.price:.2f}. Running total: ${total_cost:.2f}")
-                break
-        if not selected_gpu:
-            logging.warning("Failed to select a GPU within budget allocation.")
-            return None
-
-
-        # 4. RAM Selection (Allocate ~5-10% of remaining budget)
-        ram_budget_max = (budget - total_cost) * random.uniform(0.05, 0.10)
-        # Pass the RAM type from the Motherboard
-        rams = self.get_compatible_parts("RAM", {"ram_type": compat_reqs.get("ram_type")})
+    def _rank_rams(self, user_prefs: dict, selected_parts: dict) -> list:
+        # RAM type must match the Motherboard (compatibility index rule)
+        target_ram_gb = 16 if user_prefs["budget"] < 800 and user_prefs.get("use_case", "general") != "productivity" else 32
+        rams = [ram for ram in self.get_compatible_parts("RAM", selected_parts) if ram.specs.get("capacity_gb", 0) >= target_ram_gb]
         # Prioritize higher capacity, then speed
         rams.sort(key=lambda x: (x.specs.get("capacity_gb", 0), x.specs.get("speed_mt_s", 0)), reverse=True)
-        logging.debug(f"Considering {len(rams)} RAM kits for up to ${ram_budget_max:.2f} (RAM type: {compat_reqs.get('ram_type')})")
-
-        target_ram_gb = 16 if budget < 800 and use_case != "productivity" else 32
-        for ram in rams:
-            if ram.specs.get("capacity_gb", 0) >= target_ram_gb:
-                price_entry = self.get_lowest_price_for_product(ram.id)
-                if price_entry and price_entry.price <= ram_budget_max:
-                    selected_ram = ram
-                    recommended_parts["RAM"] = {"product": ram, "price_entry": price_entry}
-                    total_cost += price_entry.price
-                    logging.info(f"Selected RAM: {ram.name} for ${price_entry.price:.2f}. Running total: ${total_cost:.2f}")
-                    break
-        if not selected_ram:
-            logging.warning(f"Failed to select a compatible RAM kit ({target_ram_gb}GB target) of type {compat_reqs.get('ram_type')} within budget.")
-            return None # Keep this 'return None' as RAM is critical
+        return rams
 
-
-        # 5. Storage (SSD) Selection (Allocate ~5-10% of remaining budget)
-        storage_budget_max = (budget - total_cost) * random.uniform(0.05, 0.10)
-        ssds = self.db.query(Product).filter(Product.category == "Storage", Product.specs["type"] == "SSD").all()
+    def _rank_ssds(self, user_prefs: dict, selected_parts: dict) -> list:
+        target_ssd_gb = 500 if user_prefs["budget"] < 800 else 1000 # Aim for 500GB or 1TB
+        ssd_ids = self.catalog.compatibility.with_spec("Storage", "type", "SSD")
+        ssds = [ssd for ssd in self.get_compatible_parts("Storage", selected_parts, ssd_ids) if ssd.specs.get("capacity_gb", 0) >= target_ssd_gb]
         ssds.sort(key=lambda x: x.specs.get("capacity_gb", 0), reverse=True)
-        logging.debug(f"Considering {len(ssds)} SSDs for up to ${storage_budget_max:.2f}")
-
-        target_ssd_gb = 500 if budget < 800 else 1000 # Aim for 500GB or 1TB
-        for ssd in ssds:
-            if ssd.specs.get("capacity_gb", 0) >= target_ssd_gb:
-                price_entry = self.get_lowest_price_for_product(ssd.id)
-                if price_entry and price_entry.price <= storage_budget_max:
-                    selected_storage = ssd
-                    recommended_parts["Storage"] = {"product": ssd, "price_entry": price_entry}
-                    total_cost += price_entry.price
-                    logging.info(f"Selected Storage: {ssd.name} for ${price_entry.price:.2f}. Running total: ${total_cost:.2f}")
-                    break
-        if not selected_storage:
-            logging.warning(f"Failed to select a suitable SSD ({target_ssd_gb}GB target) within budget.")
-            return None
-
-
-        # 6. Power Supply (PSU) Selection (Allocate ~5-8% of remaining budget)
-        psu_budget_max = (budget - total_cost) * random.uniform(0.05, 0.08)
-        min_psu_wattage = compat_reqs.get("min_psu_wattage", 650) # Default if GPU/CPU TDPs not precise
-        psus = self.db.query(Product).filter(Product.category == "PSU").all()
+        return ssds
+
+    def _rank_psus(self, user_prefs: dict, selected_parts: dict) -> list:
+        # Estimate needed PSU wattage from CPU + GPU TDP with a 50% buffer
+        cpu_tdp = selected_parts["CPU"].specs.get("tdp", 65)
+        gpu_tdp = selected_parts["GPU"].specs.get("tdp", 150)
+        min_psu_wattage = (cpu_tdp + gpu_tdp) * 1.5
+        psus = self.get_compatible_parts("PSU", selected_parts, self.catalog.compatibility.at_least("PSU", "wattage", min_psu_wattage))
         psus.sort(key=lambda x: x.specs.get("wattage", 0), reverse=True) # Prioritize higher wattage
-        logging.debug(f"Considering {len(psus)} PSUs for up to ${psu_budget_max:.2f}, min wattage: {min_psu_wattage}")
-
-        for psu in psus:
-            if psu.specs.get("wattage", 0) >= min_psu_wattage:
-                price_entry = self.get_lowest_price_for_product(psu.id)
-                if price_entry and price_entry.price <= psu_budget_max:
-                    selected_psu = psu
-                    recommended_parts["PSU"] = {"product": psu, "price_entry": price_entry}
-                    total_cost += price_entry.price
-                    logging.info(f"Selected PSU: {psu.name} for ${price_entry.price:.2f}. Running total: ${total_cost:.2f}")
-                    break
-        if not selected_psu:
-            logging.warning(f"Failed to select a suitable PSU ({min_psu_wattage}W target) within budget.")
-            return None
-
-
-        # 7. Case Selection (Allocate ~3-7% of remaining budget)
-        case_budget_max = (budget - total_cost) * random.uniform(0.03, 0.07)
-        cases = self.db.query(Product).filter(Product.category == "Case").all()
-        logging.debug(f"Considering {len(cases)} Cases for up to ${case_budget_max:.2f}")
-
-        # Basic case selection: try to match aesthetic, then form factor, then just cheapest
-        filtered_cases = []
-        for case in cases:
-            # Simple form factor match (MB ATX will filter out Mini-ITX cases for now)
-            if compat_reqs.get("mb_form_factor") == "ATX" and "Mini ITX" in case.specs.get("form_factor", ""):
-                 continue
-            filtered_cases.append(case)
+        return psus
 
+    def _rank_cases(self, user_prefs: dict, selected_parts: dict) -> list:
+        # Form factor and GPU clearance come from the compatibility index rules
+        cases = self.get_compatible_parts("Case", selected_parts)
+        price_of = lambda x: self.get_lowest_price_for_product(x.id).price if self.get_lowest_price_for_product(x.id) else float('inf')
         # Prioritize aesthetic, then price
+        aesthetic = user_prefs.get("aesthetic")
         if aesthetic:
-            filtered_cases.sort(key=lambda x: (aesthetic in x.aesthetic_tags, self.get_lowest_price_for_product(x.id).price if self.get_lowest_price_for_product(x.id) else float('inf')), reverse=True)
+            aesthetic_case_ids = self.catalog.compatibility.tagged("Case", aesthetic)
+            cases.sort(key=lambda x: (x.id in aesthetic_case_ids, price_of(x)), reverse=True)
         else:
-            filtered_cases.sort(key=lambda x: self.get_lowest_price_for_product(x.id).price if self.get_lowest_price_for_product(x.id) else float('inf'))
-
-        selected_case = None # Reset selected_case for this logic block
-        for case in filtered_cases:
-            price_entry = self.get_lowest_price_for_product(case.id)
-            if price_entry and price_entry.price <= case_budget_max:
-                selected_case = case
-                recommended_parts["Case"] = {"product": case, "price_entry": price_entry}
-                total_cost += price_entry.price
-                logging.info(f"Selected Case: {case.name} for ${price_entry.price:.2f}. Running total: ${total_cost:.2f}")
-                break
-        if not selected_case:
-            logging.warning("Failed to select a Case within budget and basic compatibility.")
-            # For MVP, if a case isn't found, we might still try to build without one or just return None
-            # For now, let's allow it to proceed if other parts are critical and budget is tight
-            pass # Allow to continue for now, but a real build needs a case
-
-
-        # 8. Peripherals (Monitor, Keyboard, Mouse) - if requested and budget allows
-        if include_monitor:
-            monitor_budget_max = (budget - total_cost) * random.uniform(0.05, 0.15)
-            monitors = self.db.query(Product).filter(Product.category == "Monitor").all()
-            logging.debug(f"Considering {len(monitors)} Monitors for up to ${monitor_budget_max:.2f}")
-
-            # Filter/sort monitors based on requested resolution/refresh rate
-            if monitor_resolution == "1440p":
-                monitors = [m for m in monitors if m.specs.get("resolution_width") == 2560 and m.specs.get("resolution_height") == 1440]
-            elif monitor_resolution == "1080p":
-                monitors = [m for m in monitors if m.specs.get("resolution_width") == 1920 and m.specs.get("resolution_height") == 1080]
-            elif monitor_resolution == "4K":
-                monitors = [m for m in monitors if m.specs.get("resolution_width") == 3840 and m.specs.get("resolution_height") == 2160]
-
-            if monitor_refresh_rate:
-                 monitors = [m for m in monitors if m.specs.get("refresh_rate_hz", 0) >= monitor_refresh_rate]
-
-            monitors.sort(key=lambda x: (x.specs.get("refresh_rate_hz", 0), x.specs.get("resolution_width", 0)), reverse=True)
-
-            for monitor in monitors:
-                price_entry = self.get_lowest_price_for_product(monitor.id)
-                if price_entry and price_entry.price <= monitor_budget_max:
-                    selected_monitor = monitor
-                    recommended_parts["Monitor"] = {"product": monitor, "price_entry": price_entry}
-                    total_cost += price_entry.price
-                    logging.info(f"Selected Monitor: {monitor.name} for ${price_entry.price:.2f}. Running total: ${total_cost:.2f}")
-                    break
-            if not selected_monitor:
-                logging.warning("Failed to select a Monitor within budget.")
+            cases.sort(key=price_of)
+        return cases
 
+    def _rank_monitors(self, user_prefs: dict, selected_parts: dict) -> list:
+        monitors = self.get_compatible_parts("Monitor", selected_parts)
+        monitor_resolution = user_prefs.get("monitor_resolution") # e.g., "1440p"
+        monitor_refresh_rate = user_prefs.get("monitor_refresh_rate") # e.g., 144
 
-        # Final Check: if total_cost is too high, return None or suggest cutting corners
-        if total_cost > budget:
-            logging.warning(f"Final build cost (${total_cost:.2f}) exceeds budget (${budget:.2f}). Returning None.")
-            return None # Or implement logic to reduce price by swapping parts
+        # Filter/sort monitors based on requested resolution/refresh rate
+        if monitor_resolution == "1440p":
+            monitors = [m for m in monitors if m.specs.get("resolution_width") == 2560 and m.specs.get("resolution_height") == 1440]
+        elif monitor_resolution == "1080p":
+            monitors = [m for m in monitors if m.specs.get("resolution_width") == 1920 and m.specs.get("resolution_height") == 1080]
+        elif monitor_resolution == "4K":
+            monitors = [m for m in monitors if m.specs.get("resolution_width") == 3840 and m.specs.get("resolution_height") == 2160]
 
-        # Ensure a minimal build is complete (CPU, MB, GPU, RAM, Storage, PSU)
-        required_categories = {"CPU", "Motherboard", "GPU", "RAM", "Storage", "PSU"}
-        if not required_categories.issubset(recommended_parts.keys()):
-            logging.warning(f"Required core components not all selected. Missing: {required_categories - recommended_parts.keys()}. Returning None.")
+        if monitor_refresh_rate:
+            monitors = [m for m in monitors if m.specs.get("refresh_rate_hz", 0) >= monitor_refresh_rate]
+
+        monitors.sort(key=lambda x: (x.specs.get("refresh_rate_hz", 0), x.specs.get("resolution_width", 0)), reverse=True)
+        return monitors
+
+    # --- Selection ---
+    def _pinned_parts(self, user_prefs: dict) -> dict:
+        """
+        category -> Product for the requested parts that exist in that category and have a price.
+        Only categories the build has a stage for can be pinned; a pinned keyboard or cooler would
+        hold its price back from the other stages without ever being added to the build.
+        """
+        pinned = {}
+        for category, product_id in (user_prefs.get("pinned_parts") or {}).items():
+            if category not in self.STAGE_INPUTS:
+                logger.info("Ignoring pinned %s %r: builds don't include that category.", category, product_id)
+                continue
+            try:
+                product = self.catalog.products.get(int(product_id))
+            except (TypeError, ValueError):
+                product = None
+            if product is None or product.category != category or not self.get_lowest_price_for_product(product.id):
+                logger.info("Ignoring pinned %s %r: unknown product or no price.", category, product_id)
+                continue
+            pinned[category] = product
+        return pinned
+
+    def _reuse_mode(self, category: str, user_prefs: dict, previous_prefs: dict, previous_parts: dict, kept_categories: set) -> str | None:
+        """
+        How a stage may reuse the previous build's part:
+        "keep" when nothing it depends on changed, "budget" when only the budget changed,
+        None (re-solve from scratch) when its constraints or upstream parts changed.
+        """
+        if category not in previous_parts:
+            return None
+        pref_keys, upstream = self.STAGE_INPUTS[category]
+        if any(user_prefs.get(key) != previous_prefs.get(key) for key in pref_keys):
             return None
+        if any(dependency not in kept_categories for dependency in upstream):
+            return None
+        return "keep" if user_prefs.get("budget") == previous_prefs.get("budget") else "budget"
 
+    def _pick(self, candidates: list, budget_max: float, remaining: float, previous_id: int = None, mode: str = None):
+        """
+        Returns (product, price_entry) for the stage, or None.
+        Fresh solve: the best-ranked candidate priced within `budget_max`.
+        The previous part is kept if it is still compatible and fits the `remaining` budget, unless
+        only the budget changed and the fresh pick ranks higher (an upgrade).
+        """
+        if mode is not None:
+            for rank, product in enumerate(candidates):
+                if product.id != previous_id:
+                    continue
+                price_entry = self.get_lowest_price_for_product(product.id)
+                if not price_entry or price_entry.price > remaining:
+                    break
+                if mode == "keep":
+                    return product, price_entry # Nothing changed for this stage, skip the solve
+                for better in candidates[:rank]:
+                    better_entry = self.get_lowest_price_for_product(better.id)
+                    if better_entry and better_entry.price <= budget_max:
+                        return better, better_entry
+                return product, price_entry
+
+        for product in candidates:
+            price_entry = self.get_lowest_price_for_product(product.id)
+            if price_entry and price_entry.price <= budget_max:
+                return product, price_entry
+        return None
+
+    def _full_solve_fallback(self, user_prefs: dict, previous_build: dict = None) -> dict | None:
+        # An incremental solve that dead-ends (e.g. kept parts blow the new budget) retries from scratch
+        if previous_build is not None:
+            logger.info("Incremental recommendation failed, re-solving the full build.")
+            return self.recommend_build(user_prefs)
+        # Requested parts nothing fits with (within budget) are dropped rather than failing the build
+        pinned_parts = user_prefs.get("pinned_parts")
+        if not pinned_parts:
+            return None
+        logger.info("No build fits the pinned parts %s, re-solving without them.", pinned_parts)
+        result = self.recommend_build({**user_prefs, "pinned_parts": None})
+        if result is None:
+            return None
+        return {**result, "user_preferences": user_prefs, "dropped_pins": dict(pinned_parts)}
 
-        logging.info(f"Successfully recommended build with total cost: ${total_cost:.2f}")
-        return {
-            "build": recommended_parts,
-            "total_cost": total_cost,
-            "user_preferences": user_prefs # Store original preferences for later reference
-        }
+    def recommend_builds(self, prefs_list: list):
+        """
+        Batch API: yields (index, build_result or None) for each preference set.
+        The catalog and current prices are loaded once and shared by every item, so
+        each extra recommendation is pure in-memory work.
+        """
+        catalog = self.catalog # Load once up front, before the first item
+        logger.info("Starting batch recommendation for %d preference sets (catalog %s).", len(prefs_list), catalog.version)
+        for i, user_prefs in enumerate(prefs_list):
+            try:
+                yield i, self.recommend_build(user_prefs)
+            except Exception as e:
+                logger.error("Batch recommendation %d failed: %s", i, e, exc_info=True)
+                yield i, None
 
     # You could add a method for `get_alternatives(product_id, budget_impact)` here
-    # Which would find slightly cheaper/more expensive compatible parts.
\ No newline at end of file
+    # Which would find slightly cheaper/more expensive compatible parts.
+
+
+def build_to_dict(build_result: dict) -> dict:
+    """
+    Serializes a recommend_build() result into the JSON shape used by the API
+    (and accepted back by /save_build).
+    """
+    return {
+        "parts": [
+            {
+                "category": cat,
+                "product_id": item["product"].id,
+                "name": item["product"].name,
+                "recommended_price": item["price_entry"].price,
+                "lowest_price_retailer": item["price_entry"].retailer_name,
+                "lowest_price_url": item["price_entry"].retailer_url,
+            } for cat, item in build_result["build"].items()
+        ],
+        "total_cost": build_result["total_cost"],
+        "user_preferences": build_result["user_preferences"]
+    }
@@ -0,0 +1,191 @@
+# services/recommendation_tiers.py
+
+import logging
+import random
+import threading
+import time
+from sqlalchemy.orm import Session
+from config import Config
+from models import RecommendationTier
+from services.catalog import Catalog, load_catalog, load_current_prices
+from services.recommendation_service import RecommendationService
+
+# Preferences a tier cell is keyed on. Requests with any other constraint
+# (aesthetic, monitor resolution, ...) always get a live solve.
+TIER_PREFERENCE_KEYS = {"budget", "use_case", "monitor"}
+
+logger = logging.getLogger(__name__)
+
+
+def tier_grid() -> list:
+    """All (budget, use_case, monitor) cells of the configured grid."""
+    cells = []
+    for budget in range(Config.TIER_BUDGET_MIN, Config.TIER_BUDGET_MAX + 1, Config.TIER_BUDGET_STEP):
+        for use_case in Config.TIER_USE_CASES:
+            for monitor in (False, True):
+                cells.append((budget, use_case, monitor))
+    return cells
+
+
+def tier_key_for(user_prefs: dict) -> tuple | None:
+    """
+    Returns the nearest grid cell at or below the user's budget, or None when the
+    preferences fall outside the grid.
+    """
+    if any(value for key, value in user_prefs.items() if key not in TIER_PREFERENCE_KEYS):
+        return None
+    try:
+        budget = float(user_prefs.get("budget"))
+    except (TypeError, ValueError):
+        return None
+    use_case = user_prefs.get("use_case", "general")
+    if use_case not in Config.TIER_USE_CASES or budget < Config.TIER_BUDGET_MIN:
+        return None
+    steps = int((budget - Config.TIER_BUDGET_MIN) // Config.TIER_BUDGET_STEP)
+    cell_budget = min(Config.TIER_BUDGET_MAX, Config.TIER_BUDGET_MIN + steps * Config.TIER_BUDGET_STEP)
+    return (cell_budget, use_case, bool(user_prefs.get("monitor")))
+
+
+def _cell_rng(cell: tuple) -> random.Random:
+    # Seeded per cell so a rebuild with unchanged prices yields the same build
+    budget, use_case, monitor = cell
+    return random.Random(f"{budget}:{use_case}:{monitor}")
+
+
+def _price_changes_since(db: Session, catalog: Catalog, price_version: int | None) -> tuple:
+    """
+    Compares current prices with the prices as of `price_version`.
+    Returns (ids whose price changed, {id: new price} for products that got cheaper or newly priced).
+    """
+    before = load_current_prices(db, max_price_id=price_version) if price_version else {}
+    changed, dropped = set(), {}
+    for product_id, entry in catalog.prices.items():
+        old_entry = before.get(product_id)
+        if old_entry is None or old_entry.price != entry.price:
+            changed.add(product_id)
+            if old_entry is None or entry.price < old_entry.price:
+                dropped[product_id] = entry.price
+    changed |= set(before) - set(catalog.prices) # Products that lost their price
+    return changed, dropped
+
+
+def _cell_affected(tier: RecommendationTier, catalog: Catalog, changed: set, dropped: dict) -> bool:
+    parts = tier.parts or []
+    part_ids = {part[1] for part in parts}
+    if part_ids & changed or any(product_id not in catalog.products for product_id in part_ids):
+        return True
+    # A product that got cheaper can only displace a greedy pick if it now fits what that stage
+    # could spend; price increases of parts we didn't pick can't change the result. Stages without
+    # a pick (and cells stored before allowances were) are checked against the whole budget.
+    allowances = {part[0]: part[3] if len(part) > 3 and part[3] is not None else tier.budget for part in parts}
+    stages = set(RecommendationService.STAGE_INPUTS) - (set() if tier.monitor else {"Monitor"})
+    for product_id, price in dropped.items():
+        product = catalog.products.get(product_id)
+        if product_id in part_ids or product is None or product.category not in stages:
+            continue
+        if price <= allowances.get(product.category, tier.budget):
+            return True
+    return False
+
+
+def refresh_recommendation_tiers(db: Session, full: bool = False) -> dict:
+    """
+    Background job: (re)builds the materialized recommendation grid.
+    Only cells affected by price changes since they were built are re-solved unless `full` is set
+    (use it after editing product specs or the recommendation logic).
+    """
+    catalog = load_catalog(db)
+    price_version = catalog.version[2] or 0
+    existing = {(tier.budget, tier.use_case, tier.monitor): tier for tier in db.query(RecommendationTier).all()}
+    changes_by_version = {}
+    rec_service = RecommendationService(db)
+    rebuilt, unchanged = 0, 0
+
+    for cell in tier_grid():
+        tier = existing.pop(cell, None)
+        if tier is not None and not full:
+            if tier.price_version not in changes_by_version:
+                changes_by_version[tier.price_version] = _price_changes_since(db, catalog, tier.price_version)
+            if not _cell_affected(tier, catalog, *changes_by_version[tier.price_version]):
+                tier.price_version = price_version # Still valid against the current prices
+                unchanged += 1
+                continue
+
+        budget, use_case, monitor = cell
+        rec_service.rng = _cell_rng(cell)
+        build_result = rec_service.recommend_build({"budget": budget, "use_case": use_case, "monitor": monitor})
+        if tier is None:
+            tier = RecommendationTier(budget=budget, use_case=use_case, monitor=monitor)
+            db.add(tier)
+        if build_result:
+            # Stored as a list to keep category order (MySQL reorders JSON object keys)
+            tier.parts = [
+                [category, item["product"].id, item["price_entry"].price, item.get("budget_max")]
+                for category, item in build_result["build"].items()
+            ]
+            tier.total_cost = build_result["total_cost"]
+        else:
+            tier.parts = None
+            tier.total_cost = None
+        tier.price_version = price_version
+        rebuilt += 1
+
+    for stale_tier in existing.values(): # Cells no longer part of the configured grid
+        db.delete(stale_tier)
+    db.commit()
+    invalidate_tier_cache()
+    logger.info("Recommendation tiers refreshed: %d rebuilt, %d unchanged, %d removed.", rebuilt, unchanged, len(existing))
+    return {"rebuilt": rebuilt, "unchanged": unchanged, "removed": len(existing)}
+
+
+# --- Serving ---
+_tier_lock = threading.Lock()
+_tiers: dict = {}
+_tiers_loaded_at = 0.0
+
+
+def _get_tiers(db: Session) -> dict:
+    """Per-process copy of the grid, reloaded at most every TIER_CACHE_TTL_SECONDS."""
+    global _tiers, _tiers_loaded_at
+    if time.monotonic() - _tiers_loaded_at < Config.TIER_CACHE_TTL_SECONDS:
+        return _tiers
+    with _tier_lock:
+        if time.monotonic() - _tiers_loaded_at >= Config.TIER_CACHE_TTL_SECONDS:
+            rows = db.query(RecommendationTier.budget, RecommendationTier.use_case,
+                            RecommendationTier.monitor, RecommendationTier.parts).all()
+            _tiers = {(budget, use_case, monitor): parts for budget, use_case, monitor, parts in rows}
+            _tiers_loaded_at = time.monotonic()
+    return _tiers
+
+
+def invalidate_tier_cache():
+    global _tiers_loaded_at
+    _tiers_loaded_at = 0.0
+
+
+def get_tiered_build(db: Session, user_prefs: dict) -> dict | None:
+    """
+    Serves a precomputed build for the nearest grid cell that fits the user's budget,
+    priced at current catalog prices. Returns None when the caller should solve live.
+    """
+    cell = tier_key_for(user_prefs)
+    if cell is None:
+        return None
+    parts = _get_tiers(db).get(cell)
+    if not parts:
+        return None
+
+    catalog = load_catalog(db)
+    build, total_cost = {}, 0
+    for category, product_id, *_ in parts:
+        product = catalog.products.get(product_id)
+        price_entry = catalog.lowest_price(product_id)
+        if product is None or price_entry is None:
+            return None # Catalog moved on since the cell was built
+        build[category] = {"product": product, "price_entry": price_entry}
+        total_cost += price_entry.price
+    if total_cost > float(user_prefs["budget"]):
+        return None
+
+    logger.info("Serving materialized build for tier %s, total $%.2f.", cell, total_cost)
+    return {"build": build, "total_cost": total_cost, "user_preferences": user_prefs}
@@ -0,0 +1,119 @@
+# services/scrape_priority.py
+
+import logging
+import math
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from config import Config
+from models import BuildPart, PriceEntry, ProductDemand
+from services.demand import decayed
+
+logger = logging.getLogger(__name__)
+
+# Importance weights; an item's priority is importance x hours since its last successful scrape
+VOLATILITY_WEIGHT = 4.0 # (max - min) / mean over the volatility window; 0.1 (10% swings) adds 0.4
+SAVED_BUILD_WEIGHT = 1.0 # Per log(1 + saved builds containing the product)
+RECOMMENDATION_WEIGHT = 0.5 # Per log(1 + decayed recent recommendations)
+
+
+class ScrapeTarget:
+    """One (product, retailer) pair to scrape, with the inputs of its priority."""
+
+    __slots__ = ("product", "retailer", "priority", "age_hours", "volatility", "saved_builds", "recommendations")
+
+    def __init__(self, product, retailer: str, age_hours: float, volatility: float = 0.0, saved_builds: int = 0, recommendations: float = 0.0):
+        self.product = product
+        self.retailer = retailer
+        self.age_hours = age_hours
+        self.volatility = volatility
+        self.saved_builds = saved_builds
+        self.recommendations = recommendations
+        importance = (
+            1.0
+            + VOLATILITY_WEIGHT * volatility
+            + SAVED_BUILD_WEIGHT * math.log1p(saved_builds)
+            + RECOMMENDATION_WEIGHT * math.log1p(recommendations)
+        )
+        # Cold parts still age into the budget eventually; past the max age they go first
+        overdue = age_hours >= Config.SCRAPE_MAX_AGE_HOURS
+        self.priority = (overdue, importance * age_hours)
+
+    def __repr__(self):
+        return f"<ScrapeTarget(product_id={self.product.id}, retailer='{self.retailer}', priority={self.priority[1]:.1f})>"
+
+
+def _price_stats(db: Session, since: datetime) -> dict:
+    """{(product_id, retailer): (volatility, last observation)} over the prices seen since `since`."""
+    seen = func.coalesce(PriceEntry.last_seen_at, PriceEntry.timestamp) # Unchanged prices only extend last_seen_at
+    rows = db.query(
+        PriceEntry.product_id,
+        PriceEntry.retailer_name,
+        func.min(PriceEntry.price),
+        func.max(PriceEntry.price),
+        func.avg(PriceEntry.price),
+        func.max(seen),
+    ).filter(seen >= since).group_by(PriceEntry.product_id, PriceEntry.retailer_name).all()
+    return {
+        (product_id, retailer): (((high - low) / mean) if mean else 0.0, latest)
+        for product_id, retailer, low, high, mean, latest in rows
+    }
+
+
+def rank_scrape_targets(db: Session, products: list, retailers: list, links: dict = None, now: datetime = None) -> list:
+    """
+    Scores every (product, retailer) pair and returns ScrapeTargets, highest priority first.
+    Importance comes from recent price volatility, saved builds and recent recommendations
+    containing the product; it's multiplied by the hours since the pair's last successful
+    scrape (RetailerProductUrl.verified_at or its newest price), so a fresh price of a hot
+    part can wait while a stale one of a cold part eventually can't.
+    """
+    now = now or datetime.now()
+    links = links or {}
+    price_stats = _price_stats(db, now - timedelta(days=Config.SCRAPE_VOLATILITY_WINDOW_DAYS))
+    saved_builds = dict(
+        db.query(BuildPart.product_id, func.count(func.distinct(BuildPart.saved_build_id))).group_by(BuildPart.product_id).all()
+    )
+    recommendations = {
+        row.product_id: decayed(row.recommendations, row.updated_at, now) for row in db.query(ProductDemand).all()
+    }
+
+    targets = []
+    for product in products:
+        for retailer in retailers:
+            volatility, last_price_at = price_stats.get((product.id, retailer), (0.0, None))
+            link = links.get((product.id, retailer))
+            last_success = max(
+                (moment.replace(tzinfo=None) for moment in (last_price_at, link.verified_at if link else None) if moment is not None),
+                default=None,
+            )
+            # Never scraped: as stale as anything gets
+            age_hours = (now - last_success).total_seconds() / 3600 if last_success else Config.SCRAPE_MAX_AGE_HOURS
+            targets.append(ScrapeTarget(
+                product, retailer, max(age_hours, 0.0), volatility=volatility,
+                saved_builds=saved_builds.get(product.id, 0), recommendations=recommendations.get(product.id, 0.0),
+            ))
+    targets.sort(key=lambda target: target.priority, reverse=True)
+    return targets
+
+
+def request_cost(target: ScrapeTarget, links: dict) -> int:
+    """Requests a product-page scrape of `target` takes: one, plus a search if its URL isn't resolved."""
+    link = links.get((target.product.id, target.retailer))
+    return 1 if link is not None and link.product_url else 2
+
+
+def select_within_budget(targets: list, budget: int, links: dict) -> list:
+    """The highest-priority targets whose requests fit in `budget` (None or 0: no limit)."""
+    if not budget:
+        return list(targets)
+    selected, spent = [], 0
+    for target in targets:
+        cost = request_cost(target, links)
+        if spent + cost > budget:
+            continue # A cheaper, lower-priority target may still fit
+        selected.append(target)
+        spent += cost
+        if spent >= budget:
+            break
+    return selected
@@ -1,103 +1,300 @@
 import requests
+from abc import ABC, abstractmethod
 from bs4 import BeautifulSoup
 from sqlalchemy.orm import Session
 from models import Product, PriceEntry
 from config import Config
+from services.catalog_snapshot import write_snapshot
+from services.metrics import span
+from services.price_history import record_prices
+from services.scrape_priority import rank_scrape_targets, select_within_budget
+from services.single_flight import get_flight
+from services.url_resolution import HEADERS, RESOLVERS, get_product_link, load_product_links, record_scrape_result
+import logging
 import time
 import random
 
-def scrape_amazon(product_url: str) -> float | None:
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-    try:
-        response = requests.get(product_url, headers=headers, timeout=10)
+# Per-product lines are rate limited by logging_config (LOG_RATE_LIMITS)
+logger = logging.getLogger(__name__)
+
+_SCRAPE_FLIGHT = get_flight("scrape", share_results=True)
+
+
+def _parse_price(text: str) -> float:
+    return float(text.strip().replace('$', '').replace(',', ''))
+
+
+class RetailerPlugin(ABC):
+    """
+    One retailer's scraping logic. Subclasses parse product pages and listing pages; those with
+    category listing pages (`listing_urls`) get the bulk mode, which prices dozens of products
+    per request (without any, parse_listing_page can just return []). Register instances with
+    register_retailer(); a subclass missing a parser can't be instantiated.
+    """
+    name = "" # As in Config.TRUSTED_RETAILERS, e.g. "amazon.com"
+    key = "" # Short name for metrics and Config.SCRAPER_TARGET_URLS
+    listing_urls = {} # Product category -> listing page URL with a {page} placeholder
+
+    @property
+    def supports_bulk(self) -> bool:
+        return bool(self.listing_urls)
+
+    @abstractmethod
+    def parse_product_page(self, soup: BeautifulSoup) -> float | None:
+        """Returns the price on a product page, or None when it shows none."""
+
+    @abstractmethod
+    def parse_listing_page(self, soup: BeautifulSoup) -> list:
+        """Returns [(retailer item id, price), ...] for the products shown on a listing page."""
+
+    def _fetch(self, url: str, http=None) -> str:
+        with span("scraper.fetch", stage=self.key):
+            response = (http or requests).get(url, headers=HEADERS, timeout=10)
         response.raise_for_status() # Raise an exception for HTTP errors
-        soup = BeautifulSoup(response.text, 'html.parser')
+        return response.text
+
+    def scrape_product(self, product_url: str, http=None) -> float | None:
+        # `http` is an optional requests.Session, so a scrape run reuses connections.
+        # Overlapping scrape runs (see services.single_flight) fetch a page once and share the price.
+        return _SCRAPE_FLIGHT.do(("product", product_url), lambda: self._scrape_product(product_url, http), cross_process=True)
 
+    def _scrape_product(self, product_url: str, http=None) -> float | None:
+        try:
+            html = self._fetch(product_url, http)
+            with span("scraper.parse", stage=self.key):
+                return self.parse_product_page(BeautifulSoup(html, 'html.parser'))
+        except requests.exceptions.RequestException as e:
+            logger.warning("Error scraping %s %s: %s", self.name, product_url, e)
+            return None
+        except Exception as e:
+            logger.warning("Failed to parse %s price for %s: %s", self.name, product_url, e)
+            return None
+
+    def scrape_listing(self, listing_url: str, http=None) -> list:
+        rows = _SCRAPE_FLIGHT.do(("listing", listing_url), lambda: self._scrape_listing(listing_url, http), cross_process=True)
+        return [tuple(row) for row in rows] # Shared across processes as JSON lists
+
+    def _scrape_listing(self, listing_url: str, http=None) -> list:
+        try:
+            html = self._fetch(listing_url, http)
+            with span("scraper.parse", stage=self.key):
+                return self.parse_listing_page(BeautifulSoup(html, 'html.parser'))
+        except requests.exceptions.RequestException as e:
+            logger.warning("Error scraping %s listing %s: %s", self.name, listing_url, e)
+            return []
+        except Exception as e:
+            logger.warning("Failed to parse %s listing %s: %s", self.name, listing_url, e)
+            return []
+
+
+class AmazonPlugin(RetailerPlugin):
+    name = "amazon.com"
+    key = "amazon"
+    # Search results restricted to a browse node; adjust the nodes to the categories you track
+    listing_urls = {
+        "CPU": "https://www.amazon.com/s?rh=n%3A229189&page={page}",
+        "GPU": "https://www.amazon.com/s?rh=n%3A284822&page={page}",
+        "Motherboard": "https://www.amazon.com/s?rh=n%3A1048424&page={page}",
+        "RAM": "https://www.amazon.com/s?rh=n%3A172500&page={page}",
+        "Storage": "https://www.amazon.com/s?rh=n%3A1292116011&page={page}",
+        "PSU": "https://www.amazon.com/s?rh=n%3A1161760&page={page}",
+        "Case": "https://www.amazon.com/s?rh=n%3A572238&page={page}",
+        "Monitor": "https://www.amazon.com/s?rh=n%3A1292115011&page={page}",
+    }
+
+    def parse_product_page(self, soup: BeautifulSoup) -> float | None:
         # This is a very basic selector, often changes.
         # You'll need to inspect Amazon's current HTML structure.
         price_span = soup.find('span', class_='a-offscreen')
-        if price_span:
-            price_text = price_span.get_text(strip=True).replace('$', '').replace(',', '')
-            return float(price_text)
-        return None
-    except requests.exceptions.RequestException as e:
-        print(f"Error scraping Amazon {product_url}: {e}")
-        return None
-    except Exception as e:
-        print(f"Failed to parse Amazon price for {product_url}: {e}")
-        return None
-
-def scrape_newegg(product_url: str) -> float | None:
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+        return _parse_price(price_span.get_text(strip=True)) if price_span else None
+
+    def parse_listing_page(self, soup: BeautifulSoup) -> list:
+        items = []
+        for result in soup.find_all('div', attrs={'data-asin': True}):
+            asin = result['data-asin'].strip()
+            price_span = result.find('span', class_='a-offscreen')
+            if asin and price_span:
+                items.append((asin, _parse_price(price_span.get_text(strip=True))))
+        return items
+
+
+class NeweggPlugin(RetailerPlugin):
+    name = "newegg.com"
+    key = "newegg"
+    # Category listing pages (N = Newegg category id)
+    listing_urls = {
+        "CPU": "https://www.newegg.com/p/pl?N=100007671&page={page}",
+        "GPU": "https://www.newegg.com/p/pl?N=100007709&page={page}",
+        "Motherboard": "https://www.newegg.com/p/pl?N=100007627&page={page}",
+        "RAM": "https://www.newegg.com/p/pl?N=100007611&page={page}",
+        "Storage": "https://www.newegg.com/p/pl?N=100011693&page={page}",
+        "PSU": "https://www.newegg.com/p/pl?N=100007657&page={page}",
+        "Case": "https://www.newegg.com/p/pl?N=100007583&page={page}",
+        "Monitor": "https://www.newegg.com/p/pl?N=100160979&page={page}",
     }
-    try:
-        response = requests.get(product_url, headers=headers, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
 
+    def parse_product_page(self, soup: BeautifulSoup) -> float | None:
         # Again, highly dependent on Newegg's current HTML
         price_strong = soup.find('li', class_='price-current').find('strong')
-        if price_strong:
-            price_text = price_strong.get_text(strip=True).replace('$', '').replace(',', '')
-            return float(price_text)
-        return None
-    except requests.exceptions.RequestException as e:
-        print(f"Error scraping Newegg {product_url}: {e}")
-        return None
-    except Exception as e:
-        print(f"Failed to parse Newegg price for {product_url}: {e}")
-        return None
-
-def get_product_url_for_retailer(product: Product, retailer: str) -> str | None:
-    # This function needs to dynamically generate or look up the correct URL for a product
-    # on a specific retailer's site. This is often the hardest part.
-    # For MVP, you might store these URLs directly in your product data.
-    # Or build a mapping for common products.
-    # For example, searching by model number on the retailer's site might be needed.
-
-    if retailer == "amazon.com":
-        # Placeholder: You'd need a way to get the Amazon ASIN or search for the product
-        return f"https://www.amazon.com/s?k={product.name.replace(' ', '+')}"
-    elif retailer == "newegg.com":
-        # Placeholder: You'd need Newegg item number or search logic
-        return f"https://www.newegg.com/p/pl?d={product.name.replace(' ', '+')}"
-    return None
-
-def update_product_prices(db: Session):
-    products = db.query(Product).all()
-    retailers_to_scrape = Config.TRUSTED_RETAILERS # Use your configured list
-
-    for product in products:
-        print(f"Scraping prices for {product.name}...")
-        for retailer in retailers_to_scrape:
-            product_url = get_product_url_for_retailer(product, retailer)
-            if not product_url:
-                print(f"Could not find URL for {product.name} on {retailer}")
+        return _parse_price(price_strong.get_text(strip=True)) if price_strong else None
+
+    def parse_listing_page(self, soup: BeautifulSoup) -> list:
+        item_pattern = RESOLVERS[self.name].item_pattern # Same item ids as the resolved product URLs
+        items = []
+        for cell in soup.find_all('div', class_='item-cell'):
+            title = cell.find('a', class_='item-title', href=True)
+            price = cell.find('li', class_='price-current')
+            match = item_pattern.search(title['href']) if title else None
+            if not match or price is None or price.find('strong') is None:
                 continue
+            cents = price.find('sup')
+            items.append((match.group(1), _parse_price(price.find('strong').get_text(strip=True) + (cents.get_text(strip=True) if cents else ""))))
+        return items
 
-            current_price = None
-            if "amazon.com" in retailer: # Simplified check
-                current_price = scrape_amazon(product_url)
-            elif "newegg.com" in retailer: # Simplified check
-                current_price = scrape_newegg(product_url)
-            # Add more scrapers for other retailers
-
-            if current_price is not None:
-                new_price_entry = PriceEntry(
-                    product_id=product.id,
-                    retailer_name=retailer,
-                    retailer_url=product_url, # This should ideally be the direct product page URL
-                    price=current_price
-                )
-                db.add(new_price_entry)
-                print(f"  -> Found {current_price} on {retailer}")
+
+RETAILER_PLUGINS = {}
+
+
+def register_retailer(plugin: RetailerPlugin):
+    if not isinstance(plugin, RetailerPlugin):
+        raise TypeError(f"Retailer plugins must be RetailerPlugin instances, got {type(plugin).__name__}.")
+    RETAILER_PLUGINS[plugin.name] = plugin
+
+
+register_retailer(AmazonPlugin())
+register_retailer(NeweggPlugin())
+
+
+def _enabled_plugins() -> list:
+    # Retailers we can scrape: trusted, with a plugin and a URL resolver
+    return [RETAILER_PLUGINS[name] for name in Config.TRUSTED_RETAILERS if name in RETAILER_PLUGINS and name in RESOLVERS]
+
+
+def get_product_url_for_retailer(db: Session, product: Product, retailer: str, links: dict = None, http=None) -> str | None:
+    """
+    The direct product page on `retailer`. Resolved via the retailer's search once and stored
+    (see services/url_resolution.py), so steady-state scrapes fetch only the product page.
+    """
+    link = get_product_link(db, product, retailer, links=links, http=http)
+    return link.product_url if link else None
+
+
+def _scrape_products(db: Session, targets: list, links: dict, http) -> list:
+    """Per-product mode: one product page request per ScrapeTarget, in order. Returns PriceEntry rows to insert."""
+    rows = []
+    for target in targets:
+        product, plugin = target.product, RETAILER_PLUGINS[target.retailer]
+        logger.info("Scraping %s price for %s...", plugin.name, product.name)
+        link = get_product_link(db, product, plugin.name, links=links, http=http)
+        if link is None:
+            logger.info("Could not find URL for %s on %s", product.name, plugin.name)
+            continue
+
+        current_price = plugin.scrape_product(link.product_url, http)
+        record_scrape_result(link, current_price is not None) # Repeated failures re-resolve the URL next run
+        if current_price is not None:
+            rows.append({"product_id": product.id, "retailer_name": plugin.name, "retailer_url": link.product_url, "price": current_price})
+            logger.info("Found %s for %s on %s", current_price, product.name, plugin.name)
+        time.sleep(random.uniform(1, 3)) # Be polite, avoid getting blocked
+    return rows
+
+
+def _scrape_listings(plugin: RetailerPlugin, categories: list, links: dict, http, max_requests: int = None) -> tuple:
+    """
+    Bulk mode for one retailer: walks the category listing pages (in the given order) and matches
+    item ids to our products through the stored URL mapping, stopping after `max_requests` pages.
+    Returns (PriceEntry rows, covered (product_id, retailer) keys, requests made).
+    """
+    by_sku = {link.retailer_sku: link for (_, retailer), link in links.items() if retailer == plugin.name and link.retailer_sku}
+    rows, covered, requests_made = [], set(), 0
+    for category in categories:
+        url_template = plugin.listing_urls.get(category)
+        if url_template is None:
+            continue
+        for page in range(1, Config.SCRAPER_LISTING_MAX_PAGES + 1):
+            if max_requests is not None and requests_made >= max_requests:
+                break
+            items = plugin.scrape_listing(url_template.format(page=page), http)
+            requests_made += 1
             time.sleep(random.uniform(1, 3)) # Be polite, avoid getting blocked
+            if not items:
+                break # Past the last page (or the layout changed)
+            for sku, price in items:
+                link = by_sku.get(sku)
+                if link is None or (link.product_id, plugin.name) in covered:
+                    continue # Not a product we track (or already priced from an earlier page)
+                covered.add((link.product_id, plugin.name))
+                record_scrape_result(link, True)
+                rows.append({"product_id": link.product_id, "retailer_name": plugin.name, "retailer_url": link.product_url, "price": price})
+    logger.info("Bulk scrape of %s: %d listing pages, %d products priced.", plugin.name, requests_made, len(rows))
+    return rows, covered, requests_made
+
+
+def _categories_by_priority(targets: list, retailer: str) -> list:
+    # Walk the listings of the categories with the most urgent parts first, in case the budget runs out
+    totals = {}
+    for target in targets:
+        if target.retailer == retailer:
+            overdue, priority = totals.get(target.product.category, (0, 0.0))
+            totals[target.product.category] = (overdue + target.priority[0], priority + target.priority[1])
+    return sorted(totals, key=totals.get, reverse=True)
+
+
+def update_product_prices(db: Session, mode: str = None, request_budget: int = None):
+    """
+    Scrapes current prices from every enabled retailer and writes them in one batch
+    (see services.price_history.record_prices).
+    Each (product, retailer) pair is ranked by services.scrape_priority (volatility, saved builds,
+    recent recommendations, time since its last price) and the run spends at most `request_budget`
+    requests (default: Config.SCRAPER_REQUEST_BUDGET; 0 means no limit) on the highest-ranked ones.
+    mode "bulk" (default: Config.SCRAPER_MODE) first prices what it can from category listing pages,
+    using up to Config.SCRAPER_LISTING_BUDGET_SHARE of the budget, and only visits product pages for
+    pairs the listings didn't cover (including new products whose URL isn't resolved yet);
+    mode "product" visits one product page per pair.
+    """
+    mode = mode or Config.SCRAPER_MODE
+    budget = Config.SCRAPER_REQUEST_BUDGET if request_budget is None else request_budget
+    products = db.query(Product).all()
+    plugins = _enabled_plugins()
+    links = load_product_links(db) # All stored product URLs in one query
+    http = requests.Session() # Keep-alive across the run
+    targets = rank_scrape_targets(db, products, [plugin.name for plugin in plugins], links)
+
+    rows, covered, spent = [], set(), 0
+    if mode == "bulk":
+        listing_budget = int(budget * Config.SCRAPER_LISTING_BUDGET_SHARE) if budget else None
+        for plugin in plugins:
+            if not plugin.supports_bulk:
+                continue
+            remaining = None if listing_budget is None else listing_budget - spent
+            if remaining is not None and remaining <= 0:
+                break
+            categories = _categories_by_priority(targets, plugin.name)
+            plugin_rows, plugin_covered, requests_made = _scrape_listings(plugin, categories, links, http, max_requests=remaining)
+            rows.extend(plugin_rows)
+            covered |= plugin_covered
+            spent += requests_made
+    pending = [target for target in targets if (target.product.id, target.retailer) not in covered]
+    if not budget:
+        selected = select_within_budget(pending, None, links)
+    elif budget - spent > 0:
+        selected = select_within_budget(pending, budget - spent, links)
+    else:
+        selected = [] # The listings used the whole budget; 0 would mean "no limit" to select_within_budget
+    rows.extend(_scrape_products(db, selected, links, http))
 
+    inserted, extended = record_prices(db, rows) # Unchanged prices only extend their current row
     db.commit()
-    print("Price update complete.")
+    if Config.CATALOG_SNAPSHOT_PATH:
+        try:
+            write_snapshot(db, Config.CATALOG_SNAPSHOT_PATH) # Workers pick up the new prices on their next catalog load
+        except OSError as e:
+            # Prices are saved either way; workers fall back to loading the catalog from the database
+            logger.error("Could not write catalog snapshot %s: %s", Config.CATALOG_SNAPSHOT_PATH, e)
+    logger.info(
+        "Price update complete: %d prices (%d changed); %d of %d product/retailer pairs due by priority, %d covered by listings.",
+        len(rows), inserted, len(selected), len(pending), len(covered),
+    )
 
 if __name__ == "__main__":
     from database import SessionLocal, create_db_and_tables
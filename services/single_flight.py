@@ -0,0 +1,220 @@
+# services/single_flight.py
+
+"""
+Single-flight: concurrent callers asking for the same key wait on one in-progress computation
+and share its result, instead of each repeating it (a popular shared link hitting
+recommend_build, every worker loading a cold catalog after a restart, overlapping scrape runs
+fetching the same page).
+
+Within a process, followers block on the leader's call. With Config.SINGLE_FLIGHT_DIR set,
+`cross_process=True` calls also take a file lock on the key, so leaders in different processes
+on the host run one at a time: a process that had to wait reuses the result the other one left
+behind (flights created with share_results=True, JSON-serializable results only), or simply
+runs `fn` afterwards, which is expected to find the other process's work (e.g. a fresh catalog
+snapshot) and be cheap.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from config import Config
+from services.metrics import REGISTRY
+
+try:
+    import fcntl
+except ImportError: # Windows: coalescing stays within the process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SINGLE_FLIGHT_CALLS = REGISTRY.counter(
+    "pc_agent_single_flight_calls_total",
+    "Single-flight calls: leader (computed), follower (waited on this process's call), shared (waited on another process).",
+    ("flight", "role"),
+)
+SINGLE_FLIGHT_COALESCING = REGISTRY.gauge(
+    "pc_agent_single_flight_coalescing_ratio", "Share of single-flight calls that didn't compute on their own.", ("flight",)
+)
+
+LOCK_STRIPES = 4096 # Byte-range locks in one file per flight; colliding keys only wait on each other
+_MISSING = object()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls by key. `name` labels the metrics and the lock and result files;
+    keys must be hashable, and for cross-process calls have the same repr() in every process.
+    """
+
+    def __init__(self, name: str, share_results: bool = False, lock_dir: str = None):
+        self.name = name
+        self.share_results = share_results
+        self.lock_dir = lock_dir
+        self._lock = threading.Lock()
+        self._calls = {} # key -> _Call in progress
+        self._counts = {"leader": 0, "follower": 0, "shared": 0}
+        self._lock_file = None # Kept open: closing any descriptor of it would drop this process's locks
+        # lockf locks belong to the process, not the thread: two of our threads on one stripe would
+        # share it and the first unlock would release it for both, so threads take turns per stripe
+        self._stripe_locks = [threading.Lock() for _ in range(LOCK_STRIPES)] if fcntl is not None else []
+        self._pruned_at = 0.0
+
+    def _count(self, role: str):
+        SINGLE_FLIGHT_CALLS.inc(flight=self.name, role=role)
+        with self._lock:
+            self._counts[role] += 1
+            total = sum(self._counts.values())
+            ratio = (total - self._counts["leader"]) / total
+        SINGLE_FLIGHT_COALESCING.set(ratio, flight=self.name)
+
+    def do(self, key, fn, cross_process: bool = False):
+        """Returns fn(), or the result (or exception) of the identical call already in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            self._count("follower")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            lock_dir = self.lock_dir or Config.SINGLE_FLIGHT_DIR
+            if cross_process and lock_dir and fcntl is not None:
+                call.result = self._do_locked(key, fn, lock_dir)
+            else:
+                self._count("leader")
+                call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _do_locked(self, key, fn, lock_dir: str):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        result_path = os.path.join(lock_dir, f"{self.name}-{digest}.json")
+        stripe = int(digest[:8], 16) % LOCK_STRIPES
+        lock_file = self._open_lock_file(lock_dir)
+        waiting_since = time.time()
+        with self._stripe_locks[stripe]: # Held around the file lock, see __init__
+            try:
+                fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, stripe)
+                contended = False
+            except OSError:
+                contended = True
+                fcntl.lockf(lock_file, fcntl.LOCK_EX, 1, stripe) # Another process is computing it
+            try:
+                if contended:
+                    self._count("shared")
+                    if self.share_results:
+                        result = self._read_result(result_path, waiting_since)
+                        if result is not _MISSING:
+                            return result
+                    return fn()
+                self._count("leader")
+                result = fn()
+                if self.share_results:
+                    self._write_result(lock_dir, result_path, result)
+                return result
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN, 1, stripe)
+
+    def _open_lock_file(self, lock_dir: str):
+        with self._lock:
+            if self._lock_file is None:
+                os.makedirs(lock_dir, exist_ok=True)
+                self._lock_file = open(os.path.join(lock_dir, f"{self.name}.lock"), "a+b")
+            return self._lock_file
+
+    def _read_result(self, path: str, newer_than: float):
+        # Only a result written while we waited; an older one is from an unrelated earlier call
+        try:
+            if os.stat(path).st_mtime < newer_than:
+                return _MISSING
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return _MISSING # The other process failed; compute it ourselves
+
+    def _write_result(self, lock_dir: str, path: str, result):
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=f".{self.name}-", suffix=".tmp", dir=lock_dir)
+            with os.fdopen(fd, "w", encoding="utf-8") as out:
+                json.dump(result, out)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Could not share %s single-flight result: %s", self.name, e)
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+            return
+        self._prune(lock_dir)
+
+    def _prune(self, lock_dir: str):
+        # Results only matter to processes waiting right now; drop the old ones now and then
+        now = time.time()
+        if now - self._pruned_at < Config.SINGLE_FLIGHT_RESULT_TTL_SECONDS:
+            return
+        self._pruned_at = now
+        prefix = f"{self.name}-"
+        try:
+            for entry in os.scandir(lock_dir):
+                if entry.name.startswith(prefix) and entry.name.endswith(".json") \
+                        and now - entry.stat().st_mtime > Config.SINGLE_FLIGHT_RESULT_TTL_SECONDS:
+                    os.unlink(entry.path)
+        except OSError as e:
+            logger.debug("Could not prune %s single-flight results: %s", self.name, e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+            in_flight = len(self._calls)
+        total = sum(counts.values())
+        return {
+            **counts,
+            "in_flight": in_flight,
+            "coalescing_ratio": round((total - counts["leader"]) / total, 4) if total else 0.0,
+        }
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_flight(name: str, share_results: bool = False) -> SingleFlight:
+    """The process-wide SingleFlight called `name` ("recommendation", "catalog", "scrape", ...)."""
+    flight = _flights.get(name)
+    if flight is None:
+        with _flights_lock:
+            flight = _flights.get(name)
+            if flight is None:
+                flight = _flights[name] = SingleFlight(name, share_results=share_results)
+    return flight
+
+
+def flight_stats() -> dict:
+    """{name: stats()} for every flight used in this process."""
+    return {name: flight.stats() for name, flight in list(_flights.items())}
@@ -0,0 +1,134 @@
+# services/traffic_capture.py
+
+"""
+Opt-in traffic capture for performance regression tests (scripts/replay_traffic.py). With
+Config.CAPTURE_PATH set, /chat and /save_build requests are appended to that JSONL file with
+what the NLU calls returned, the status, the latency and the DB query count. Emails, phone
+numbers and names are scrubbed before anything is written; emails become stable pseudonyms,
+so one user's requests still belong together.
+
+One line per request:
+    {"ts", "endpoint", "path", "headers", "body", "status", "session_id", "nlu": [...], "seconds", "db_queries"}
+where "nlu" lists the calls in order: {"call": "chat" | "extract", "content": ...} or {"call", "error"}.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+CAPTURED_ENDPOINTS = ("chat.chat", "builds.save_build")
+CAPTURED_HEADERS = ("Idempotency-Key",)
+
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+_PHONE = re.compile(r"(?<!\w)\+?(?:\d[\s().-]{0,2}){9,14}\d(?!\w)") # 10-15 digits, short separators; not "1000 - 1500"
+# Pseudonyms are only stable within one salt; set CAPTURE_SALT to keep them stable across workers
+_salt = Config.CAPTURE_SALT or os.urandom(16).hex()
+
+_nlu_calls: ContextVar = ContextVar("nlu_calls", default=None)
+
+
+def _pseudonym(match) -> str:
+    digest = hashlib.sha256(f"{_salt}:{match.group(0).lower()}".encode("utf-8")).hexdigest()[:12]
+    return f"user-{digest}@example.invalid"
+
+
+def scrub(value):
+    """`value` (JSON data) with emails pseudonymized and phone numbers removed."""
+    if isinstance(value, str):
+        return _PHONE.sub("[phone]", _EMAIL.sub(_pseudonym, value))
+    if isinstance(value, dict):
+        return {key: scrub(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+
+def start_capture():
+    """Starts collecting the NLU results of the current request."""
+    _nlu_calls.set([])
+
+
+def record_nlu(call: str, content: str = None, error: str = None):
+    """Called by NLUService with every reply or extraction it returns (cached or not); a no-op unless capturing."""
+    calls = _nlu_calls.get()
+    if calls is not None:
+        calls.append({"call": call, "error": error} if error else {"call": call, "content": content})
+
+
+def finish_capture() -> list:
+    calls = _nlu_calls.get()
+    _nlu_calls.set(None)
+    return calls or []
+
+
+def _sampled(key) -> bool:
+    # Whole conversations/users are sampled, so a replayed session isn't missing its earlier turns
+    if Config.CAPTURE_SAMPLE_RATE >= 1:
+        return True
+    if key is None:
+        return random.random() < Config.CAPTURE_SAMPLE_RATE
+    return int(hashlib.sha256(str(key).encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF < Config.CAPTURE_SAMPLE_RATE
+
+
+class CaptureWriter:
+    """Appends one JSON line per request; each line goes out in a single write, so workers can share the file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def write(self, record: dict):
+        line = json.dumps(record, separators=(",", ":"), default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(os.path.abspath(self.path))
+                os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer() -> CaptureWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = CaptureWriter(Config.CAPTURE_PATH)
+    return _writer
+
+
+def capture_request(endpoint: str, path: str, headers, body, status: int, response_body, nlu: list, seconds: float, db_queries: int):
+    """Writes one captured request, if its session (or user) is sampled. Never raises."""
+    try:
+        body = body if isinstance(body, dict) else {}
+        session_id = (response_body or {}).get("session_id") if isinstance(response_body, dict) else None
+        if not _sampled(session_id or body.get("session_id") or body.get("email")):
+            return
+        _get_writer().write({
+            "ts": time.time(),
+            "endpoint": endpoint,
+            "path": path,
+            "headers": {name: headers[name] for name in CAPTURED_HEADERS if name in headers},
+            "body": scrub({**body, "name": "[name]"} if body.get("name") else body), # /save_build's user name
+            "status": status,
+            "session_id": session_id, # The id the server assigned, so a replay can map it to its own
+            "nlu": [scrub(call) for call in nlu],
+            "seconds": round(seconds, 6),
+            "db_queries": db_queries,
+        })
+    except Exception as e:
+        logger.warning("Could not capture %s request: %s", endpoint, e)
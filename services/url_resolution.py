@@ -0,0 +1,139 @@
+# services/url_resolution.py
+
+import logging
+import re
+from datetime import datetime, timedelta
+from urllib.parse import quote_plus
+import requests
+from bs4 import BeautifulSoup
+from sqlalchemy.orm import Session
+from config import Config
+from models import Product, RetailerProductUrl
+from services.metrics import REGISTRY, span
+
+logger = logging.getLogger(__name__)
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+URL_RESOLUTIONS = REGISTRY.counter(
+    "pc_agent_retailer_url_resolutions_total", "Search-page lookups of direct product URLs.", ("retailer", "outcome")
+)
+
+# How long to wait before searching again for a product a retailer didn't list
+RESOLVE_RETRY_INTERVAL = timedelta(hours=24)
+
+
+class RetailerResolver:
+    """How to find a product's direct page on one retailer: its search URL and how to read item ids from results."""
+
+    def __init__(self, key: str, search_url: str, item_pattern: str):
+        self.key = key # Key into Config.SCRAPER_TARGET_URLS
+        self.search_url = search_url
+        self.item_pattern = re.compile(item_pattern)
+
+    def search_page_url(self, product: Product) -> str:
+        return self.search_url.format(quote_plus(product.name))
+
+    def product_page_url(self, sku: str) -> str:
+        return Config.SCRAPER_TARGET_URLS[self.key].format(sku)
+
+    def first_result_sku(self, html: str) -> str | None:
+        # Result links in page order; the first item link is the best match
+        soup = BeautifulSoup(html, "html.parser")
+        for link in soup.find_all("a", href=True):
+            match = self.item_pattern.search(link["href"])
+            if match:
+                return match.group(1)
+        return None
+
+
+RESOLVERS = {
+    "amazon.com": RetailerResolver("amazon", "https://www.amazon.com/s?k={}", r"/(?:dp|gp/product)/([A-Z0-9]{10})"),
+    # Newegg items: N82E16819113666 (Newegg) or 9SIA...-style marketplace ids; /p/pl is the search page itself
+    "newegg.com": RetailerResolver("newegg", "https://www.newegg.com/p/pl?d={}", r"/p/(?!pl\b)((?:N82E\d{11})|(?:[0-9A-Z]{3,}(?:-[0-9A-Z]+)+))"),
+}
+
+
+def resolve_product_url(product: Product, retailer: str, http=None) -> tuple | None:
+    """
+    Looks the product up on the retailer's search page once and returns (sku, direct product URL),
+    or None when nothing matched. Raises requests exceptions on network errors.
+    """
+    resolver = RESOLVERS.get(retailer)
+    if resolver is None:
+        return None
+    with span("scraper.resolve", stage=resolver.key):
+        response = (http or requests).get(resolver.search_page_url(product), headers=HEADERS, timeout=10)
+        response.raise_for_status()
+        sku = resolver.first_result_sku(response.text)
+    if sku is None:
+        return None
+    return sku, resolver.product_page_url(sku)
+
+
+def _needs_resolution(link: RetailerProductUrl, now: datetime) -> bool:
+    if link.product_url:
+        return (link.failure_count or 0) >= Config.RETAILER_URL_MAX_FAILURES
+    # Not listed last time we searched: retry once in a while, not on every run
+    resolved_at = link.resolved_at.replace(tzinfo=None) if link.resolved_at else None
+    return resolved_at is None or now - resolved_at >= RESOLVE_RETRY_INTERVAL
+
+
+def get_product_link(db: Session, product: Product, retailer: str, links: dict = None, http=None) -> RetailerProductUrl | None:
+    """
+    Returns the product's stored direct URL for `retailer`, resolving it via search only when it's
+    unknown or the stored one kept failing. `links` is an optional preloaded
+    {(product_id, retailer): RetailerProductUrl} map (see load_product_links).
+    Returns None when the retailer isn't supported or no product page is known.
+    """
+    if retailer not in RESOLVERS:
+        return None
+    if links is not None:
+        link = links.get((product.id, retailer))
+    else:
+        link = db.query(RetailerProductUrl).filter_by(product_id=product.id, retailer_name=retailer).first()
+    now = datetime.now()
+    if link is not None and not _needs_resolution(link, now):
+        return link if link.product_url else None
+
+    if link is None:
+        link = RetailerProductUrl(product_id=product.id, retailer_name=retailer, failure_count=0)
+        db.add(link)
+        if links is not None:
+            links[(product.id, retailer)] = link
+    try:
+        resolved = resolve_product_url(product, retailer, http=http)
+    except requests.exceptions.RequestException as e:
+        # Keep whatever we had; the next run tries again
+        URL_RESOLUTIONS.inc(retailer=retailer, outcome="error")
+        logger.warning("Error resolving %s URL for %s: %s", retailer, product.name, e)
+        return link if link.product_url else None
+
+    link.resolved_at = now
+    if resolved is None:
+        URL_RESOLUTIONS.inc(retailer=retailer, outcome="not_found")
+        logger.info("No %s listing found for %s.", retailer, product.name)
+        link.product_url = None
+        link.retailer_sku = None
+        return None
+    URL_RESOLUTIONS.inc(retailer=retailer, outcome="resolved")
+    link.retailer_sku, link.product_url = resolved
+    link.failure_count = 0
+    logger.info("Resolved %s URL for %s: %s", retailer, product.name, link.product_url)
+    return link
+
+
+def load_product_links(db: Session) -> dict:
+    """All stored links as {(product_id, retailer): RetailerProductUrl}, for one query per scrape run."""
+    return {(link.product_id, link.retailer_name): link for link in db.query(RetailerProductUrl).all()}
+
+
+def record_scrape_result(link: RetailerProductUrl, found_price: bool):
+    """Marks the link verified, or counts a failure; RETAILER_URL_MAX_FAILURES in a row trigger re-resolution."""
+    if found_price:
+        link.verified_at = datetime.now()
+        link.failure_count = 0
+    else:
+        link.failure_count = (link.failure_count or 0) + 1
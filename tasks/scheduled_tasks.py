@@ -1,5 +1,6 @@
 import sys
 import os
+import logging
 
 # Add the project root to the path to allow imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -7,24 +8,47 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 from database import SessionLocal
 from services.scraper_service import update_product_prices
 from services.notification_service import NotificationService
+from services.recommendation_tiers import refresh_recommendation_tiers
+from services.price_history import compact_price_history
+from services.build_store import flush_build_queue
+from config import Config
+from services.profiling import profile
+from logging_config import configure_logging
+
+logger = logging.getLogger(__name__)
 
 def run_scheduled_tasks():
     db = SessionLocal()
     try:
-        print(f"[{datetime.now()}] Starting scheduled tasks...")
+        logger.info("Starting scheduled tasks...")
         # 1. Update prices
-        update_product_prices(db)
+        with profile("task.update_prices"):
+            update_product_prices(db)
 
         # 2. Check for price drops and send notifications
-        notification_service = NotificationService(db)
-        notification_service.check_for_price_drops()
+        with profile("task.price_drops"):
+            notification_service = NotificationService(db)
+            notification_service.check_for_price_drops()
+
+        # 3. Rebuild the materialized recommendation tiers affected by the new prices
+        with profile("task.recommendation_tiers"):
+            refresh_recommendation_tiers(db)
+
+        # 4. Roll completed days up into daily price rollups and apply retention (no-op until a day completes)
+        with profile("task.compact_price_history"):
+            compact_price_history(db)
+
+        # 5. Write any builds left in this host's write-behind queue (e.g. by a worker that has since stopped)
+        if Config.BUILD_WRITE_BEHIND:
+            with profile("task.flush_build_queue"):
+                flush_build_queue(db)
 
-        print(f"[{datetime.now()}] Scheduled tasks completed.")
+        logger.info("Scheduled tasks completed.")
     except Exception as e:
-        print(f"[{datetime.now()}] Error during scheduled tasks: {e}")
+        logger.error("Error during scheduled tasks: %s", e, exc_info=True)
     finally:
         db.close()
 
 if __name__ == "__main__":
-    from datetime import datetime
+    configure_logging()
     run_scheduled_tasks()
\ No newline at end of file